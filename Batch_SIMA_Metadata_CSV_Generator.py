@@ -13,104 +13,177 @@ channel_presets = {
     "ChannelName": "DRAQ7",
     "Color": "#dd00ff",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 628,
+    "EmissionWavelength": 685},
 
 "Nonconfocal DAPI": {
     "ChannelName": "DAPI",
     "Color": "#0035ff",
     "AcquisitionType": "NonConfocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 377,
+    "EmissionWavelength": 447},
 
 "Confocal DAPI": {
     "ChannelName": "DAPI",
     "Color": "#0035ff",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 377,
+    "EmissionWavelength": 447},
 
 "NonConfocal Bright Field": {
     "ChannelName": "Bright Field",
     "Color": "#888a8c",
     "AcquisitionType": "NonConfocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "BTIColor": ["Bright Field", "Brightfield"]},
 
 "NonConfocal Bright Field-High Contrast": {
     "ChannelName": "Bright Field-High Contrast",
     "Color": "#48494a",
     "AcquisitionType": "NonConfocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "BTIColor": ["High Contrast Bright Field", "High Contrast Brightfield", "High Contrast"]},
 
 "Confocal Texas Red": {
     "ChannelName": "Texas Red",
     "Color": "#ed0707",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 586,
+    "EmissionWavelength": 647},
 
 "Confocal GFP": {
     "ChannelName": "GFP",
     "Color": "#07ed07",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 469,
+    "EmissionWavelength": 525},
 
 "Confocal CY5": {
     "ChannelName": "CY5",
     "Color": "#dd00ff",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 628,
+    "EmissionWavelength": 685},
 
 "Confocal TRITC": {
     "ChannelName": "TRITC", 
     "Color": "#ed0707",
     "AcquisitionType": "Confocal",
-    "ChannelType": "Fluoresence"},
+    "ChannelType": "Fluoresence",
+    "ExcitationWavelength": 556,
+    "EmissionWavelength": 600},
 }
 
+# --auto-channels matches the header of each channel against the optional keys of the presets: BTIColor (the Gen5
+# Color names of the channel, the ChannelName is always tried), ExcitationWavelength and EmissionWavelength in nm,
+# within WavelengthTolerance nm (default CHANNEL_WAVELENGTH_TOLERANCE_NM), and the AcquisitionType. Presets that
+# match equally well go to the one with the highest Priority (default 0), e.g. CY5 over DRAQ7 with Priority = 1.
+CHANNEL_WAVELENGTH_TOLERANCE_NM = 10
+
 
 
 
 
 import tifffile
+import numpy as np
 import xml.etree.ElementTree as ET
 import json
-from PIL import Image
+import io
+import mmap
 import os
+import sys
 import xmltodict
 from datetime import datetime
 import csv
-
-
-
-
-
-def get_input_output():
-    print("\nPress Ctrl + C to exit anytime.")
+import shutil
+import sqlite3
+import argparse
+import queue
+import threading
+import time
+import cProfile
+import contextlib
+import zlib
+import zipfile
+import tarfile
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from SIMA_Discovery import DiscoveryFilter, add_discovery_arguments, get_discovery_options, iter_tiff_filepaths
+from SIMA_CSVWriter import SIMACSVWriter
+from SIMA_MetadataCache import MetadataCache
+from SIMA_MetadataIndex import parse_metadata_index
+from SIMA_JobFile import load_job_file, parse_args_with_job_file
+
+
+
+
+
+def get_input_output(walk_input=True, stage_timer=None, allow_empty=False, discovery_options=None, input_directory=None, output_directory=None):
+    """
+    Ask for (or check the given) input and output folders and return the tifs, the output folder and the input folder.
+    With walk_input=False only the first tif is returned, discovery_options are passed on to iter_tiff_filepaths.
+    """
+    if discovery_options is None:
+        discovery_options = {}
+
+    headless = input_directory is not None and output_directory is not None
+    if not headless:
+        print("\nPress Ctrl + C to exit anytime.")
+    given_input_directory = input_directory
+    given_output_directory = output_directory
     tiff_filepaths = []
     while True:
-        input_directory = input("\nINPUT - Enter an input folder with aligned kinetic stacks to split/generate a SImA Upload CSV: ")
-        if not os.path.isdir(input_directory):
+        while given_input_directory is None:
+            input_directory = input("\nINPUT - Enter an input folder with aligned kinetic stacks to split/generate a SImA Upload CSV: ")
+            if not os.path.isdir(input_directory):
+                print(f"ERROR: The folder '{input_directory}' does not exist.")
+                continue
+            else:
+                break
+        if given_input_directory is not None and not os.path.isdir(input_directory):
             print(f"ERROR: The folder '{input_directory}' does not exist.")
-            continue
-        else:
-            # Walk through the directory and get .tif files
-            for root, dirs, files in os.walk(input_directory):
-                for file in files:
-                    if file.endswith(".tif") or file.endswith(".tiff"):
-                        tiff_filepaths.append(os.path.join(root, file))
-            if not len(tiff_filepaths) > 0:
-                print(f"ERROR: The folder '{input_directory}' does not contain any .tif files, please try again.")
+            exit()
+
+        while given_output_directory is None:
+            output_directory = input("\nOUTPUT - Enter an folder to output the CSV and split stacks: ")
+            if not os.path.isdir(output_directory):
+                print(f"ERROR: The folder '{output_directory}' does not exist, try again.")
                 continue
             else:
                 break
+        if given_output_directory is not None and not os.path.isdir(output_directory):
+            print(f"ERROR: The folder '{output_directory}' does not exist.")
+            exit()
 
-    while True:
-        output_directory = input("\nOUTPUT - Enter an folder to output the CSV and split stacks: ")
-        if not os.path.isdir(output_directory):
-            print(f"ERROR: The folder '{output_directory}' does not exist, try again.")
+        # Walk through the directory and get .tif files, without the frames split into an output folder inside it
+        if walk_input:
+            discovery_start = time.perf_counter()
+            tiff_filepaths = list(iter_tiff_filepaths(input_directory, exclude_directories=[output_directory], **discovery_options))
+            if stage_timer is not None:
+                stage_timer.record("discovery", time.perf_counter() - discovery_start, count=len(tiff_filepaths))
+        else:
+            first_tiff_filepath = next(iter_tiff_filepaths(input_directory, exclude_directories=[output_directory], **discovery_options), None)
+            tiff_filepaths = [first_tiff_filepath] if first_tiff_filepath is not None else []
+        if not len(tiff_filepaths) > 0 and not allow_empty:
+            if given_input_directory is not None:
+                print(f"ERROR: The folder '{input_directory}' does not contain any .tif files.")
+                exit()
+            print(f"ERROR: The folder '{input_directory}' does not contain any .tif files, please try again.")
             continue
         else:
             break
 
-    
-    return tiff_filepaths, output_directory
+    return tiff_filepaths, output_directory, input_directory
 
 def well_id_to_row_col(well_id):
     rows = "ABCDEFGHIJKLMNOP"
@@ -197,6 +270,9 @@ def get_metadata_info(image_metadata):
         resolution = "0.1612"
     elif objectiveSizeInt == 60:
         resolution = "0.1082"
+    else:
+        print(f"ERROR get_metadata_info: Unknown objective size {objectiveMagnification}x, only 4x, 10x, 20x, 40x and 60x objectives have a known image resolution.")
+        exit()
     resolutionX = resolution
     resolutionY = resolution
 
@@ -215,29 +291,6 @@ def get_metadata_info(image_metadata):
 
     return plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor,channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename, wellID
 
-def create_append_SIMA_CSV(filepath, data):
-    headers = [
-        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
-        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um", 
-        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm", 
-        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth", 
-        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification", 
-        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
-    ]
-    
-    try:
-        with open(filepath, mode='a+', newline='') as file:
-            writer = csv.writer(file)
-            
-            file.seek(0)
-            if file.read(1) == '':
-                writer.writerow(headers)
-            
-            writer.writerows(data)
-
-    except Exception as e:
-        print(f"ERROR create_append_SIMA_CSV: {e}")
-
 def colored_text(text, hex_color):
     # Remove '#' if present in the hex string
     hex_color = hex_color.lstrip('#')
@@ -319,11 +372,923 @@ def get_channel_settings(image_metadata, channel_presets):
     
     return chosen_channel_ids
 
-def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder):
+def resolve_channel_settings(image_metadata, channel_presets, channels):
+    """
+    Pick the preset of each channel from channels, a list (or comma separated string) of preset names or of their
+    1-based numbers in the menu of get_channel_settings. Returns the same (index, preset name) list without asking.
+    """
+    num_channels = int(image_metadata["num_channels"])
+    channel_names = list(channel_presets.keys())
+    if isinstance(channels, str):
+        channels = [channel.strip() for channel in channels.split(",")]
+
+    if len(channels) != num_channels:
+        print(f"ERROR resolve_channel_settings: {len(channels)} channels were given but the stacks have {num_channels} channels.")
+        exit()
+
+    chosen_channel_ids = []
+    for i, channel in enumerate(channels):
+        if str(channel).isdigit() and 1 <= int(channel) <= len(channel_names):
+            chosen_channel_name = channel_names[int(channel) - 1]
+        elif channel in channel_presets:
+            chosen_channel_name = channel
+        else:
+            print(f"ERROR resolve_channel_settings: '{channel}' is not one of the channel presets: {', '.join(channel_names)}")
+            exit()
+        chosen_channel_ids.append((i, chosen_channel_name))
+        print(f"\tChannel {i+1} is {chosen_channel_name}")
+
+    return chosen_channel_ids
+
+def get_channel_names_inorder(chosen_channel_ids, channel_presets):
+    """Turn the (index, preset name) list of get_channel_settings into the (name, acquisition type, color) list the split names frames with."""
+    channel_names_inorder = []
+    for index, channel_key in chosen_channel_ids:
+        preset = channel_presets[channel_key]
+        channel_names_inorder.append((preset["ChannelName"], preset["AcquisitionType"], preset["Color"]))
+    return channel_names_inorder
+
+def load_channel_presets(presets_filepath, channel_presets):
+    """
+    Return channel_presets with the presets of a JSON or TOML preset file added, replacing built-in ones of the same name.
+    Each preset needs ChannelName, Color and AcquisitionType, the keys --auto-channels uses are described above.
+    """
+    loaded_presets = load_job_file(presets_filepath, "preset file")
+    for preset_name, preset in loaded_presets.items():
+        if not isinstance(preset, dict) or any(key not in preset for key in ("ChannelName", "Color", "AcquisitionType")):
+            print(f"ERROR load_channel_presets: The preset '{preset_name}' in {presets_filepath} needs a ChannelName, Color and AcquisitionType.")
+            exit()
+        if not isinstance(preset.get("Priority", 0), (int, float)):
+            print(f"ERROR load_channel_presets: The Priority of the preset '{preset_name}' in {presets_filepath} has to be a number.")
+            exit()
+        preset.setdefault("ChannelType", "Fluoresence")
+    return dict(channel_presets, **loaded_presets)
+
+def get_acquisition_type(acquisition_mode):
+    """Map an OME AcquisitionMode onto the Confocal/NonConfocal AcquisitionType of the presets, None when the header doesn't say."""
+    if not acquisition_mode or acquisition_mode == "Other":
+        return None
+    return "Confocal" if "confocal" in acquisition_mode.lower() else "NonConfocal"
+
+def normalize_channel_name(name):
+    return "".join(character for character in str(name or "").lower() if character.isalnum())
+
+def match_channel_preset(channel_info, preset):
+    """
+    Score how well a channel header matches a preset (2 for the name, 1 per wavelength and for the acquisition type),
+    or None when the header contradicts the preset or matches neither its names nor its wavelengths.
+    """
+    score = 0
+    acquisition_type = get_acquisition_type(channel_info.get("acquisitionMode"))
+    if acquisition_type is not None:
+        if acquisition_type.lower() != preset["AcquisitionType"].lower():
+            return None
+        score += 1
+
+    preset_names = preset.get("BTIColor", [])
+    if isinstance(preset_names, str):
+        preset_names = [preset_names]
+    preset_names = {normalize_channel_name(name) for name in preset_names + [preset["ChannelName"]]}
+    header_names = {normalize_channel_name(channel_info.get("color")), normalize_channel_name(channel_info.get("name"))} - {""}
+    name_matches = len(header_names & preset_names) > 0
+    if name_matches:
+        score += 2
+
+    wavelength_matches = False
+    tolerance = float(preset.get("WavelengthTolerance", CHANNEL_WAVELENGTH_TOLERANCE_NM))
+    for header_key, preset_key in (("excitationWavelength", "ExcitationWavelength"), ("emissionWavelength", "EmissionWavelength")):
+        header_value = channel_info.get(header_key)
+        if header_value in (None, "") or preset.get(preset_key) is None:
+            continue
+        try:
+            if abs(float(header_value) - float(preset[preset_key])) > tolerance:
+                return None
+        except ValueError:
+            continue
+        wavelength_matches = True
+        score += 1
+
+    if not name_matches and not wavelength_matches:
+        return None
+    return score
+
+def describe_channel_info(channel_info):
+    description = channel_info.get("color") or channel_info.get("name") or "unnamed"
+    if channel_info.get("excitationWavelength") or channel_info.get("emissionWavelength"):
+        description += f", {channel_info.get('excitationWavelength') or '?'}/{channel_info.get('emissionWavelength') or '?'} nm"
+    if channel_info.get("acquisitionMode"):
+        description += f", {channel_info['acquisitionMode']}"
+    return description
+
+def resolve_stack_channels(image_metadata, channel_presets):
+    """
+    Pick the best matching preset of each channel of a stack, ties going to the highest Priority.
+    Returns the (index, preset name) list and the channels that match no preset or still tie.
+    """
+    num_channels = int(image_metadata["num_channels"])
+    channel_infos = image_metadata.get("channels") or []
+    if len(channel_infos) != num_channels:
+        return [], [f"the header describes {len(channel_infos)} channels but the stack has {num_channels}"]
+
+    chosen_channel_ids = []
+    problems = []
+    for i, channel_info in enumerate(channel_infos):
+        scores = {}
+        for preset_name, preset in channel_presets.items():
+            score = match_channel_preset(channel_info, preset)
+            if score is not None:
+                scores[preset_name] = score
+        if len(scores) == 0:
+            problems.append(f"channel {i+1} ({describe_channel_info(channel_info)}) matches none of the channel presets")
+            continue
+        best_score = max(scores.values())
+        best_preset_names = [preset_name for preset_name, score in scores.items() if score == best_score]
+        best_priority = max(float(channel_presets[preset_name].get("Priority", 0)) for preset_name in best_preset_names)
+        best_preset_names = [preset_name for preset_name in best_preset_names if float(channel_presets[preset_name].get("Priority", 0)) == best_priority]
+        if len(best_preset_names) > 1:
+            problems.append(f"channel {i+1} ({describe_channel_info(channel_info)}) matches the presets {', '.join(best_preset_names)} equally well, "
+                            f"give the one to use a higher Priority in a --channel-presets file or pick the channels with --channels")
+            continue
+        chosen_channel_ids.append((i, best_preset_names[0]))
+
+    return chosen_channel_ids, problems
+
+def resolve_stack_channel_names(tiff_filepath, image_metadata, channel_presets):
+    """resolve_stack_channels as the channel_names_inorder of the stack, exits when a channel can't be picked."""
+    chosen_channel_ids, problems = resolve_stack_channels(image_metadata, channel_presets)
+    if len(problems) > 0:
+        print(f"ERROR resolve_stack_channels: Could not pick the channels of {tiff_filepath}: {'; '.join(problems)}")
+        exit()
+    return get_channel_names_inorder(chosen_channel_ids, channel_presets)
+
+class StageTimer:
+    """
+    Collect the wall time, bytes and item count of each run stage and write them as a JSON or CSV report.
+    Worker processes keep their own StageTimer and send back its samples to merge().
+    """
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+
+    def record(self, stage, seconds, bytes_read=0, bytes_written=0, count=1):
+        with self.lock:
+            self.samples.setdefault(stage, []).append((seconds, bytes_read, bytes_written, count))
+
+    @contextlib.contextmanager
+    def time(self, stage, bytes_read=0, bytes_written=0, count=1):
+        start = time.perf_counter()
+        yield
+        self.record(stage, time.perf_counter() - start, bytes_read, bytes_written, count)
+
+    def merge(self, samples):
+        with self.lock:
+            for stage, stage_samples in samples.items():
+                self.samples.setdefault(stage, []).extend(stage_samples)
+
+    def get_report(self):
+        """Return one dict per stage with the totals, the seconds per sample and the MB/s per sample at the 50th, 90th and 99th percentile."""
+        stage_reports = []
+        for stage, stage_samples in self.samples.items():
+            sample_array = np.array(stage_samples, dtype=np.float64)
+            seconds, bytes_read, bytes_written, counts = sample_array.T
+            mb_per_s = np.maximum(bytes_read, bytes_written) / 1024 / 1024 / np.maximum(seconds, 1e-9)
+            total_seconds = float(seconds.sum())
+
+            stage_report = {
+                "stage": stage,
+                "samples": len(stage_samples),
+                "count": int(counts.sum()),
+                "total_seconds": total_seconds,
+                "bytes_read": int(bytes_read.sum()),
+                "bytes_written": int(bytes_written.sum()),
+                "count_per_s": float(counts.sum()) / total_seconds if total_seconds > 0 else None,
+            }
+            for percentile in [50, 90, 99]:
+                stage_report[f"seconds_p{percentile}"] = float(np.percentile(seconds, percentile))
+            for percentile in [50, 90, 99]:
+                stage_report[f"mb_per_s_p{percentile}"] = float(np.percentile(mb_per_s, percentile))
+            stage_reports.append(stage_report)
+
+        return stage_reports
+
+    def write_report(self, report_filepath):
+        """Write the report as CSV if report_filepath ends with .csv, as JSON otherwise."""
+        stage_reports = self.get_report()
+        if report_filepath.lower().endswith(".csv"):
+            with open(report_filepath, "w", newline="") as report_file:
+                fieldnames = list(stage_reports[0].keys()) if len(stage_reports) > 0 else ["stage"]
+                csv_writer = csv.DictWriter(report_file, fieldnames=fieldnames)
+                csv_writer.writeheader()
+                csv_writer.writerows(stage_reports)
+        else:
+            with open(report_filepath, "w") as report_file:
+                json.dump({"run_seconds": time.perf_counter() - self.start_time, "stages": stage_reports}, report_file, indent=2)
+
+class ProgressReporter:
+    """
+    Print stacks done/total, frames/s, MB/s and ETA at most once every interval seconds instead of a line per frame.
+    log_filepath logs every saved frame, total_stacks can be None while stacks are still being found.
+    """
+    def __init__(self, total_stacks=None, interval=2.0, quiet=False, log_filepath=None):
+        self.total_stacks = total_stacks
+        self.stacks_found = 0
+        self.interval = interval
+        self.quiet = quiet
+        self.log_file = open(log_filepath, "a") if log_filepath else None
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.last_print_time = self.start_time
+
+        self.stacks_done = 0
+        self.frames_done = 0
+        self.bytes_done = 0
+        # Frames of the stack currently split in this process, replaced by the stack totals once it is done
+        self.stack_frames = 0
+        self.stack_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stack_found(self):
+        with self.lock:
+            self.stacks_found += 1
+
+    def discovery_done(self):
+        with self.lock:
+            self.total_stacks = self.stacks_found
+
+    def log(self, message):
+        if self.log_file is not None:
+            with self.lock:
+                self.log_file.write(message + "\n")
+
+    def frame_done(self, output_filename, nbytes):
+        with self.lock:
+            self.stack_frames += 1
+            self.stack_bytes += nbytes
+            if self.log_file is not None:
+                self.log_file.write(f"\tSaved frame {self.stack_frames} as {output_filename}\n")
+        self.update()
+
+    def stack_done(self, tiff_filepath, split_metadata, nbytes, log_frames=True):
+        """Count a finished stack. With log_frames the frames in its CSV rows are logged, for stacks split in another process."""
+        with self.lock:
+            self.stacks_done += 1
+            self.frames_done += len(split_metadata)
+            self.bytes_done += nbytes
+            self.stack_frames = 0
+            self.stack_bytes = 0
+            if self.log_file is not None:
+                if log_frames:
+                    for i, metadata_tuple in enumerate(split_metadata):
+                        # SourceFilename is the last column of the CSV rows
+                        self.log_file.write(f"\tSaved frame {i+1} as {metadata_tuple[-1]}\n")
+                self.log_file.write(f"Finished {tiff_filepath}\n")
+        self.update()
+
+    def stack_failed(self, tiff_filepath):
+        """Count a stack that failed in continue-on-error mode as done, without its frames."""
+        with self.lock:
+            self.stacks_done += 1
+            self.stack_frames = 0
+            self.stack_bytes = 0
+            if self.log_file is not None:
+                self.log_file.write(f"Failed {tiff_filepath}\n")
+        self.update()
+
+    def get_status(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start_time, 1e-9)
+            frames = self.frames_done + self.stack_frames
+            megabytes = (self.bytes_done + self.stack_bytes) / 1024 / 1024
+            total_stacks = self.total_stacks if self.total_stacks is not None else self.stacks_found
+
+            if self.stacks_done > 0 and total_stacks > self.stacks_done:
+                eta = time.strftime("%H:%M:%S", time.gmtime(elapsed / self.stacks_done * (total_stacks - self.stacks_done)))
+            elif total_stacks > 0 and self.stacks_done >= total_stacks:
+                eta = "00:00:00"
+            else:
+                eta = "--:--:--"
+            if self.total_stacks is None:
+                total_stacks = f"{total_stacks}+"
+                eta = f"{eta}+"
+
+            return f"Stacks {self.stacks_done}/{total_stacks} | {frames / elapsed:.1f} frames/s | {megabytes / elapsed:.1f} MB/s | ETA {eta}"
+
+    def update(self, force=False):
+        if self.quiet:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.last_print_time < self.interval:
+                return
+            self.last_print_time = now
+        print(self.get_status(), flush=True)
+
+    def close(self):
+        self.update(force=True)
+        if self.log_file is not None:
+            with self.lock:
+                self.log_file.close()
+                self.log_file = None
+
+def profile_call(profile_directory, tiff_filepath, function, *args, **kwargs):
+    """Call function, and with a profile_directory dump its cProfile stats there as <stack name>.prof."""
+    if profile_directory is None:
+        return function(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profile_filename = os.path.splitext(os.path.basename(tiff_filepath))[0] + ".prof"
+        profiler.dump_stats(os.path.join(profile_directory, profile_filename))
+
+def map_tiff_file(tif):
+    """Memory-map an open TiffFile so page data can be read without copying. Returns None if the file can't be mapped."""
+    try:
+        return mmap.mmap(tif.filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+OUTPUT_CODECS = ["none", "zlib", "lzw", "zstd"]
+# On the 12 bits of noisy camera data zlib level 1 compresses almost as well as the default level 6, about 5x faster
+DEFAULT_CODEC_LEVELS = {"zlib": 1}
+
+def get_codec_write_kwargs(codec="none", level=None, workers=4, rows_per_strip=64):
+    """
+    Return the TiffWriter.write keyword arguments to compress split frames with codec, or None for "none".
+    The codec is tried on a small frame first, so a missing codec fails before anything is split.
+    """
+    if codec not in OUTPUT_CODECS:
+        print(f"ERROR get_codec_write_kwargs: Unknown codec '{codec}', use one of {', '.join(OUTPUT_CODECS)}.")
+        exit()
+    if codec == "none":
+        return None
+
+    codec_kwargs = {"compression": codec, "predictor": True, "rowsperstrip": rows_per_strip, "maxworkers": max(1, workers)}
+    if level is None:
+        level = DEFAULT_CODEC_LEVELS.get(codec)
+    if level is not None:
+        codec_kwargs["compressionargs"] = {"level": level}
+    try:
+        with tifffile.TiffWriter(io.BytesIO()) as writer:
+            writer.write(np.zeros((2, 2), dtype=np.uint16), **codec_kwargs)
+    except Exception as e:
+        print(f"ERROR get_codec_write_kwargs: Can't write {codec} compressed frames here ({e}). LZW and zstd need imagecodecs (pip install imagecodecs).")
+        exit()
+    return codec_kwargs
+
+def read_page_data(tif, page, stack_map=None, codec_kwargs=None):
+    """
+    Return the data of a page of an open stack and the TiffWriter.write keyword arguments for write_frame_to_tiff.
+    Uncompressed pages come straight out of the mapped stack, the others are decoded once.
+    """
+    write_kwargs = {
+        "photometric": page.photometric,
+        "resolution": page.get_resolution(),
+        "resolutionunit": page.resolutionunit,
+        "metadata": None,
+    }
+    if page.samplesperpixel > 1:
+        write_kwargs["planarconfig"] = page.planarconfig
+
+    is_raw_copyable = (
+        stack_map is not None
+        and page.compression == 1
+        and page.predictor == 1
+        and page.fillorder == 1
+        and page.bitspersample == page.dtype.itemsize * 8
+    )
+
+    if is_raw_copyable and page.is_contiguous:
+        # The whole page is one block in the stack, write a view of the mapped file
+        page_dtype = page.dtype.newbyteorder(tif.byteorder)
+        page_data = np.ndarray(page.shape, dtype=page_dtype, buffer=stack_map, offset=page.dataoffsets[0])
+        write_kwargs.update(rowsperstrip=page.rowsperstrip, bitspersample=page.bitspersample)
+    elif is_raw_copyable and codec_kwargs is None:
+        # Stream the raw strips or tiles in the same layout as the stack
+        page_data = (stack_map[offset:offset + bytecount] for offset, bytecount in zip(page.dataoffsets, page.databytecounts))
+        write_kwargs.update(shape=page.shape, dtype=page.dtype)
+        if page.is_tiled:
+            write_kwargs["tile"] = page.tile
+        else:
+            write_kwargs["rowsperstrip"] = page.rowsperstrip
+    else:
+        page_data = page.asarray()
+        write_kwargs["bitspersample"] = page.bitspersample
+
+    if codec_kwargs is not None:
+        # Compressed in the strips of the codec, not those of the stack
+        write_kwargs.update(codec_kwargs)
+
+    return page_data, write_kwargs
+
+def gf2_matrix_times(matrix, vector):
+    total = 0
+    for row in matrix:
+        if vector == 0:
+            break
+        if vector & 1:
+            total ^= row
+        vector >>= 1
+    return total
+
+def gf2_matrix_square(matrix):
+    return [gf2_matrix_times(matrix, row) for row in matrix]
+
+# CRC32_ZERO_OPERATORS[n] moves a CRC32 past 2**n zero bytes, starting from the operator for a single zero bit
+CRC32_ZERO_OPERATORS = [[0xEDB88320] + [1 << n for n in range(31)]]
+for _ in range(3):
+    CRC32_ZERO_OPERATORS[0] = gf2_matrix_square(CRC32_ZERO_OPERATORS[0])
+for _ in range(47):
+    CRC32_ZERO_OPERATORS.append(gf2_matrix_square(CRC32_ZERO_OPERATORS[-1]))
+
+def crc32_combine(crc1, crc2, length2):
+    """zlib's crc32_combine: the CRC32 of two blocks joined, from the CRC32 of each and the length of the second."""
+    for operator in CRC32_ZERO_OPERATORS:
+        if length2 == 0:
+            break
+        if length2 & 1:
+            crc1 = gf2_matrix_times(operator, crc1)
+        length2 >>= 1
+    return crc1 ^ crc2
+
+class ChecksumFile(io.RawIOBase):
+    """Write-through file for TiffWriter that works out the CRC32 of the finished file from the bytes as they are written."""
+    # Runs of bytes up to this size keep their bytes, so the header and IFD tifffile rewrites can be patched
+    max_kept_bytes = 64 * 1024
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        # [offset, length, crc32, bytes or None] of each run of bytes in the file
+        self.extents = []
+        self.tail_extent = None
+        self.size = 0
+        self.overwritten = False
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.output_file.seek(offset, whence)
+
+    def tell(self):
+        return self.output_file.tell()
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        offset = self.output_file.tell()
+        length = self.output_file.write(data)
+        if self.tail_extent is not None and offset == self.size:
+            # Appending to the end of the file, the frame data is written this way
+            tail_extent = self.tail_extent
+            tail_extent[1] += length
+            tail_extent[2] = zlib.crc32(data, tail_extent[2])
+            tail_extent[3] = tail_extent[3] + data.tobytes() if tail_extent[3] is not None and tail_extent[1] <= self.max_kept_bytes else None
+            self.size += length
+            return length
+
+        end = offset + length
+        for extent in [extent for extent in self.extents if extent[0] < end and offset < extent[0] + extent[1]]:
+            self.extents.remove(extent)
+            extent_offset, extent_length, extent_crc, extent_bytes = extent
+            if offset <= extent_offset and extent_offset + extent_length <= end:
+                continue
+            if extent_bytes is None:
+                self.overwritten = True
+                continue
+            if extent_offset < offset:
+                self.add_extent(extent_offset, extent_bytes[:offset - extent_offset])
+            if extent_offset + extent_length > end:
+                self.add_extent(end, extent_bytes[end - extent_offset:])
+        self.add_extent(offset, data)
+        return length
+
+    def add_extent(self, offset, data):
+        extent = [offset, len(data), zlib.crc32(data), bytes(data) if len(data) <= self.max_kept_bytes else None]
+        self.extents.append(extent)
+        if offset + len(data) >= self.size:
+            self.size = offset + len(data)
+            self.tail_extent = extent
+
+    def get_checksum(self):
+        """The CRC32 of the file, or None when a write only partly replaced a large earlier one."""
+        if self.overwritten:
+            return None
+        checksum = 0
+        position = 0
+        for offset, length, data_crc, data in sorted(self.extents, key=lambda extent: extent[0]):
+            if offset > position:
+                # Bytes tifffile skipped over are zeros
+                checksum = zlib.crc32(bytes(offset - position), checksum)
+            checksum = crc32_combine(checksum, data_crc, length)
+            position = offset + length
+        return checksum
+
+def get_file_checksum(output_filepath):
+    checksum = 0
+    with open(output_filepath, "rb") as output_file:
+        for chunk in iter(lambda: output_file.read(1024 * 1024), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return checksum
+
+def write_frame_to_tiff(output_filepath, page_data, write_kwargs, byteorder, fsync=False, stage_timer=None, checksum=False, archive_writer=None):
+    """
+    Write the data from read_page_data to its own TIFF (or into archive_writer) and return the bytes written
+    and, with checksum, the CRC32 of the written bytes (None otherwise).
+    """
+    start = time.perf_counter()
+    frame_checksum = None
+    if archive_writer is not None:
+        # tifffile seeks back to fill in the tags, so the frame is put together in memory first
+        frame_file = io.BytesIO()
+        with tifffile.TiffWriter(frame_file, byteorder=byteorder) as writer:
+            writer.write(page_data, **write_kwargs)
+        frame_bytes = frame_file.getbuffer()
+        bytes_written = len(frame_bytes)
+        if checksum:
+            frame_checksum = zlib.crc32(frame_bytes)
+        archive_writer.add_bytes(output_filepath, frame_bytes)
+        if stage_timer is not None:
+            stage_timer.record("frame_write", time.perf_counter() - start, bytes_written=bytes_written)
+        return bytes_written, frame_checksum
+
+    if checksum and isinstance(page_data, np.ndarray) and page_data.ndim == 2 and "rowsperstrip" in write_kwargs and "compression" not in write_kwargs:
+        # Without a fileno numpy would copy the whole frame, handing it over a strip at a time keeps the copies small
+        frame, rows_per_strip = page_data, write_kwargs["rowsperstrip"]
+        write_kwargs = dict(write_kwargs, shape=frame.shape, dtype=frame.dtype)
+        page_data = (frame[row:row + rows_per_strip] for row in range(0, frame.shape[0], rows_per_strip))
+
+    with open(output_filepath, "wb") as output_file:
+        tiff_file = ChecksumFile(output_file) if checksum else output_file
+        with tifffile.TiffWriter(tiff_file, byteorder=byteorder) as writer:
+            writer.write(page_data, **write_kwargs)
+        bytes_written = output_file.tell()
+        if checksum:
+            frame_checksum = tiff_file.get_checksum()
+        if fsync:
+            output_file.flush()
+            os.fsync(output_file.fileno())
+
+    if checksum and frame_checksum is None:
+        frame_checksum = get_file_checksum(output_filepath)
+
+    if stage_timer is not None:
+        stage_timer.record("frame_write", time.perf_counter() - start, bytes_written=bytes_written)
+    return bytes_written, frame_checksum
+
+def read_page_data_timed(tif, page, stack_map=None, stage_timer=None, codec_kwargs=None):
+    """read_page_data, recorded as the frame_decode stage of stage_timer with the bytes the page takes up in the stack."""
+    if stage_timer is None:
+        return read_page_data(tif, page, stack_map, codec_kwargs)
+
+    with stage_timer.time("frame_decode", bytes_read=sum(page.databytecounts)):
+        return read_page_data(tif, page, stack_map, codec_kwargs)
+
+def write_page_to_tiff(tif, page, output_filepath, stack_map=None, stage_timer=None, checksum=False, archive_writer=None, codec_kwargs=None):
+    """Write a single page of an open stack to its own TIFF file with tifffile instead of PIL. Returns what write_frame_to_tiff returns."""
+    page_data, write_kwargs = read_page_data_timed(tif, page, stack_map, stage_timer, codec_kwargs)
+    return write_frame_to_tiff(output_filepath, page_data, write_kwargs, tif.byteorder, stage_timer=stage_timer, checksum=checksum, archive_writer=archive_writer)
+
+class FrameWriter:
+    """Write split frames from a bounded pool of threads, submit() blocks while max_inflight_bytes are waiting."""
+    def __init__(self, workers=4, max_inflight_bytes=256 * 1024 * 1024, fsync=True, stage_timer=None, checksum=False, archive_writer=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_inflight_bytes = max_inflight_bytes
+        self.fsync = fsync
+        self.stage_timer = stage_timer
+        self.checksum = checksum
+        self.archive_writer = archive_writer
+        self.inflight_bytes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, output_filepath, page_data, write_kwargs, byteorder, nbytes):
+        with self.condition:
+            # A frame larger than the whole budget still gets through once nothing else is in flight
+            self.condition.wait_for(lambda: self.inflight_bytes == 0 or self.inflight_bytes + nbytes <= self.max_inflight_bytes)
+            self.inflight_bytes += nbytes
+
+        future = self.executor.submit(write_frame_to_tiff, output_filepath, page_data, write_kwargs, byteorder, self.fsync, self.stage_timer, self.checksum, self.archive_writer)
+        future.add_done_callback(lambda future: self.release(nbytes))
+        return future
+
+    def release(self, nbytes):
+        with self.condition:
+            self.inflight_bytes -= nbytes
+            self.condition.notify_all()
+
+class ArchiveWriter:
+    """Stream the split frames and the CSV into one ZIP or TAR archive, split into volumes of about max_volume_bytes."""
+    def __init__(self, archive_filepath, archive_format="zip", compression="stored", max_volume_bytes=None):
+        if archive_format not in ("zip", "tar"):
+            print(f"ERROR ArchiveWriter: Unknown archive format '{archive_format}', use 'zip' or 'tar'.")
+            exit()
+        if compression not in ("stored", "deflate"):
+            print(f"ERROR ArchiveWriter: Unknown compression '{compression}', use 'stored' or 'deflate'.")
+            exit()
+        self.archive_filepath = archive_filepath
+        self.archive_format = archive_format
+        self.compression = zipfile.ZIP_DEFLATED if compression == "deflate" else zipfile.ZIP_STORED
+        self.max_volume_bytes = max_volume_bytes
+        self.volume_filepaths = []
+        self.archive = None
+        self.volume_bytes = 0
+        self.volume_entries = 0
+        self.lock = threading.Lock()
+        self.open_volume()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_volume_filepath(self, volume_number):
+        if self.max_volume_bytes is None:
+            return self.archive_filepath
+        base_filepath, extension = os.path.splitext(self.archive_filepath)
+        return f"{base_filepath}.{volume_number:03d}{extension}"
+
+    def open_volume(self):
+        volume_filepath = self.get_volume_filepath(len(self.volume_filepaths) + 1)
+        if self.archive_format == "zip":
+            self.archive = zipfile.ZipFile(volume_filepath, "w", compression=self.compression, allowZip64=True)
+        else:
+            self.archive = tarfile.open(volume_filepath, "w", format=tarfile.PAX_FORMAT)
+        self.volume_filepaths.append(volume_filepath)
+        self.volume_bytes = 0
+        self.volume_entries = 0
+
+    def add_bytes(self, arcname, data):
+        """Append a file with the contents data (bytes or a memoryview) to the archive as arcname."""
+        arcname = arcname.replace(os.sep, "/")
+        with self.lock:
+            if self.max_volume_bytes is not None and self.volume_entries > 0 and self.volume_bytes + len(data) > self.max_volume_bytes:
+                self.archive.close()
+                self.open_volume()
+
+            if self.archive_format == "zip":
+                entry_info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+                entry_info.compress_type = self.compression
+                with self.archive.open(entry_info, "w", force_zip64=len(data) >= zipfile.ZIP64_LIMIT) as entry_file:
+                    entry_file.write(data)
+            else:
+                entry_info = tarfile.TarInfo(arcname)
+                entry_info.size = len(data)
+                entry_info.mtime = time.time()
+                self.archive.addfile(entry_info, io.BytesIO(data))
+            self.volume_bytes += len(data)
+            self.volume_entries += 1
+
+    def add_file(self, arcname, filepath):
+        """Append a file on disk, e.g. the CSV, to the archive as arcname."""
+        with open(filepath, "rb") as input_file:
+            self.add_bytes(arcname, input_file.read())
+
+    def close(self):
+        with self.lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+def get_frame_index_table(num_frames, num_channels, num_timepoints=None, num_planes=1, num_fields=1, dimension_order="XYCZT"):
+    """
+    Return the 0-based (timepoint, channel, plane, field) of every page of a stack from the OME DimensionOrder,
+    fields outermost, falling back to channels then timepoints when the header sizes don't add up to num_frames.
+    """
+    order = str(dimension_order or "")[2:]
+    if sorted(order) != ["C", "T", "Z"] or not str(dimension_order).startswith("XY"):
+        order = "CZT"
+
+    sizes = None
+    if num_timepoints is not None:
+        for planes, fields in ((num_planes, num_fields), (num_planes, 1), (1, 1)):
+            if num_channels * int(num_timepoints) * planes * fields == num_frames:
+                sizes = {"C": num_channels, "Z": planes, "T": int(num_timepoints), "F": fields}
+                break
+    if sizes is None:
+        order = "CZT"
+        sizes = {"C": num_channels, "Z": 1, "T": num_frames // num_channels, "F": 1}
+
+    # unravel_index wants the slowest dimension first
+    axes = ["F"] + list(reversed(order))
+    indices = dict(zip(axes, np.unravel_index(np.arange(num_frames), [sizes[axis] for axis in axes])))
+    return np.stack([indices["T"], indices["C"], indices["Z"], indices["F"]], axis=1)
+
+def parse_timepoint_ranges(timepoints):
+    """
+    Turn a comma separated string of 1-based timepoints and inclusive ranges, e.g. "1-10,25,50-" (an open end runs
+    to the last timepoint), into a list of (first, last) tuples, last being None for an open end.
+    """
+    timepoint_ranges = []
+    for part in str(timepoints).split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        first, separator, last = part.partition("-")
+        try:
+            first = int(first) if first.strip() else 1
+            last = (int(last) if last.strip() else None) if separator else first
+        except ValueError:
+            print(f"ERROR parse_timepoint_ranges: '{part}' is not a timepoint or a range of timepoints like 1-10 or 50-.")
+            exit()
+        if first < 1 or (last is not None and last < first):
+            print(f"ERROR parse_timepoint_ranges: '{part}' is not a valid range, timepoints start at 1.")
+            exit()
+        timepoint_ranges.append((first, last))
+    return timepoint_ranges
+
+class FrameSelection:
+    """
+    Which wells, channels and timepoints (every stride-th of timepoint_ranges) of a batch to split, None selecting all.
+    The selected timepoints are numbered from 1 again, in the CSV and the filenames alike.
+    """
+    def __init__(self, wells=None, channels=None, timepoint_ranges=None, stride=1):
+        if stride < 1:
+            print(f"ERROR FrameSelection: The timepoint stride has to be at least 1, not {stride}.")
+            exit()
+        self.wells = {well.strip().upper() for well in wells} if wells else None
+        self.channels = {(normalize_channel_name(channel_name), acquisition_type) for channel_name, acquisition_type in channels} if channels else None
+        self.timepoint_ranges = timepoint_ranges or None
+        self.stride = stride
+
+    def get_settings(self):
+        """The selection as plain values, for the journal to compare against the run being resumed."""
+        return {"wells": sorted(self.wells) if self.wells else None, "channels": sorted(self.channels, key=str) if self.channels else None, "timepoint_ranges": [list(timepoint_range) for timepoint_range in self.timepoint_ranges] if self.timepoint_ranges else None, "stride": self.stride}
+
+    def keeps_well(self, well_ID):
+        return self.wells is None or str(well_ID).upper() in self.wells
+
+    def keeps_channel(self, channel_name, acquisition_type):
+        channel_name = normalize_channel_name(channel_name)
+        return self.channels is None or (channel_name, acquisition_type) in self.channels or (channel_name, None) in self.channels
+
+    def select_timepoints(self, num_timepoints):
+        """Return a boolean array of which of the num_timepoints timepoints (0-based) are selected."""
+        selected = np.ones(num_timepoints, dtype=bool)
+        if self.timepoint_ranges is not None:
+            selected[:] = False
+            for first, last in self.timepoint_ranges:
+                selected[first - 1:num_timepoints if last is None else last] = True
+        if self.stride > 1:
+            kept = np.flatnonzero(selected)[::self.stride]
+            selected[:] = False
+            selected[kept] = True
+        return selected
+
+    def select_frames(self, frame_index_table, channel_names_inorder):
+        """
+        Return the page indices of the selected rows of a get_frame_index_table table and the 1-based CSV timepoint
+        of every timepoint of the stack (0 for the ones that aren't selected), as NumPy arrays.
+        """
+        num_timepoints = int(frame_index_table[:, 0].max()) + 1 if len(frame_index_table) > 0 else 0
+        selected_timepoints = self.select_timepoints(num_timepoints)
+        timepoint_numbers = np.where(selected_timepoints, np.cumsum(selected_timepoints), 0)
+
+        selected = selected_timepoints[frame_index_table[:, 0]]
+        if self.channels is not None:
+            selected_channels = np.array([self.keeps_channel(channel[0], channel[1]) for channel in channel_names_inorder], dtype=bool)
+            selected &= selected_channels[frame_index_table[:, 1]]
+        return np.flatnonzero(selected), timepoint_numbers
+
+def get_frame_selection(wells=None, channels=None, timepoints=None, stride=1, channel_presets=None):
+    """
+    Build the FrameSelection of the --wells, --select-channels, --timepoints and --timepoint-stride options,
+    or return None if they select everything.
+    """
+    if isinstance(wells, str):
+        wells = [well for well in wells.split(",") if well.strip()]
+    if isinstance(channels, str):
+        channels = [channel.strip() for channel in channels.split(",") if channel.strip()]
+    if not wells and not channels and not timepoints and stride == 1:
+        return None
+
+    for well in wells or []:
+        try:
+            well_id_to_row_col(well.strip().upper())
+        except Exception:
+            print(f"ERROR get_frame_selection: '{well}' is not a well ID like A1.")
+            exit()
+
+    selected_channels = None
+    if channels:
+        preset_channel_names = {normalize_channel_name(preset["ChannelName"]) for preset in channel_presets.values()}
+        selected_channels = []
+        for channel in channels:
+            if channel in channel_presets:
+                selected_channels.append((channel_presets[channel]["ChannelName"], channel_presets[channel]["AcquisitionType"]))
+            elif normalize_channel_name(channel) in preset_channel_names:
+                selected_channels.append((channel, None))
+            else:
+                print(f"ERROR get_frame_selection: '{channel}' is not one of the channel presets: {', '.join(channel_presets.keys())}")
+                exit()
+
+    timepoint_ranges = parse_timepoint_ranges(timepoints) if timepoints else None
+    return FrameSelection(wells, selected_channels, timepoint_ranges, stride)
+
+OUTPUT_LAYOUTS = ["flat", "well", "plate-well", "well-channel", "hash"]
+
+class OutputLayout:
+    """Which folder under the output folder each split frame goes into, one of OUTPUT_LAYOUTS."""
+    def __init__(self, name="flat", hash_buckets=256):
+        if name not in OUTPUT_LAYOUTS:
+            print(f"ERROR OutputLayout: Unknown output layout '{name}', use one of {', '.join(OUTPUT_LAYOUTS)}.")
+            exit()
+        if hash_buckets < 1:
+            print(f"ERROR OutputLayout: The number of hash buckets has to be at least 1, not {hash_buckets}.")
+            exit()
+        self.name = name
+        self.hash_buckets = hash_buckets
+        self.hash_digits = len(f"{hash_buckets - 1:x}")
+
+    def get_settings(self):
+        """The layout as plain values, for the journal to compare against the run being resumed."""
+        return {"name": self.name, "hash_buckets": self.hash_buckets if self.name == "hash" else None}
+
+    def get_subdirectory(self, output_filename, plateName, well_ID, channelName):
+        """Return the folder of a frame relative to the output folder, with "/" separators ("" for the output folder itself)."""
+        if self.name == "well":
+            return get_safe_folder_name(well_ID)
+        if self.name == "plate-well":
+            return f"{get_safe_folder_name(plateName)}/{get_safe_folder_name(well_ID)}"
+        if self.name == "well-channel":
+            return f"{get_safe_folder_name(well_ID)}/{get_safe_folder_name(channelName)}"
+        if self.name == "hash":
+            return f"{zlib.crc32(output_filename.encode()) % self.hash_buckets:0{self.hash_digits}x}"
+        return ""
+
+    def get_all_subdirectories(self):
+        """Return every folder of the layout if they are known before any stack is read (the hash buckets), None otherwise."""
+        if self.name == "hash":
+            return [f"{bucket:0{self.hash_digits}x}" for bucket in range(self.hash_buckets)]
+        return None
+
+def get_safe_folder_name(name):
+    """Replace the characters that can't be in a folder name on Windows."""
+    return "".join("_" if character in '<>:"/\\|?*' or ord(character) < 32 else character for character in str(name)).strip(" .") or "_"
+
+# Folders this process created already, so each one is only created once per run
+created_output_directories = set()
+created_output_directories_lock = threading.Lock()
+
+def create_output_directories(output_directory, subdirectories):
+    """Create the folders (relative to output_directory) of a batch of frames in one go, before any frame is written."""
+    with created_output_directories_lock:
+        new_directories = sorted({os.path.join(output_directory, subdirectory) for subdirectory in subdirectories if subdirectory} - created_output_directories)
+        for directory in new_directories:
+            os.makedirs(directory, exist_ok=True)
+        created_output_directories.update(new_directories)
+
+def plan_frame_filenames(plateName, well_ID, channel_names_inorder, num_frames, num_timepoints, num_planes=1, num_fields=1, dimension_order=None, frame_selection=None, output_layout=None):
+    """
+    Return the page index, output filename and 1-based (timepoint, channel, plane, field) of every frame of a stack
+    that is split, in page order. The batch and single stack scripts both name their frames with it.
+    """
+    frame_index_table = get_frame_index_table(num_frames, len(channel_names_inorder), num_timepoints, num_planes, num_fields, dimension_order)
+    has_planes = frame_index_table[:, 2].max() > 0 if num_frames > 0 else False
+
+    page_indices = np.arange(num_frames)
+    timepoint_numbers = None
+    if frame_selection is not None:
+        page_indices, timepoint_numbers = frame_selection.select_frames(frame_index_table, channel_names_inorder)
+
+    frame_names = []
+    read_step = "RS"
+    for page_index, (time_point_index, channel_name_index, plane_index, field_index) in zip(page_indices.tolist(), frame_index_table[page_indices].tolist()):
+        channel_prefix = channel_names_inorder[channel_name_index][0]
+        timepoint = time_point_index + 1 if timepoint_numbers is None else int(timepoint_numbers[time_point_index])
+        
+        plane_suffix = f"_Z{plane_index + 1:03d}" if has_planes else ""
+        output_filename = f"{well_ID}_{read_step}_{channel_name_index + 1}_{field_index + 1}_{channel_prefix}_{timepoint:03d}{plane_suffix}.tif" 
+        if output_layout is not None:
+            output_subdirectory = output_layout.get_subdirectory(output_filename, plateName, well_ID, channel_prefix)
+            if output_subdirectory:
+                output_filename = f"{output_subdirectory}/{output_filename}"
+
+        frame_names.append((page_index, output_filename, timepoint, channel_name_index + 1, plane_index + 1, field_index + 1))
 
+    return frame_names
+
+def plan_stack_frames(image_metadata, channel_names_inorder, num_frames, frame_selection=None, output_layout=None):
+    """Return the page index, output filename and CSV row of every (selected) frame of a stack, in page order."""
 
-    field = image_metadata["field"]
-    plane = image_metadata["plane"]
     orientationMatrix = image_metadata["orientationMatrix"]
 
     # timepoint = None
@@ -355,59 +1320,123 @@ def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names
     acquisitionType = image_metadata["acquisitionType"]
     well_ID = image_metadata["wellID"]
 
-    if create_well_folder:
-        output_directory = os.path.join(output_directory, well_ID)
-        if not os.path.isdir(output_directory):
-            os.mkdir(output_directory)
+    num_planes = int(image_metadata.get("num_planes") or 1)
+    frame_names = plan_frame_filenames(plateName, well_ID, channel_names_inorder, num_frames, num_timepoints, num_planes, int(numFields), image_metadata.get("dimensionOrder"), frame_selection, output_layout)
+    if frame_selection is not None:
+        num_timepoints = max((frame_name[2] for frame_name in frame_names), default=0)
+
+    frame_plan = []
+    for page_index, output_filename, timepoint, channel, plane, field in frame_names:
+        channel_name_index = channel - 1
+
+        # Create the metadata tuples and output
+        sourceFilename = output_filename 
+        acquisitionType = channel_names_inorder[channel_name_index][1]
+        channelColor = channel_names_inorder[channel_name_index][2]
+        channelName = channel_names_inorder[channel_name_index][0]
+
+        metadata_tuple = (plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor, channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename)
+        frame_plan.append((page_index, output_filename, metadata_tuple))
+
+    return frame_plan
+
+def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder, write_threads=0, write_budget_bytes=256 * 1024 * 1024, fsync=True, stage_timer=None, progress=None, frame_checksums=None, channel_presets=None, frame_selection=None, archive_writer=None, output_layout=None, codec_kwargs=None, continue_on_error=False):
+    """
+    Split a stack into one TIFF per frame and return the CSV rows of the frames.
+    With continue_on_error a stack that fails its checks or writes raises a StackError instead of exiting.
+    """
+
+    well_ID = image_metadata["wellID"]
+    if frame_selection is not None and not frame_selection.keeps_well(well_ID):
+        return []
+    if channel_presets is not None:
+        with catch_stack_errors(tiff_filepath, "split_stack_channels_timepoints", continue_on_error):
+            channel_names_inorder = resolve_stack_channel_names(tiff_filepath, image_metadata, channel_presets)
+
+    if create_well_folder and (output_layout is None or output_layout.name == "flat"):
+        output_layout = OutputLayout("well")
 
     output_metadata = []
-    time_point_index = 0
-    channel_name_index = 0
+    pending_writes = []
     
-    with Image.open(tiff_filepath) as img:
-        
+    checksum = frame_checksums is not None
+    frame_writer = FrameWriter(write_threads, write_budget_bytes, fsync, stage_timer, checksum, archive_writer) if write_threads > 0 else None
+    stack_map = None
+    try:
+        with tifffile.TiffFile(tiff_filepath) as tif:
+            stack_map = map_tiff_file(tif)
 
-        channel_name_index_max = len(channel_names_inorder)
+            channel_name_index_max = len(channel_names_inorder)
 
-        num_frames = img.n_frames
-        time_point_index_max = int(num_frames / channel_name_index_max)
+            num_frames = len(tif.pages)
 
-        if num_frames % channel_name_index_max != 0:
-            print(f"ERROR split_stack_channels_timepoints: The number of frames ({num_frames}) divided by number of channels ({channel_name_index_max}) was not zero-divisible for {tiff_filepath}.\n\tCannot split stack evenly without matching number of frames and number of channels")
-            exit()
+            with catch_stack_errors(tiff_filepath, "split_stack_channels_timepoints", continue_on_error):
+                if num_frames % channel_name_index_max != 0:
+                    print(f"ERROR split_stack_channels_timepoints: The number of frames ({num_frames}) divided by number of channels ({channel_name_index_max}) was not zero-divisible for {tiff_filepath}.\n\tCannot split stack evenly without matching number of frames and number of channels")
+                    exit()
+
+                frame_plan = plan_stack_frames(image_metadata, channel_names_inorder, num_frames, frame_selection, output_layout)
+            if archive_writer is not None:
+                # The output filenames are the paths of the entries in the archive
+                output_directory = ""
+            else:
+                create_output_directories(output_directory, {os.path.dirname(output_filename) for page_index, output_filename, metadata_tuple in frame_plan})
 
-        for i in range(num_frames):
+            # tif.pages only follows the IFD offsets up to each selected page, the skipped pages are never decoded
+            for page_index, output_filename, metadata_tuple in frame_plan:
 
-            # Save the frame with correct channel and time point
-            channel_prefix = channel_names_inorder[channel_name_index][0]
-            
-            field_num = 1
-            read_step = "RS"
-            output_filename = f"{well_ID}_{read_step}_{channel_name_index + 1}_{field_num}_{channel_prefix}_{time_point_index+1:03d}.tif" 
-            output_filepath = os.path.join(output_directory, output_filename)
-            
-            img.seek(i)
-            img.save(output_filepath)
-            print(f"\tSaved frame {i+1} as {output_filename}")
-
-            # Create the metadata tuples and output
-            sourceFilename = output_filename 
-            acquisitionType = channel_names_inorder[channel_name_index][1]
-            timepoint = time_point_index + 1
-            channel = channel_name_index + 1
-            channelColor = channel_names_inorder[channel_name_index][2]
-            channelName = channel_names_inorder[channel_name_index][0]
-
-            metadata_tuple = (plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor, channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename)
-
-            output_metadata.append(metadata_tuple)
-
-            # Increment indices and reset if necessary
-            channel_name_index = (channel_name_index + 1) % channel_name_index_max
-            if channel_name_index == 0:  # This means channel_name_index has reset
-                time_point_index = (time_point_index + 1) % time_point_index_max
-        
+                # Save the frame with correct channel and time point
+                output_filepath = os.path.join(output_directory, output_filename)
             
+                if frame_writer is not None:
+                    page = tif.pages[page_index]
+                    page_data, write_kwargs = read_page_data_timed(tif, page, stack_map, stage_timer, codec_kwargs)
+                    write_future = frame_writer.submit(output_filepath, page_data, write_kwargs, tif.byteorder, page.nbytes)
+                    del page_data
+                    pending_writes.append((page.nbytes, output_filename, write_future, metadata_tuple))
+                else:
+                    page = tif.pages[page_index]
+                    bytes_written, frame_checksum = write_page_to_tiff(tif, page, output_filepath, stack_map, stage_timer, checksum, archive_writer, codec_kwargs)
+                    if checksum:
+                        frame_checksums[output_filename] = (bytes_written, frame_checksum)
+                    if progress is not None:
+                        progress.frame_done(output_filename, page.nbytes)
+                    output_metadata.append(metadata_tuple)
+
+            if frame_writer is not None:
+                # Only hand back the rows of frames that made it to disk
+                write_errors = []
+                for nbytes, output_filename, write_future, metadata_tuple in pending_writes:
+                    try:
+                        bytes_written, frame_checksum = write_future.result()
+                    except Exception as e:
+                        write_errors.append(f"{output_filename}: {e}")
+                        continue
+                    if checksum:
+                        frame_checksums[output_filename] = (bytes_written, frame_checksum)
+                    if progress is not None:
+                        progress.frame_done(output_filename, nbytes)
+                    output_metadata.append(metadata_tuple)
+                frame_writer.close()
+                pending_writes = []
+
+                if len(write_errors) > 0:
+                    with catch_stack_errors(tiff_filepath, "split_stack_channels_timepoints", continue_on_error):
+                        print(f"ERROR split_stack_channels_timepoints: {len(write_errors)} frames of {tiff_filepath} could not be written:")
+                        for write_error in write_errors:
+                            print(f"\t{write_error}")
+                        exit()
+    finally:
+        # Also on errors and skipped stacks, so no write threads or mapped stacks are left behind
+        if frame_writer is not None:
+            frame_writer.close()
+        if stack_map is not None:
+            try:
+                stack_map.close()
+            except BufferError:
+                # A frame that failed to write can still hold a view of the map, it is closed once that is freed
+                pass
+
     return output_metadata
 
 
@@ -417,36 +1446,53 @@ def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names
 
 
 
+def extract_metadata_as_dict_timed(tiff_path, stage_timer=None):
+    """extract_metadata_as_dict, recorded as the extract_metadata_as_dict stage of stage_timer."""
+    if stage_timer is None:
+        return extract_metadata_as_dict(tiff_path)
+
+    with stage_timer.time("extract_metadata_as_dict"):
+        return extract_metadata_as_dict(tiff_path)
+
 def extract_metadata_as_dict(tiff_path):
 
     with tifffile.TiffFile(tiff_path) as tif:
-        # Check for OME metadata and parse if available
-        if tif.ome_metadata:
-            ome_dict = xmltodict.parse(tif.ome_metadata)
-            return get_clean_metadata_dict(clean_dict_keys(ome_dict))
-
-        # If OME metadata is not available, extract and parse metadata from page 0
-        if tif.pages:
-            page_0 = tif.pages[0]
-            page_0_metadata_xml = page_0.description  # Assuming XML metadata is in the description field
-            if page_0_metadata_xml:
-                try:
-                    page_0_dict = xmltodict.parse(page_0_metadata_xml)
-                    return get_clean_metadata_dict(clean_dict_keys(page_0_dict))
-                except Exception as e:
-                    if "IJMetadata" in page_0.tags:
-                        ij_metadata = page_0.tags["IJMetadata"].value["Info"]
-                        start_index = ij_metadata.find("<OME")
-                        if start_index != -1:
-                            ij_metadata = ij_metadata[start_index:]
-                        ome_dict = xmltodict.parse(ij_metadata)
-                        return get_clean_metadata_dict(clean_dict_keys(ome_dict))
-                    
-                    else:
-                        return None
+        return extract_metadata_from_tiff(tif)
+
+def extract_metadata_from_tiff(tif):
+    """extract_metadata_as_dict for a TiffFile that is already open. Only the first IFD is read."""
+
+    # Check for OME metadata and parse if available
+    if tif.ome_metadata:
+        return get_metadata_from_xml(tif.ome_metadata)
+
+    # If OME metadata is not available, extract and parse metadata from page 0
+    if tif.pages:
+        page_0 = tif.pages[0]
+        page_0_metadata_xml = page_0.description  # Assuming XML metadata is in the description field
+        if page_0_metadata_xml:
+            try:
+                return get_metadata_from_xml(page_0_metadata_xml)
+            except Exception as e:
+                if "IJMetadata" in page_0.tags:
+                    ij_metadata = page_0.tags["IJMetadata"].value["Info"]
+                    start_index = ij_metadata.find("<OME")
+                    if start_index != -1:
+                        ij_metadata = ij_metadata[start_index:]
+                    return get_metadata_from_xml(ij_metadata)
+                
+                else:
+                    return None
 
-        return None
+    return None
     
+def get_metadata_from_xml(metadata_xml):
+    """get_clean_metadata_dict of an XML header, with the channels, DimensionOrder and SizeZ read in the same pass."""
+    pixels_info = {}
+    image_metadata = get_clean_metadata_dict(parse_metadata_index(metadata_xml, pixels_info))
+    image_metadata.update(pixels_info)
+    return image_metadata
+
 def get_value_from_metadata_dict(final_key, data):
     """Recursively search for the final key in a nested dictionary and return its value."""
     if isinstance(data, dict):
@@ -464,33 +1510,30 @@ def get_value_from_metadata_dict(final_key, data):
                         return result
     return None
 
-def get_clean_metadata_dict(original_metadata_dict):    
+def get_clean_metadata_dict(metadata_index):    
 
     # Calculated/Derived
     
-    verticalTotal = get_value_from_metadata_dict("VerticalTotal", original_metadata_dict)
+    verticalTotal = metadata_index.get("VerticalTotal")
     if verticalTotal is None:
-        verticalTotal = get_value_from_metadata_dict("verticalTotal", original_metadata_dict)
+        verticalTotal = metadata_index.get("verticalTotal")
 
-    horizTotal = get_value_from_metadata_dict("HorizontalTotal", original_metadata_dict)
+    horizTotal = metadata_index.get("HorizontalTotal")
     if horizTotal is None:
-        horizTotal = get_value_from_metadata_dict("horizontalTotal", original_metadata_dict)
-
-    print(verticalTotal)
-    print(horizTotal)
+        horizTotal = metadata_index.get("horizontalTotal")
 
     numFields = int(verticalTotal) * int(horizTotal)
 
-    exposureTimeMS = get_value_from_metadata_dict("ShutterSpeedMS", original_metadata_dict)
+    exposureTimeMS = metadata_index.get("ShutterSpeedMS")
     exposureTimeS = int(exposureTimeMS) / 1000
 
-    measurementDate = get_value_from_metadata_dict("Date", original_metadata_dict)
+    measurementDate = metadata_index.get("Date")
     measurementDate, absoluteTime = convert_date_format(measurementDate)
 
-    wellID = get_value_from_metadata_dict("Well", original_metadata_dict)
+    wellID = metadata_index.get("Well")
     row, column = well_id_to_row_col(wellID)
 
-    objectiveMagnification = get_value_from_metadata_dict("ObjectiveSize", original_metadata_dict)
+    objectiveMagnification = metadata_index.get("ObjectiveSize")
 
     objectiveSizeInt = int(objectiveMagnification)
 
@@ -504,18 +1547,21 @@ def get_clean_metadata_dict(original_metadata_dict):
         resolution = "0.1612"
     elif objectiveSizeInt == 60:
         resolution = "0.1082"
+    else:
+        print(f"ERROR get_clean_metadata_dict: Unknown objective size {objectiveMagnification}x, only 4x, 10x, 20x, 40x and 60x objectives have a known image resolution.")
+        exit()
 
 
-    image_width = get_value_from_metadata_dict("SizeX", original_metadata_dict)
+    image_width = metadata_index.get("SizeX")
     if image_width == None or image_width == "":
-        image_width = get_value_from_metadata_dict("PixelWidth", original_metadata_dict)
+        image_width = metadata_index.get("PixelWidth")
 
-    image_height = get_value_from_metadata_dict("SizeY", original_metadata_dict)
+    image_height = metadata_index.get("SizeY")
     if image_height == None or image_height == "":
-        image_height = get_value_from_metadata_dict("PixelHeight", original_metadata_dict)
+        image_height = metadata_index.get("PixelHeight")
 
     clean_metadata_dict = {
-        "plateName" : get_value_from_metadata_dict("Plate", original_metadata_dict),
+        "plateName" : metadata_index.get("Plate"),
         "measurementDate" : measurementDate,
         "absoluteTime" : absoluteTime,
         "wellID" : wellID,
@@ -525,16 +1571,16 @@ def get_clean_metadata_dict(original_metadata_dict):
         "horizTotal" : horizTotal,
         "numFields": numFields,
         "exposureTimeS" : exposureTimeS,
-        "channelName" : get_value_from_metadata_dict("Color", original_metadata_dict),
-        "emissionWavelength" : get_value_from_metadata_dict("EmissionWavelength", original_metadata_dict),
-        "excitationWavelength" : get_value_from_metadata_dict("ExcitationWavelength", original_metadata_dict),
-        "num_channels" : get_value_from_metadata_dict("SizeC", original_metadata_dict),
-        "num_timepoints" : get_value_from_metadata_dict("SizeT", original_metadata_dict),
+        "channelName" : metadata_index.get("Color"),
+        "emissionWavelength" : metadata_index.get("EmissionWavelength"),
+        "excitationWavelength" : metadata_index.get("ExcitationWavelength"),
+        "num_channels" : metadata_index.get("SizeC"),
+        "num_timepoints" : metadata_index.get("SizeT"),
         "imageWidth" : image_width,
         "imageHeight" : image_height,
         "resolutionX" : resolution,
         "resolutionY" : resolution,
-        "objectiveNA" : get_value_from_metadata_dict("NumericalAperture", original_metadata_dict),
+        "objectiveNA" : metadata_index.get("NumericalAperture"),
         "objectiveMagnification" : objectiveSizeInt,
         "field" : "1",
         "plane" : "1",
@@ -563,81 +1609,1248 @@ def get_clean_metadata_dict(original_metadata_dict):
 
 
 
-print("\n\n\nCAUTION: All the tifs in your input directory must have the same number of separate \nimage channels or else the split naming convention will not be accurate to the actual channel.\n")
-# Get the inputs and outputs
-tiff_filepath_list, output_directory = get_input_output()
-print(f"\n\nSelected input contains {len(tiff_filepath_list)} tifs to be processed.\nSelected output: {output_directory}")
+# Bump this whenever get_clean_metadata_dict changes what it returns so old cache entries are thrown away
+METADATA_EXTRACTOR_VERSION = 3
+# Name of this script's entries in a metadata cache shared with the other SImA scripts
+METADATA_EXTRACTOR_NAME = "batch"
 
+class SplitJournal:
+    """SQLite journal of a batch run in its output folder, with the stacks and frames that are done, so the run can be resumed."""
+    def __init__(self, journal_filepath, output_directory, resume=False):
+        # Stacks are marked from the pipeline threads as well, the lock keeps them off each other
+        self.connection = sqlite3.connect(journal_filepath, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.output_directory = output_directory
+        # {filename: size} of each folder of the output folder, listed the first time a frame in that folder is checked
+        self.output_file_sizes = {}
 
-# Select a tiff to make sure everything checks out
-test_tiff_filepath = tiff_filepath_list[0]
-if not os.path.isfile(test_tiff_filepath):
-    print(f"\n\nERROR {test_tiff_filepath} is not a valid tiff file. Check to make sure it exists.")
-    exit()
-if not test_tiff_filepath.endswith(".tif"):
-    print(f"\n\nERROR {test_tiff_filepath} is not a tiff file. Enter a .tif filepath and retry.\n")
-    exit()
+        if not resume:
+            self.connection.execute("DROP TABLE IF EXISTS settings")
+            self.connection.execute("DROP TABLE IF EXISTS stacks")
+            self.connection.execute("DROP TABLE IF EXISTS frames")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stacks (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, status TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS frames (path TEXT, frame_index INTEGER, filename TEXT, size INTEGER, crc32 INTEGER, row TEXT, PRIMARY KEY (path, frame_index))")
+        self.connection.commit()
 
-image_metadata = extract_metadata_as_dict(test_tiff_filepath)
-if image_metadata is None:
-    print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {test_tiff_filepath}. Exiting script...")
-    exit()
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-# Get the settings for each channel according to the presets and convert it into a list to pass onto split_stack_channels_timepoints
-chosen_channel_ids = get_channel_settings(image_metadata, channel_presets)
+    def check_setting(self, key, value):
+        """Store a setting of the run, or return False if the journal already has a different value for it."""
+        value = json.dumps(value)
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.connection.execute("INSERT INTO settings VALUES (?, ?)", (key, value))
+                self.connection.commit()
+                return True
+        return row[0] == value
 
-num_channels = image_metadata["num_channels"]
-channel_names_inorder = []
-for channel in chosen_channel_ids:
+    def count_stacks(self, status):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM stacks WHERE status = ?", (status,)).fetchone()[0]
 
-    index, channel_key = channel
+    def get_done_rows(self, tiff_filepath):
+        """
+        Return the CSV rows of a stack that is done, hasn't changed since and still has all its frames in the
+        output folder at the size they were written with, or None if the stack has to be split (again).
+        """
+        with self.lock:
+            stack = self.connection.execute("SELECT size, mtime_ns, status FROM stacks WHERE path = ?", (os.path.abspath(tiff_filepath),)).fetchone()
+            if stack is None or stack[2] != "done":
+                return None
+            frames = self.connection.execute("SELECT filename, size, row FROM frames WHERE path = ? ORDER BY frame_index", (os.path.abspath(tiff_filepath),)).fetchall()
+            has_all_frames = all(self.get_output_file_size(filename) == size for filename, size, row in frames)
 
-    # channel[1] is the channel key name, channel[1] is the respective index of the channel
-    preset = channel_presets[channel[1]]
-    name = preset["ChannelName"]
-    acquisitionType = preset["AcquisitionType"]
-    color = preset["Color"]
+        file_stat = os.stat(tiff_filepath)
+        if (stack[0], stack[1]) != (file_stat.st_size, file_stat.st_mtime_ns):
+            return None
+        if not has_all_frames:
+            return None
+        return [tuple(json.loads(row)) for filename, size, row in frames]
+
+    def get_output_file_size(self, filename):
+        """Return the size of a frame by its path relative to the output folder, or None if it isn't there. Call with the lock held."""
+        directory, name = filename.rpartition("/")[::2]
+        if directory not in self.output_file_sizes:
+            try:
+                with os.scandir(os.path.join(self.output_directory, directory)) as entries:
+                    self.output_file_sizes[directory] = {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+            except OSError:
+                self.output_file_sizes[directory] = {}
+        return self.output_file_sizes[directory].get(name)
+
+    def get_done_stacks(self, tiff_filepaths):
+        """Return {filepath: rows} of every stack get_done_rows has rows for."""
+        done_stacks = {}
+        for tiff_filepath in tiff_filepaths:
+            split_metadata = self.get_done_rows(tiff_filepath)
+            if split_metadata is not None:
+                done_stacks[tiff_filepath] = split_metadata
+        return done_stacks
+
+    def mark_started(self, tiff_filepath):
+        file_stat = os.stat(tiff_filepath)
+        with self.lock:
+            self.connection.execute("DELETE FROM frames WHERE path = ?", (os.path.abspath(tiff_filepath),))
+            self.connection.execute("INSERT OR REPLACE INTO stacks VALUES (?, ?, ?, ?)", (os.path.abspath(tiff_filepath), file_stat.st_size, file_stat.st_mtime_ns, "started"))
+            self.connection.commit()
+
+    def mark_done(self, tiff_filepath, split_metadata, frame_checksums):
+        path = os.path.abspath(tiff_filepath)
+        frames = [(path, frame_index, metadata_tuple[-1], *frame_checksums.get(metadata_tuple[-1], (None, None)), json.dumps(metadata_tuple)) for frame_index, metadata_tuple in enumerate(split_metadata)]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?, ?, ?)", frames)
+            self.connection.execute("UPDATE stacks SET status = 'done' WHERE path = ?", (path,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class StackError(Exception):
+    """A stack that failed in one stage, raised instead of exiting the whole run in continue-on-error mode."""
+    def __init__(self, tiff_filepath, stage, message):
+        super().__init__(tiff_filepath, stage, message)
+        self.tiff_filepath = tiff_filepath
+        self.stage = stage
+        self.message = message
+
+@contextlib.contextmanager
+def catch_stack_errors(tiff_filepath, stage, enabled=True, capture_output=True):
+    """
+    Turn an exception or exit() in one stage of a stack into a StackError, with the ERROR line as its message.
+    Only capture output where no other thread prints, redirecting stdout affects the whole process.
+    """
+    if not enabled:
+        yield
+        return
+
+    captured_output = io.StringIO()
+    output_lines = None
+    try:
+        with contextlib.redirect_stdout(captured_output) if capture_output else contextlib.nullcontext():
+            yield
+    except StackError:
+        raise
+    except (Exception, SystemExit) as e:
+        output_lines = captured_output.getvalue().splitlines(keepends=True)
+        error_line_indices = [i for i, line in enumerate(output_lines) if line.strip().startswith("ERROR")]
+        if isinstance(e, SystemExit) and len(error_line_indices) > 0:
+            message = output_lines[error_line_indices[-1]].strip()
+            # The ErrorReport prints the message, so the ERROR lines before the exit() aren't printed here too
+            output_lines = output_lines[:error_line_indices[-1]]
+        elif isinstance(e, SystemExit):
+            message = "exit() was called"
+        else:
+            message = f"{type(e).__name__}: {e}"
+        raise StackError(tiff_filepath, stage, message) from None
+    finally:
+        sys.stdout.write(captured_output.getvalue() if output_lines is None else "".join(output_lines))
+
+class ErrorReport:
+    """The stacks that failed in continue-on-error mode, saved as a CSV and moved or linked to quarantine_directory."""
+    headers = ["SourceStack", "Stage", "Error", "QuarantinedAs"]
+
+    def __init__(self, report_filepath, quarantine_directory=None, quarantine_mode="move"):
+        self.report_filepath = report_filepath
+        self.quarantine_directory = quarantine_directory
+        self.quarantine_mode = quarantine_mode
+        self.errors = []
+        self.lock = threading.Lock()
+        if quarantine_directory is not None:
+            os.makedirs(quarantine_directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self.errors)
+
+    def add(self, tiff_filepath, stage, message):
+        quarantined_filepath = self.quarantine(tiff_filepath) if self.quarantine_directory is not None else ""
+        # Stacks fail in several pipeline threads at once, printing under the lock keeps their lines apart
+        with self.lock:
+            self.errors.append((tiff_filepath, stage, message, quarantined_filepath))
+            print(f"ERROR {stage}: {tiff_filepath} failed and is skipped ({message})", flush=True)
+
+    def quarantine(self, tiff_filepath):
+        with self.lock:
+            quarantined_filepath = os.path.join(self.quarantine_directory, os.path.basename(tiff_filepath))
+            name, extension = os.path.splitext(quarantined_filepath)
+            copy_number = 1
+            while os.path.lexists(quarantined_filepath):
+                quarantined_filepath = f"{name}_{copy_number}{extension}"
+                copy_number += 1
+
+            try:
+                if self.quarantine_mode == "move":
+                    shutil.move(tiff_filepath, quarantined_filepath)
+                else:
+                    try:
+                        os.symlink(os.path.abspath(tiff_filepath), quarantined_filepath)
+                    except OSError:
+                        # Windows only allows symlinks with developer mode or admin rights
+                        os.link(tiff_filepath, quarantined_filepath)
+            except OSError as e:
+                print(f"WARNING: Could not quarantine {tiff_filepath} ({e})")
+                return ""
+        return quarantined_filepath
+
+    def write(self):
+        with open(self.report_filepath, "w", newline="") as report_file:
+            csv_writer = csv.writer(report_file)
+            csv_writer.writerow(self.headers)
+            csv_writer.writerows(self.errors)
+
+def prescan_stack(tiff_filepath, image_metadata=None, channel_presets=None):
+    """Read the first IFD and the header of a stack, without the pixels, and return what prescan_stacks checks."""
+    stack_info = {"tiff_filepath": tiff_filepath, "image_metadata": image_metadata, "errors": []}
+    try:
+        with tifffile.TiffFile(tiff_filepath) as tif:
+            if image_metadata is None:
+                image_metadata = extract_metadata_from_tiff(tif)
+                stack_info["image_metadata"] = image_metadata
+            if image_metadata is None:
+                stack_info["errors"].append("no OME metadata")
+                return stack_info
+            if channel_presets is not None:
+                stack_info["errors"] += resolve_stack_channels(image_metadata, channel_presets)[1]
+
+            page_0 = tif.pages.first
+            # Counting the pages only follows the IFD chain, it doesn't read them
+            num_frames = len(tif.pages)
+            # ImageJ stacks over 4 GB only have the first IFD, with their frame count in its ImageJ metadata
+            if tif.is_imagej and "images" in tif.imagej_metadata:
+                num_frames = max(num_frames, int(tif.imagej_metadata["images"]))
+            stack_info["num_frames"] = num_frames
+
+            # The split accepts the fields and the planes in the stack or in stacks of their own, as get_frame_index_table does
+            num_header_frames = int(image_metadata["num_channels"]) * int(image_metadata["num_timepoints"])
+            num_planes = int(image_metadata.get("num_planes") or 1)
+            num_fields = int(image_metadata["numFields"])
+            header_frame_counts = [num_header_frames * num_planes * num_fields, num_header_frames * num_planes, num_header_frames]
+            if num_frames not in header_frame_counts:
+                stack_info["errors"].append(f"stack has {num_frames} frames but the header says SizeC x SizeT x SizeZ x fields = {image_metadata['num_channels']} x {image_metadata['num_timepoints']} x {num_planes} x {num_fields} = {header_frame_counts[0]}")
+
+            if (page_0.imagewidth, page_0.imagelength) != (int(image_metadata["imageWidth"]), int(image_metadata["imageHeight"])):
+                stack_info["errors"].append(f"first frame is {page_0.imagewidth}x{page_0.imagelength} but the header says {image_metadata['imageWidth']}x{image_metadata['imageHeight']}")
+
+            # Uncompressed frames all take up as many bytes as the first one, a smaller file is missing frames
+            if page_0.compression == 1:
+                expected_bytes = num_frames * sum(page_0.databytecounts)
+                file_size = os.fstat(tif.filehandle.fileno()).st_size
+                if file_size < expected_bytes:
+                    stack_info["errors"].append(f"file is {file_size} bytes but {num_frames} frames need at least {expected_bytes}, the stack looks truncated")
+    except Exception as e:
+        stack_info["errors"].append(f"could not read the header ({e})")
+
+    return stack_info
+
+def prescan_stacks(tiff_filepath_list, workers=8, cached_metadata=None, metadata_cache=None, error_report=None, channel_presets=None):
+    """
+    Check the headers of every stack match before anything is split and return {filepath: metadata}.
+    Exits with the problems, or with an error_report adds the stacks with problems to it and leaves them out.
+    """
+    if cached_metadata is None:
+        cached_metadata = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stack_infos = list(executor.map(lambda tiff_filepath: prescan_stack(tiff_filepath, cached_metadata.get(tiff_filepath), channel_presets), tiff_filepath_list))
+
+    # Count the stacks with each combination of the settings that have to match
+    summary = {}
+    stack_settings = {}
+    stack_metadata = {stack_info["tiff_filepath"]: stack_info["image_metadata"] for stack_info in stack_infos}
+    for stack_info in stack_infos:
+        image_metadata = stack_info["image_metadata"]
+        if len(stack_info["errors"]) > 0 and image_metadata is None:
+            continue
+        settings = (str(image_metadata["plateName"]), str(image_metadata["num_channels"]), str(image_metadata["num_timepoints"]), f"{image_metadata['imageWidth']}x{image_metadata['imageHeight']}", str(image_metadata["objectiveMagnification"]))
+        summary.setdefault(settings, []).append(stack_info["tiff_filepath"])
+        stack_settings[stack_info["tiff_filepath"]] = settings
+
+    print(f"\n{'Plate':<20} {'Channels':>8} {'Timepoints':>10} {'Frame size':>12} {'Objective':>9} {'Stacks':>7}  Example")
+    for settings, tiff_filepaths in sorted(summary.items(), key=lambda item: -len(item[1])):
+        plate_name, num_channels, num_timepoints, frame_size, objective = settings
+        print(f"{plate_name:<20} {num_channels:>8} {num_timepoints:>10} {frame_size:>12} {objective:>9} {len(tiff_filepaths):>7}  {os.path.basename(tiff_filepaths[0])}")
+
+    stack_problems = {stack_info["tiff_filepath"]: list(stack_info["errors"]) for stack_info in stack_infos}
+    problems = []
+    # With channels picked per stack the channel count doesn't have to match
+    matched_settings = {}
+    for tiff_filepath, settings in stack_settings.items():
+        matched_settings[tiff_filepath] = settings[:1] + settings[2:] if channel_presets is not None else settings
+    match_summary = {}
+    for tiff_filepath, settings in matched_settings.items():
+        match_summary.setdefault(settings, []).append(tiff_filepath)
+    setting_names = "plate, timepoints, frame size and objective" if channel_presets is not None else "plate, channels, timepoints, frame size and objective"
+    if len(match_summary) > 1:
+        if error_report is None:
+            problems.append(f"the stacks don't all have the same {setting_names} ({len(summary)} combinations above)")
+        else:
+            common_settings = max(match_summary, key=lambda settings: len(match_summary[settings]))
+            for tiff_filepath, settings in matched_settings.items():
+                if settings != common_settings:
+                    stack_problems[tiff_filepath].append(f"{setting_names} {settings} don't match the {len(match_summary[common_settings])} other stacks {common_settings}")
+    if len(summary) > 0:
+        # The split names each frame after the channels of the first stack (or its own ones), every stack has to divide evenly by them
+        num_channels = int(max(summary, key=lambda settings: len(summary[settings]))[1])
+        for stack_info in stack_infos:
+            if channel_presets is not None and stack_info["tiff_filepath"] in stack_settings:
+                num_channels = int(stack_settings[stack_info["tiff_filepath"]][1])
+            if "num_frames" in stack_info and stack_info["num_frames"] % num_channels != 0:
+                stack_problems[stack_info["tiff_filepath"]].append(f"{stack_info['num_frames']} frames can't be split evenly into {num_channels} channels")
+
+    wells = {}
+    for tiff_filepath in sorted(stack_settings):
+        if len(stack_problems[tiff_filepath]) == 0 or error_report is None:
+            wells.setdefault((stack_settings[tiff_filepath][0], stack_metadata[tiff_filepath]["wellID"]), []).append(tiff_filepath)
+    for (plate_name, well_ID), tiff_filepaths in wells.items():
+        if len(tiff_filepaths) > 1:
+            if error_report is None:
+                problems.append(f"well {well_ID} of {plate_name} is in {len(tiff_filepaths)} stacks, their frames would overwrite each other: {', '.join(tiff_filepaths)}")
+            else:
+                for tiff_filepath in tiff_filepaths[1:]:
+                    stack_problems[tiff_filepath].append(f"well {well_ID} of {plate_name} is already split from {tiff_filepaths[0]}, the frames would overwrite each other")
+
+    problems = [f"{tiff_filepath}: {problem}" for tiff_filepath, stack_problem_list in stack_problems.items() for problem in stack_problem_list] + problems
+    if len(problems) > 0 and error_report is None:
+        print(f"\nERROR prescan_stacks: {len(problems)} problems were found before splitting, no frames were written:")
+        for problem in problems:
+            print(f"\t{problem}")
+        exit()
 
-    channel_names_inorder.append((name, acquisitionType, color))
+    good_stack_infos = []
+    for stack_info in stack_infos:
+        if len(stack_problems[stack_info["tiff_filepath"]]) > 0:
+            error_report.add(stack_info["tiff_filepath"], "prescan_stacks", "; ".join(stack_problems[stack_info["tiff_filepath"]]))
+        else:
+            good_stack_infos.append(stack_info)
 
+    if metadata_cache is not None:
+        for stack_info in good_stack_infos:
+            if stack_info["tiff_filepath"] not in cached_metadata:
+                metadata_cache.put(stack_info["tiff_filepath"], stack_info["image_metadata"])
 
+    if len(good_stack_infos) == len(stack_infos):
+        print(f"All {len(stack_infos)} stacks match.")
+    else:
+        print(f"WARNING: {len(stack_infos) - len(good_stack_infos)} of {len(stack_infos)} stacks have problems and are skipped, see the error report.")
+    return {stack_info["tiff_filepath"]: stack_info["image_metadata"] for stack_info in good_stack_infos}
+
+def get_frame_output_size(page):
+    """Return the size of the TIFF a page is split into, by writing an empty frame of the same shape to memory. No pixels are read."""
+    write_kwargs = {
+        "photometric": page.photometric,
+        "resolution": page.get_resolution(),
+        "resolutionunit": page.resolutionunit,
+        "metadata": None,
+        "bitspersample": page.bitspersample,
+    }
+    if page.samplesperpixel > 1:
+        write_kwargs["planarconfig"] = page.planarconfig
+    if page.compression == 1 and not page.is_tiled:
+        write_kwargs["rowsperstrip"] = page.rowsperstrip
+
+    output_file = io.BytesIO()
+    with tifffile.TiffWriter(output_file, byteorder=page.parent.byteorder) as writer:
+        writer.write(np.zeros(page.shape, dtype=page.dtype), **write_kwargs)
+    return output_file.tell()
+
+def plan_stack(tiff_filepath, channel_names_inorder, image_metadata=None, channel_presets=None, frame_selection=None, output_layout=None):
+    """Plan the split of a stack from its header only: returns its CSV rows, its bytes and the bytes of its split frames."""
+    with tifffile.TiffFile(tiff_filepath) as tif:
+        if image_metadata is None:
+            image_metadata = extract_metadata_from_tiff(tif)
+        if image_metadata is None:
+            print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {tiff_filepath}. Exiting script...")
+            exit()
+        if frame_selection is not None and not frame_selection.keeps_well(image_metadata["wellID"]):
+            return [], 0, 0
+        if channel_presets is not None:
+            channel_names_inorder = resolve_stack_channel_names(tiff_filepath, image_metadata, channel_presets)
+
+        num_frames = len(tif.pages)
+        if num_frames % len(channel_names_inorder) != 0:
+            print(f"ERROR plan_stack: The number of frames ({num_frames}) divided by number of channels ({len(channel_names_inorder)}) was not zero-divisible for {tiff_filepath}.")
+            exit()
 
-confirmation = input("Confirm that the above settings are correct (\"n\" for no, any other key to continue):")
-if confirmation.lower == "n":
-    print("Exiting script. Please restart the script manually.")
-    exit()
+        frame_plan = plan_stack_frames(image_metadata, channel_names_inorder, num_frames, frame_selection, output_layout)
+        output_bytes = len(frame_plan) * get_frame_output_size(tif.pages.first)
+        input_bytes = os.fstat(tif.filehandle.fileno()).st_size
+
+    return [metadata_tuple for page_index, output_filename, metadata_tuple in frame_plan], input_bytes, output_bytes
+
+def measure_throughput(tiff_filepath, output_directory, sample_bytes=64 * 1024 * 1024):
+    """
+    Measure the read speed of the input and the write speed of the output folder in bytes/s, by reading up to
+    sample_bytes of tiff_filepath and writing (and removing) a file of the same size in output_directory.
+    """
+    chunk_size = 1024 * 1024
+
+    read_start = time.perf_counter()
+    bytes_read = 0
+    with open(tiff_filepath, "rb", buffering=0) as input_file:
+        while bytes_read < sample_bytes:
+            chunk = input_file.read(chunk_size)
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+    read_seconds = time.perf_counter() - read_start
 
+    sample_filepath = os.path.join(output_directory, ".sima_throughput_test.tmp")
+    chunk = os.urandom(chunk_size)
+    write_start = time.perf_counter()
+    bytes_written = 0
+    try:
+        with open(sample_filepath, "wb", buffering=0) as sample_file:
+            while bytes_written < max(bytes_read, chunk_size):
+                bytes_written += sample_file.write(chunk)
+            os.fsync(sample_file.fileno())
+        write_seconds = time.perf_counter() - write_start
+    finally:
+        if os.path.isfile(sample_filepath):
+            os.remove(sample_filepath)
+
+    return bytes_read / max(read_seconds, 1e-9), bytes_written / max(write_seconds, 1e-9)
+
+def plan_batch(tiff_filepath_list, channel_names_inorder, output_directory, cached_metadata=None, workers=8, channel_presets=None, frame_selection=None, output_layout=None):
+    """Dry run of a batch split: write ImageIndex.ColumbusIDX.plan.csv and print the output size, free space and runtime."""
+    if cached_metadata is None:
+        cached_metadata = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        stack_plans = list(executor.map(lambda tiff_filepath: plan_stack(tiff_filepath, channel_names_inorder, cached_metadata.get(tiff_filepath), channel_presets, frame_selection, output_layout), tiff_filepath_list))
+
+    all_metadata = [metadata_tuple for split_metadata, input_bytes, output_bytes in stack_plans for metadata_tuple in split_metadata]
+    all_metadata.sort(key=metadata_row_sort_key)
+    total_input_bytes = sum(input_bytes for split_metadata, input_bytes, output_bytes in stack_plans)
+    total_output_bytes = sum(output_bytes for split_metadata, input_bytes, output_bytes in stack_plans)
+
+    plan_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.plan.csv")
+    if os.path.isfile(plan_csv_fp):
+        os.remove(plan_csv_fp)
+    with SIMACSVWriter(plan_csv_fp) as csv_writer:
+        csv_writer.writerows(all_metadata)
+    total_output_bytes += os.path.getsize(plan_csv_fp)
+
+    read_speed, write_speed = measure_throughput(tiff_filepath_list[0], output_directory)
+    estimated_seconds = total_input_bytes / read_speed + total_output_bytes / write_speed
+    free_bytes = shutil.disk_usage(output_directory).free
+
+    print(f"\nPlan for {len(tiff_filepath_list)} stacks:")
+    print(f"\tFrames to write:   {len(all_metadata)}")
+    print(f"\tInput size:        {total_input_bytes / 1024 ** 3:.2f} GB")
+    print(f"\tOutput size:       {total_output_bytes / 1024 ** 3:.2f} GB (frames and CSV)")
+    print(f"\tFree output space: {free_bytes / 1024 ** 3:.2f} GB")
+    print(f"\tMeasured speed:    {read_speed / 1024 ** 2:.1f} MB/s read, {write_speed / 1024 ** 2:.1f} MB/s write")
+    print(f"\tEstimated runtime: {time.strftime('%H:%M:%S', time.gmtime(estimated_seconds))} (one stack at a time)")
+    print(f"\tPlanned filenames and CSV rows: {plan_csv_fp}")
+    if free_bytes < total_output_bytes:
+        print(f"WARNING: The output folder is {(total_output_bytes - free_bytes) / 1024 ** 3:.2f} GB short of space for this batch.")
+
+    return all_metadata
+
+def process_stack(tiff_filepath, channel_names_inorder, output_directory, create_well_folder=False, image_metadata=None, instrument=False, profile_directory=None, checksums=False, continue_on_error=False, **split_options):
+    """
+    Extract the metadata of a stack (unless cached) and split it, the process pool worker.
+    Returns the metadata, the CSV rows, the StageTimer samples and the frame checksums of the stack.
+    """
+    stage_timer = StageTimer() if instrument else None
+    frame_checksums = {} if checksums else None
+
+    def run():
+        stack_metadata = image_metadata
+        with catch_stack_errors(tiff_filepath, "extract_metadata_as_dict", continue_on_error):
+            if stack_metadata is None:
+                stack_metadata = extract_metadata_as_dict_timed(tiff_filepath, stage_timer)
+            if stack_metadata is None:
+                print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {tiff_filepath}. Exiting script...")
+                exit()
+        # The split catches the errors of its own checks, its output isn't held back here
+        with catch_stack_errors(tiff_filepath, "split_stack_channels_timepoints", continue_on_error, capture_output=False):
+            return stack_metadata, split_stack_channels_timepoints(tiff_filepath, stack_metadata, channel_names_inorder, output_directory, create_well_folder, stage_timer=stage_timer, frame_checksums=frame_checksums, continue_on_error=continue_on_error, **split_options)
+
+    stack_metadata, split_metadata = profile_call(profile_directory, tiff_filepath, run)
+    return stack_metadata, split_metadata, stage_timer.samples if stage_timer is not None else None, frame_checksums
+
+def metadata_row_sort_key(metadata_tuple):
+    """Order CSV rows by plate, row, column, timepoint, channel, field and plane so serial and parallel runs write the same CSV."""
+    # Indices follow the CSV headers: PlateName, Row, Column, Timepoint, Channel, Field, Plane, SourceFilename
+    return (str(metadata_tuple[0]), int(metadata_tuple[2]), int(metadata_tuple[3]), int(metadata_tuple[5]), int(metadata_tuple[7]), int(metadata_tuple[4]), int(metadata_tuple[6]), metadata_tuple[28])
+
+def split_stacks_parallel(tiff_filepath_list, channel_names_inorder, output_directory, workers, create_well_folder=False, cached_metadata=None, metadata_cache=None, split_options=None, stage_timer=None, profile_directory=None, progress=None, journal=None, error_report=None):
+    """Split the stacks in a process pool and return the CSV rows of every stack."""
+    if cached_metadata is None:
+        cached_metadata = {}
+    if split_options is None:
+        split_options = {}
+
+    all_metadata = []
+    if journal is not None:
+        for tiff_filepath in tiff_filepath_list:
+            journal.mark_started(tiff_filepath)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_stack, tiff_filepath, channel_names_inorder, output_directory, create_well_folder, cached_metadata.get(tiff_filepath), stage_timer is not None, profile_directory, journal is not None, error_report is not None, **split_options): tiff_filepath for tiff_filepath in tiff_filepath_list}
+        for future in as_completed(futures):
+            tiff_filepath = futures[future]
+            try:
+                image_metadata, split_metadata, stage_samples, frame_checksums = future.result()
+            except StackError as e:
+                error_report.add(e.tiff_filepath, e.stage, e.message)
+                if progress is not None:
+                    progress.stack_failed(tiff_filepath)
+                continue
+            if journal is not None:
+                journal.mark_done(tiff_filepath, split_metadata, frame_checksums)
+            if stage_timer is not None:
+                stage_timer.merge(stage_samples)
+            if metadata_cache is not None and tiff_filepath not in cached_metadata:
+                metadata_cache.put(tiff_filepath, image_metadata)
+            all_metadata.extend(split_metadata)
+            if progress is not None:
+                progress.stack_done(tiff_filepath, split_metadata, os.path.getsize(tiff_filepath))
+
+    return all_metadata
+
+def run_stack_pipeline(input_directory, channel_names_inorder, output_directory, parse_workers=2, split_workers=1, queue_size=16, create_well_folder=False, metadata_cache=None, split_options=None, stage_timer=None, profile_directory=None, progress=None, journal=None, resume=False, error_report=None, discovery_options=None):
+    """
+    Split every stack under input_directory with discovery, header parsing, splitting and indexing running at once,
+    passing stacks along bounded queues, and return the CSV rows of every stack.
+    """
+    cached_filepaths = set()
+    journaled_filepaths = set()
+    if split_options is None:
+        split_options = {}
+    if discovery_options is None:
+        discovery_options = {}
+
+    stack_queue = queue.Queue(maxsize=queue_size)
+    metadata_queue = queue.Queue(maxsize=queue_size)
+    rows_queue = queue.Queue(maxsize=queue_size)
+    stop_event = threading.Event()
+    errors = []
+
+    # Queue helpers that give up instead of blocking forever once another stage has failed
+    def put(stage_queue, item):
+        while not stop_event.is_set():
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
 
-output_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
+    def get(stage_queue):
+        while not stop_event.is_set():
+            try:
+                return stage_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
 
+    def fail(message):
+        errors.append(message)
+        stop_event.set()
+
+    def discover_stacks():
+        try:
+            # Only the time spent walking counts, not the time spent waiting on a full queue
+            tiff_filepaths = iter_tiff_filepaths(input_directory, exclude_directories=[output_directory], **discovery_options)
+            while True:
+                discovery_start = time.perf_counter()
+                tiff_filepath = next(tiff_filepaths, None)
+                if stage_timer is not None:
+                    stage_timer.record("discovery", time.perf_counter() - discovery_start, count=int(tiff_filepath is not None))
+                if tiff_filepath is None:
+                    if progress is not None:
+                        progress.discovery_done()
+                    return
+                if progress is not None:
+                    progress.stack_found()
+                if not put(stack_queue, tiff_filepath):
+                    return
+        except Exception as e:
+            fail(f"ERROR discover_stacks: {e}")
+        finally:
+            for _ in range(parse_workers):
+                put(stack_queue, None)
+
+    def parse_headers():
+        try:
+            while True:
+                tiff_filepath = get(stack_queue)
+                if tiff_filepath is None:
+                    return
+                if resume:
+                    split_metadata = journal.get_done_rows(tiff_filepath)
+                    if split_metadata is not None:
+                        # Hand the journaled rows straight to the index stage
+                        journaled_filepaths.add(tiff_filepath)
+                        future = Future()
+                        future.set_result((None, split_metadata, None, None))
+                        if not put(rows_queue, (tiff_filepath, future)):
+                            return
+                        continue
+                image_metadata = None
+                if metadata_cache is not None:
+                    image_metadata = metadata_cache.get(tiff_filepath)
+                if image_metadata is not None:
+                    cached_filepaths.add(tiff_filepath)
+                else:
+                    try:
+                        image_metadata = extract_metadata_as_dict_timed(tiff_filepath, stage_timer)
+                    except (Exception, SystemExit) as e:
+                        if error_report is None:
+                            raise
+                        image_metadata = None
+                        # The ERROR line before an exit() is already printed, the output of a thread can't be held back
+                        error_report.add(tiff_filepath, "extract_metadata_as_dict", "exit() was called" if isinstance(e, SystemExit) else f"{type(e).__name__}: {e}")
+                        if progress is not None:
+                            progress.stack_failed(tiff_filepath)
+                        continue
+                if image_metadata is None and error_report is not None:
+                    error_report.add(tiff_filepath, "extract_metadata_as_dict", "No OME Metadata was found")
+                    if progress is not None:
+                        progress.stack_failed(tiff_filepath)
+                    continue
+                if image_metadata is None:
+                    fail(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {tiff_filepath}. Exiting script...")
+                    return
+                if not put(metadata_queue, (tiff_filepath, image_metadata)):
+                    return
+        except SystemExit:
+            # The ERROR line before the exit() is already printed
+            fail("ERROR parse_headers: Stopped after the header of a stack failed")
+        except Exception as e:
+            fail(f"ERROR parse_headers: {e}")
+        finally:
+            put(metadata_queue, None)
+
+    def split_stacks():
+        stacks_in_flight = threading.BoundedSemaphore(queue_size)
+
+        def queue_result(future, tiff_filepath):
+            put(rows_queue, (tiff_filepath, future))
+            stacks_in_flight.release()
+
+        try:
+            with ProcessPoolExecutor(max_workers=split_workers) as executor:
+                parsers_done = 0
+                while parsers_done < parse_workers:
+                    parsed_stack = get(metadata_queue)
+                    if stop_event.is_set():
+                        return
+                    if parsed_stack is None:
+                        parsers_done += 1
+                        continue
+
+                    tiff_filepath, image_metadata = parsed_stack
+                    while not stacks_in_flight.acquire(timeout=0.1):
+                        if stop_event.is_set():
+                            return
+                    if journal is not None:
+                        journal.mark_started(tiff_filepath)
+                    future = executor.submit(process_stack, tiff_filepath, channel_names_inorder, output_directory, create_well_folder, image_metadata, stage_timer is not None, profile_directory, journal is not None, error_report is not None, **split_options)
+                    future.add_done_callback(lambda future, tiff_filepath=tiff_filepath: queue_result(future, tiff_filepath))
+        except Exception as e:
+            fail(f"ERROR split_stacks: {e}")
+        finally:
+            put(rows_queue, None)
+
+    stage_threads = [threading.Thread(target=discover_stacks, daemon=True), threading.Thread(target=split_stacks, daemon=True)]
+    stage_threads += [threading.Thread(target=parse_headers, daemon=True) for _ in range(parse_workers)]
+    for stage_thread in stage_threads:
+        stage_thread.start()
+
+    # Index stage, collect the rows of every split stack
+    all_metadata = []
+    while True:
+        split_stack = get(rows_queue)
+        if split_stack is None:
+            break
 
-for tiff_filepath in tiff_filepath_list:
-    # Reset the data for the new image
-    split_metadata = ""
-    print(f"Parsing {tiff_filepath}...")
+        tiff_filepath, future = split_stack
+        try:
+            image_metadata, split_metadata, stage_samples, frame_checksums = future.result()
+        except StackError as e:
+            error_report.add(e.tiff_filepath, e.stage, e.message)
+            if progress is not None:
+                progress.stack_failed(tiff_filepath)
+            continue
+        except BaseException as e:
+            fail(f"ERROR split_stack_channels_timepoints: Splitting {tiff_filepath} failed ({e!r})")
+            break
 
-    
-    # Extract the metadata
-    print("\tExtracting metadata")
+        if tiff_filepath in journaled_filepaths:
+            all_metadata.extend(split_metadata)
+            continue
+        if journal is not None:
+            journal.mark_done(tiff_filepath, split_metadata, frame_checksums)
+        if metadata_cache is not None and tiff_filepath not in cached_filepaths:
+            metadata_cache.put(tiff_filepath, image_metadata)
+        if stage_timer is not None:
+            stage_timer.merge(stage_samples)
+        all_metadata.extend(split_metadata)
+        if progress is not None:
+            progress.stack_done(tiff_filepath, split_metadata, os.path.getsize(tiff_filepath))
+
+    for stage_thread in stage_threads:
+        stage_thread.join()
+
+    if len(errors) > 0:
+        for error in errors:
+            print(error)
+        exit()
 
-    # original_metadata_dict = extract_metadata_as_dict(tiff_filepath)
-    # image_metadata = get_clean_metadata_dict(original_metadata_dict)
-    image_metadata = extract_metadata_as_dict(tiff_filepath)
+    return all_metadata
+
+class InotifyWatcher:
+    """
+    Report the files created, written or moved into a folder tree with Linux inotify through ctypes.
+    Raises OSError where inotify isn't available, overflowed is set when the tree has to be rescanned.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    event_header = struct.Struct("iIII")
+
+    def __init__(self, directory, exclude_directories=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched_directories = {}
+        self.exclude_directories = {DiscoveryFilter.normalize_directory(exclude_directory) for exclude_directory in exclude_directories or []}
+        self.overflowed = False
+        self.add_tree(directory)
+
+    def add_tree(self, directory):
+        """Watch directory and every folder under it, returns the files already in them."""
+        filepaths = []
+        for root, dirs, files in os.walk(directory):
+            if DiscoveryFilter.normalize_directory(root) in self.exclude_directories:
+                dirs[:] = []
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {root}")
+            self.watched_directories[wd] = root
+            filepaths += [os.path.join(root, file) for file in files]
+        return filepaths
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events and return the paths of the files they were about."""
+        changed_filepaths = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed_filepaths
+
+        data = b""
+        while True:
+            try:
+                data += os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+        offset = 0
+        while offset + self.event_header.size <= len(data):
+            wd, mask, cookie, name_length = self.event_header.unpack_from(data, offset)
+            offset += self.event_header.size
+            name = data[offset:offset + name_length].rstrip(b"\0")
+            offset += name_length
+            if mask & self.IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if wd not in self.watched_directories or not name:
+                continue
+            path = os.path.join(self.watched_directories[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                # A folder created or moved in may already have stacks in it before its watch is added
+                changed_filepaths.update(self.add_tree(path))
+            else:
+                changed_filepaths.add(path)
+        return changed_filepaths
+
+    def close(self):
+        os.close(self.fd)
+
+def watch_stacks(input_directory, exclude_directory=None, settle_seconds=10, poll_interval=5, use_inotify=True, rescan_seconds=60, discovery_options=None):
+    """
+    Yield, every poll_interval seconds, the tifs under input_directory that are new or changed and have settled
+    for settle_seconds (an empty list when none are), using inotify where it can.
+    """
+    if discovery_options is None:
+        discovery_options = {}
+    exclude_directories = [exclude_directory] if exclude_directory is not None else None
+    discovery_filter = DiscoveryFilter(input_directory, discovery_options.get("include"), discovery_options.get("exclude"), discovery_options.get("pattern_type", "glob"), discovery_options.get("max_depth"), exclude_directories)
+
+    def find_tiff_filepaths():
+        return set(iter_tiff_filepaths(input_directory, exclude_directories=exclude_directories, **discovery_options))
+
+    watcher = None
+    if use_inotify and sys.platform.startswith("linux"):
+        try:
+            watcher = InotifyWatcher(input_directory, exclude_directories)
+        except OSError as e:
+            print(f"WARNING watch_stacks: inotify isn't available ({e}), checking the input folder every {poll_interval}s instead")
+
+    candidate_filepaths = find_tiff_filepaths()
+    last_rescan_time = time.monotonic()
+    # Size and mtime_ns of each stack when it was yielded, and of each candidate with the time it last changed
+    yielded_stats = {}
+    candidate_stats = {}
+    try:
+        while True:
+            if watcher is not None and not watcher.overflowed:
+                candidate_filepaths.update(path for path in watcher.wait(poll_interval) if discovery_filter.keeps_filepath(path))
+            else:
+                time.sleep(poll_interval)
+            if watcher is None or watcher.overflowed or time.monotonic() - last_rescan_time >= rescan_seconds:
+                candidate_filepaths.update(find_tiff_filepaths())
+                last_rescan_time = time.monotonic()
+                if watcher is not None:
+                    watcher.overflowed = False
+
+            now = time.monotonic()
+            ready_filepaths = []
+            for tiff_filepath in list(candidate_filepaths):
+                try:
+                    file_stat = os.stat(tiff_filepath)
+                except FileNotFoundError:
+                    candidate_filepaths.discard(tiff_filepath)
+                    candidate_stats.pop(tiff_filepath, None)
+                    continue
+                stack_stat = (file_stat.st_size, file_stat.st_mtime_ns)
+                if yielded_stats.get(tiff_filepath) == stack_stat:
+                    candidate_filepaths.discard(tiff_filepath)
+                    continue
+                if tiff_filepath not in candidate_stats or candidate_stats[tiff_filepath][0] != stack_stat:
+                    candidate_stats[tiff_filepath] = (stack_stat, now)
+                    continue
+                if stack_stat[0] > 0 and now - candidate_stats[tiff_filepath][1] >= settle_seconds:
+                    ready_filepaths.append(tiff_filepath)
+                    yielded_stats[tiff_filepath] = stack_stat
+                    candidate_filepaths.discard(tiff_filepath)
+                    del candidate_stats[tiff_filepath]
+            yield sorted(ready_filepaths)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+def watch_and_split(input_directory, channel_names_inorder, output_directory, output_csv_fp, workers=1, settle_seconds=10, poll_interval=5, idle_exit_seconds=None, use_inotify=True, flush_seconds=30, create_well_folder=False, metadata_cache=None, split_options=None, stage_timer=None, profile_directory=None, progress=None, journal=None, resume=False, error_report=None, discovery_options=None):
+    """
+    Split the stacks watch_stacks finds and append their rows to output_csv_fp until Ctrl + C or idle_exit_seconds.
+    Returns the number of stacks split.
+    """
+    if split_options is None:
+        split_options = {}
+
+    futures = {}
+    rows_to_write = []
+    stacks_split = 0
+    last_flush_time = time.monotonic()
+    last_activity_time = time.monotonic()
+
+    def flush_rows():
+        csv_start = time.perf_counter()
+        # The latest rows of a frame win, both over the CSV and over earlier rows of the same batch
+        rows_by_filename = {metadata_tuple[-1]: metadata_tuple for metadata_tuple in rows_to_write}
+        with SIMACSVWriter(output_csv_fp, drop_source_filenames=set(rows_by_filename)) as csv_writer:
+            csv_writer.writerows(sorted(rows_by_filename.values(), key=metadata_row_sort_key))
+        if stage_timer is not None:
+            stage_timer.record("csv_append", time.perf_counter() - csv_start, bytes_written=os.path.getsize(output_csv_fp), count=len(rows_to_write))
+        rows_to_write.clear()
+
+    def collect(future):
+        nonlocal stacks_split
+        tiff_filepath = futures.pop(future)
+        try:
+            image_metadata, split_metadata, stage_samples, frame_checksums = future.result()
+        except StackError as e:
+            error_report.add(e.tiff_filepath, e.stage, e.message)
+            error_report.write()
+            if progress is not None:
+                progress.stack_failed(tiff_filepath)
+            return
+        except BaseException as e:
+            print(f"ERROR split_stack_channels_timepoints: Splitting {tiff_filepath} failed ({e!r})")
+            exit()
+        if journal is not None:
+            journal.mark_done(tiff_filepath, split_metadata, frame_checksums)
+        if metadata_cache is not None:
+            metadata_cache.put(tiff_filepath, image_metadata)
+        if stage_timer is not None:
+            stage_timer.merge(stage_samples)
+        rows_to_write.extend(split_metadata)
+        stacks_split += 1
+        if progress is not None:
+            progress.stack_done(tiff_filepath, split_metadata, os.path.getsize(tiff_filepath))
+
+    print(f"Watching {input_directory} for new stacks, press Ctrl + C to stop...")
+    # The workers ignore Ctrl + C so the stacks they are splitting when the watch is stopped still finish
+    with ProcessPoolExecutor(max_workers=workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)) as executor:
+        try:
+            for ready_filepaths in watch_stacks(input_directory, output_directory, settle_seconds, poll_interval, use_inotify, discovery_options=discovery_options):
+                for tiff_filepath in ready_filepaths:
+                    last_activity_time = time.monotonic()
+                    if resume:
+                        split_metadata = journal.get_done_rows(tiff_filepath)
+                        if split_metadata is not None:
+                            rows_to_write.extend(split_metadata)
+                            continue
+                    if progress is not None:
+                        progress.stack_found()
+                    if journal is not None:
+                        journal.mark_started(tiff_filepath)
+                    image_metadata = metadata_cache.get(tiff_filepath) if metadata_cache is not None else None
+                    future = executor.submit(process_stack, tiff_filepath, channel_names_inorder, output_directory, create_well_folder, image_metadata, stage_timer is not None, profile_directory, journal is not None, error_report is not None, **split_options)
+                    futures[future] = tiff_filepath
+
+                for future in [future for future in futures if future.done()]:
+                    collect(future)
+                if len(futures) > 0:
+                    last_activity_time = time.monotonic()
+                if len(rows_to_write) > 0 and (len(futures) == 0 or time.monotonic() - last_flush_time >= flush_seconds):
+                    flush_rows()
+                    last_flush_time = time.monotonic()
+                if progress is not None:
+                    progress.update()
+                if idle_exit_seconds is not None and len(futures) == 0 and time.monotonic() - last_activity_time >= idle_exit_seconds:
+                    print(f"No new stacks for {idle_exit_seconds}s, stopping the watch.")
+                    break
+        except KeyboardInterrupt:
+            print("\nStopping the watch, waiting for the stacks being split...")
+        finally:
+            # Stacks already handed to the pool are finished and their rows written before returning
+            try:
+                for future in list(futures):
+                    collect(future)
+            finally:
+                if len(rows_to_write) > 0:
+                    flush_rows()
+
+    return stacks_split
+
+
+
+
+
+# The guard keeps the process pool workers from re-running the prompts when they import this script
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split aligned kinetic stacks and generate a SImA upload CSV. Without --input, --output and --channels the script asks for them.")
+    parser.add_argument("--job", help="JSON or TOML file with the options of this run, options given on the command line override it")
+    parser.add_argument("--input", help="Input folder with the stacks, instead of asking for it")
+    parser.add_argument("--output", help="Output folder for the CSV and split stacks, instead of asking for it")
+    parser.add_argument("--channels", help="Channel presets of the channels in order, as comma separated names or menu numbers, instead of asking for them and for a confirmation")
+    parser.add_argument("--auto-channels", action="store_true", help="Pick the channel presets of each stack from the wavelengths, Color and acquisition mode in its header, so stacks can have different channels")
+    parser.add_argument("--channel-presets", help="JSON or TOML file with channel presets to add to (or replace) the built-in ones")
+    parser.add_argument("--wells", help="Only split the stacks of these comma separated wells, e.g. A1,B2")
+    parser.add_argument("--select-channels", help="Only split the frames of these comma separated channels, as preset names or channel names, e.g. DAPI,GFP")
+    parser.add_argument("--timepoints", help="Only split these comma separated 1-based timepoints and ranges, e.g. 1-10,25,50- (they are numbered from 1 again in the CSV and the filenames)")
+    parser.add_argument("--timepoint-stride", type=int, default=1, help="Only split every n-th of the (selected) timepoints (default: 1)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of stacks to split at the same time in separate processes (default: 1)")
+    parser.add_argument("--metadata-cache", help="SQLite file to cache the metadata of each stack in, so reruns over the same stacks skip parsing their headers")
+    parser.add_argument("--pipeline", action="store_true", help="Start splitting while the input folder is still being searched, with discovery, header parsing, splitting and CSV writing overlapping")
+    parser.add_argument("--parse-workers", type=int, default=2, help="With --pipeline, number of threads parsing headers (default: 2)")
+    parser.add_argument("--queue-size", type=int, default=16, help="With --pipeline, maximum number of stacks waiting between two stages (default: 16)")
+    parser.add_argument("--write-threads", type=int, default=0, help="Number of threads writing split frames in the background of each stack, 0 writes them one at a time (default: 0)")
+    parser.add_argument("--write-budget-mb", type=int, default=256, help="With --write-threads, maximum MB of frames per stack waiting to be written (default: 256)")
+    parser.add_argument("--no-fsync", action="store_true", help="With --write-threads, don't wait for each frame to reach the disk before adding it to the CSV")
+    parser.add_argument("--layout", choices=OUTPUT_LAYOUTS, default="flat", help="Folders to put the split frames in: all in the output folder (flat), a folder per well, per plate and well, per well and channel, or hash buckets that fill up evenly (default: flat)")
+    parser.add_argument("--hash-buckets", type=int, default=256, help="With --layout hash, number of bucket folders (default: 256)")
+    parser.add_argument("--compression", choices=OUTPUT_CODECS, default="none", help="Codec to compress the split frames with, lossless, LZW and zstd need imagecodecs (default: none)")
+    parser.add_argument("--compression-level", type=int, help="With --compression, level of the codec (default: 1 for zlib, the codec's own for the others)")
+    parser.add_argument("--compression-workers", type=int, default=4, help="With --compression, number of threads compressing the strips of each frame (default: 4)")
+    parser.add_argument("--archive", choices=["zip", "tar"], help="Write the split frames and the CSV into ImageIndex.ColumbusIDX.zip (or .tar) in the output folder instead of one file per frame")
+    parser.add_argument("--archive-compression", choices=["stored", "deflate"], default="stored", help="With --archive zip, store the frames as they are or deflate them (default: stored)")
+    parser.add_argument("--archive-volume-mb", type=int, help="With --archive, split the archive into numbered volumes of about this many MB")
+    parser.add_argument("--report", help="Time discovery, metadata extraction, frame decode/write and the CSV append and save the report to this file (.json or .csv)")
+    parser.add_argument("--profile-dir", help="Save a cProfile dump of each stack to this folder")
+    parser.add_argument("--quiet", action="store_true", help="Don't print the progress while splitting, only errors")
+    parser.add_argument("--progress-interval", type=float, default=2.0, help="Seconds between two progress lines (default: 2)")
+    parser.add_argument("--log", help="Log every saved frame to this file")
+    parser.add_argument("--prescan-workers", type=int, default=8, help="Number of threads reading the headers of every stack before splitting (default: 8)")
+    parser.add_argument("--skip-prescan", action="store_true", help="Don't check the headers of every stack before splitting")
+    parser.add_argument("--resume", action="store_true", help="Continue an interrupted run into the same output folder: stacks its journal has as done are skipped and the CSV is rebuilt without duplicate rows")
+    parser.add_argument("--no-journal", action="store_true", help="Don't keep the journal --resume needs in the output folder")
+    parser.add_argument("--continue-on-error", action="store_true", help="Skip stacks that fail instead of stopping the whole run, and list them in an error report")
+    parser.add_argument("--error-report", help="With --continue-on-error, CSV to list the failed stacks in (default: ImageIndex.ColumbusIDX.errors.csv in the output folder)")
+    parser.add_argument("--quarantine", help="With --continue-on-error, folder to put the failed stacks in")
+    parser.add_argument("--quarantine-mode", choices=["move", "link"], default="move", help="Move the failed stacks to the quarantine folder or link them there (default: move)")
+    parser.add_argument("--plan", action="store_true", help="Don't split anything, only write the filenames and CSV rows the split would create and estimate its size and runtime")
+    parser.add_argument("--watch", action="store_true", help="Keep running and split new stacks as soon as they are written to the input folder, appending their rows to the CSV, until Ctrl + C")
+    parser.add_argument("--settle-seconds", type=float, default=10.0, help="With --watch, seconds a stack's size and mtime must stay the same before it is split (default: 10)")
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="With --watch, seconds between two checks of the input folder (default: 5)")
+    parser.add_argument("--flush-seconds", type=float, default=30.0, help="With --watch, longest time split rows wait before being appended to the CSV while stacks keep coming (default: 30)")
+    parser.add_argument("--idle-exit", type=float, help="With --watch, stop after this many seconds without a new stack")
+    parser.add_argument("--no-inotify", action="store_true", help="With --watch, rescan the input folder instead of using inotify, e.g. for network shares")
+    add_discovery_arguments(parser)
+    args = parse_args_with_job_file(parser)
+    discovery_options = get_discovery_options(args)
+    if args.channel_presets:
+        channel_presets = load_channel_presets(args.channel_presets, channel_presets)
+    if args.auto_channels and args.channels is not None:
+        print("ERROR: --auto-channels picks the channels of each stack, don't combine it with --channels.")
+        exit()
+    # The split picks the channels of every stack itself
+    auto_channel_presets = channel_presets if args.auto_channels else None
+    frame_selection = get_frame_selection(args.wells, args.select_channels, args.timepoints, args.timepoint_stride, channel_presets)
+    output_layout = OutputLayout(args.layout, args.hash_buckets)
+    codec_kwargs = get_codec_write_kwargs(args.compression, args.compression_level, args.compression_workers)
+    split_options = {"write_threads": args.write_threads, "write_budget_bytes": args.write_budget_mb * 1024 * 1024, "fsync": not args.no_fsync, "channel_presets": auto_channel_presets, "frame_selection": frame_selection, "output_layout": output_layout, "codec_kwargs": codec_kwargs}
+
+    if args.watch and (args.pipeline or args.plan):
+        print("ERROR: --watch can't be combined with --pipeline or --plan.")
+        exit()
+    # The frames of every stack go through the one archive of the main process
+    if args.archive and (args.watch or args.pipeline or args.workers > 1 or args.resume):
+        print("ERROR: --archive can't be combined with --watch, --pipeline, --workers or --resume, use --write-threads to write in the background.")
+        exit()
+
+    stage_timer = StageTimer() if args.report else None
+    if args.profile_dir:
+        os.makedirs(args.profile_dir, exist_ok=True)
+
+    print("\n\n\nCAUTION: All the tifs in your input directory must have the same number of separate \nimage channels or else the split naming convention will not be accurate to the actual channel.\n")
+    # Get the inputs and outputs
+    tiff_filepath_list, output_directory, input_directory = get_input_output(walk_input=not args.pipeline or args.plan, stage_timer=stage_timer, allow_empty=args.watch, discovery_options=discovery_options, input_directory=args.input, output_directory=args.output)
+    if args.pipeline and not args.plan:
+        print(f"\n\nSelected input: {input_directory}\nSelected output: {output_directory}")
+    else:
+        print(f"\n\nSelected input contains {len(tiff_filepath_list)} tifs to be processed.\nSelected output: {output_directory}")
 
-    if image_metadata is None:
-        print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {tiff_filepath}. Exiting script...")
+    # Stacks found while splitting would include the frames split into the input folder itself
+    if (args.pipeline or args.watch) and not args.plan and os.path.normcase(os.path.abspath(output_directory)) == os.path.normcase(os.path.abspath(input_directory)):
+        print("ERROR: With --pipeline or --watch the output folder has to be a different folder than the input folder.")
         exit()
 
-    # Parse the metadata to write to the CSV
-    print("\tParsing metadata and splitting channels to output...")
-    split_metadata = split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder=False)
+    metadata_cache = None
+    try:
+        cached_metadata = {}
+        if args.metadata_cache:
+            metadata_cache = MetadataCache(args.metadata_cache, METADATA_EXTRACTOR_NAME, METADATA_EXTRACTOR_VERSION)
+            cached_metadata = metadata_cache.get_many(tiff_filepath_list)
+            print(f"Found cached metadata for {len(cached_metadata)} of {len(tiff_filepath_list)} tifs")
+
+        error_report = None
+        if args.continue_on_error:
+            error_report = ErrorReport(args.error_report or os.path.join(output_directory, "ImageIndex.ColumbusIDX.errors.csv"), args.quarantine, args.quarantine_mode)
+
+        journal = None
+        done_stacks = {}
+        if args.resume and args.no_journal:
+            print("ERROR: --resume needs the journal, don't combine it with --no-journal.")
+            exit()
+        # The journal checks the frames of finished stacks in the output folder, an archive can't be resumed
+        if not args.no_journal and not args.plan and not args.archive:
+            journal_filepath = os.path.join(output_directory, "ImageIndex.ColumbusIDX.journal.sqlite")
+            if args.resume and not os.path.isfile(journal_filepath):
+                print(f"ERROR: There is no journal to resume from in {output_directory}.")
+                exit()
+            journal = SplitJournal(journal_filepath, output_directory, resume=args.resume)
+        if args.resume and not args.pipeline and not args.watch:
+            done_stacks = journal.get_done_stacks(tiff_filepath_list)
+            print(f"Resuming: {len(done_stacks)} of {len(tiff_filepath_list)} stacks are already done, {journal.count_stacks('started')} were interrupted and are split again")
+
+        # The stacks done before are only checked against each other in the run that split them
+        pending_filepath_list = [tiff_filepath for tiff_filepath in tiff_filepath_list if tiff_filepath not in done_stacks]
+        # Check every header before any pixels are written, the stacks found while splitting in the pipeline can't be
+        if (not args.pipeline or args.plan) and not args.watch and not args.skip_prescan and len(pending_filepath_list) > 0:
+            print(f"Checking the headers of {len(pending_filepath_list)} stacks...")
+            prescanned_metadata = prescan_stacks(pending_filepath_list, args.prescan_workers, cached_metadata, metadata_cache, error_report, auto_channel_presets)
+            cached_metadata.update(prescanned_metadata)
+            pending_filepath_list = [tiff_filepath for tiff_filepath in pending_filepath_list if tiff_filepath in prescanned_metadata]
+            if len(pending_filepath_list) + len(done_stacks) == 0:
+                error_report.write()
+                print(f"ERROR prescan_stacks: None of the stacks can be split, see {error_report.report_filepath}")
+                exit()
+
+
+        # Nothing to pick the channels from yet, wait for the imager to write the first stack
+        if len(tiff_filepath_list) == 0:
+            print("Waiting for the first stack to be written to the input folder...")
+            for ready_filepaths in watch_stacks(input_directory, output_directory, args.settle_seconds, args.poll_interval, not args.no_inotify, discovery_options=discovery_options):
+                if len(ready_filepaths) > 0:
+                    tiff_filepath_list = pending_filepath_list = ready_filepaths[:1]
+                    break
+
+        # Select a tiff to make sure everything checks out, the first one with readable metadata when failing stacks are skipped
+        test_tiff_filepath = tiff_filepath_list[0]
+        if error_report is not None:
+            for candidate_filepath in pending_filepath_list:
+                try:
+                    if cached_metadata.get(candidate_filepath) or extract_metadata_as_dict(candidate_filepath):
+                        test_tiff_filepath = candidate_filepath
+                        break
+                except Exception:
+                    continue
+        if not os.path.isfile(test_tiff_filepath):
+            print(f"\n\nERROR {test_tiff_filepath} is not a valid tiff file. Check to make sure it exists.")
+            exit()
+        if not test_tiff_filepath.endswith(".tif"):
+            print(f"\n\nERROR {test_tiff_filepath} is not a tiff file. Enter a .tif filepath and retry.\n")
+            exit()
+
+        image_metadata = cached_metadata.get(test_tiff_filepath) or extract_metadata_as_dict(test_tiff_filepath)
+        if image_metadata is None:
+            print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {test_tiff_filepath}. Exiting script...")
+            exit()
 
-    # Throw the data into the CSV
-    print("\tAdding data to CSV...")
-    create_append_SIMA_CSV(output_csv_fp, split_metadata)
 
-print("Finished process successfully")
+        # Get the settings for each channel according to the presets and convert it into a list to pass onto split_stack_channels_timepoints
+        if args.auto_channels:
+            # Only shown as an example, every stack gets its own channels when it is split
+            chosen_channel_ids, problems = resolve_stack_channels(image_metadata, channel_presets)
+            print(f"\nChannels are picked from the header of each stack, e.g. {os.path.basename(test_tiff_filepath)}:")
+            for index, channel_key in chosen_channel_ids:
+                print(f"\tChannel {index+1} is {channel_key}")
+            for problem in problems:
+                print(f"\tWARNING: {problem}")
+            channel_names_inorder = None
+        elif args.channels is not None:
+            chosen_channel_ids = resolve_channel_settings(image_metadata, channel_presets, args.channels)
+        else:
+            chosen_channel_ids = get_channel_settings(image_metadata, channel_presets)
+
+        if not args.auto_channels:
+            channel_names_inorder = get_channel_names_inorder(chosen_channel_ids, channel_presets)
+
+        # Channels given up front were chosen on purpose, there is nobody to confirm them in an unattended run
+        if args.channels is None and not args.auto_channels:
+            confirmation = input("Confirm that the above settings are correct (\"n\" for no, any other key to continue):")
+            if confirmation.lower == "n":
+                print("Exiting script. Please restart the script manually.")
+                exit()
+
+        # The journaled frames are named after the channels of the run they were split in, or the presets they were picked from
+        if journal is not None and not journal.check_setting("channel_names_inorder", channel_names_inorder if not args.auto_channels else {"auto_channels": channel_presets}):
+            print("ERROR: The channels don't match the ones of the run being resumed. Pick the same channels or start over without --resume.")
+            exit()
+        if journal is not None and not journal.check_setting("frame_selection", frame_selection.get_settings() if frame_selection is not None else None):
+            print("ERROR: --wells, --select-channels, --timepoints or --timepoint-stride don't match the run being resumed. Select the same frames or start over without --resume.")
+            exit()
+        if journal is not None and not journal.check_setting("output_layout", output_layout.get_settings()):
+            print("ERROR: --layout or --hash-buckets don't match the run being resumed. Use the same layout or start over without --resume.")
+            exit()
+
+
+        output_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
+
+        if args.plan:
+            plan_batch(tiff_filepath_list, channel_names_inorder, output_directory, cached_metadata, args.prescan_workers, auto_channel_presets, frame_selection, output_layout)
+            if codec_kwargs is not None:
+                print(f"\tThe output size is for uncompressed frames, {args.compression} compressed frames take up less.")
+            exit()
+
+
+        progress = ProgressReporter(None if args.pipeline or args.watch else len(pending_filepath_list), args.progress_interval, args.quiet, args.log)
+
+        archive_writer = None
+        if args.archive:
+            archive_volume_bytes = args.archive_volume_mb * 1024 * 1024 if args.archive_volume_mb else None
+            archive_writer = ArchiveWriter(os.path.join(output_directory, f"ImageIndex.ColumbusIDX.{args.archive}"), args.archive, args.archive_compression, archive_volume_bytes)
+            split_options["archive_writer"] = archive_writer
+        elif output_layout.get_all_subdirectories() is not None:
+            create_output_directories(output_directory, output_layout.get_all_subdirectories())
+
+        all_metadata = [metadata_tuple for split_metadata in done_stacks.values() for metadata_tuple in split_metadata]
+        if args.watch:
+            stacks_split = watch_and_split(input_directory, channel_names_inorder, output_directory, output_csv_fp, args.workers, args.settle_seconds, args.poll_interval, args.idle_exit, not args.no_inotify, args.flush_seconds, create_well_folder=False, metadata_cache=metadata_cache, split_options=split_options, stage_timer=stage_timer, profile_directory=args.profile_dir, progress=progress, journal=journal, resume=args.resume, error_report=error_report, discovery_options=discovery_options)
+            print(f"Split {stacks_split} stacks while watching {input_directory}")
+        elif args.pipeline:
+            print(f"Splitting the stacks in {input_directory} as they are found...")
+            all_metadata = run_stack_pipeline(input_directory, channel_names_inorder, output_directory, args.parse_workers, args.workers, args.queue_size, create_well_folder=False, metadata_cache=metadata_cache, split_options=split_options, stage_timer=stage_timer, profile_directory=args.profile_dir, progress=progress, journal=journal, resume=args.resume, error_report=error_report, discovery_options=discovery_options)
+        elif args.workers > 1:
+            print(f"Splitting {len(pending_filepath_list)} stacks with {args.workers} worker processes...")
+            all_metadata += split_stacks_parallel(pending_filepath_list, channel_names_inorder, output_directory, args.workers, create_well_folder=False, cached_metadata=cached_metadata, metadata_cache=metadata_cache, split_options=split_options, stage_timer=stage_timer, profile_directory=args.profile_dir, progress=progress, journal=journal, error_report=error_report)
+        else:
+            for tiff_filepath in pending_filepath_list:
+                # Reset the data for the new image
+                split_metadata = ""
+                progress.log(f"Parsing {tiff_filepath}...")
+
+        
+                try:
+                    # Extract the metadata
+                    image_metadata = cached_metadata.get(tiff_filepath)
+                    if image_metadata is None:
+                        progress.log("\tExtracting metadata")
+
+                        # original_metadata_dict = extract_metadata_as_dict(tiff_filepath)
+                        # image_metadata = get_clean_metadata_dict(original_metadata_dict)
+                        with catch_stack_errors(tiff_filepath, "extract_metadata_as_dict", args.continue_on_error):
+                            image_metadata = extract_metadata_as_dict_timed(tiff_filepath, stage_timer)
+
+                            if image_metadata is None:
+                                print(f"ERROR get_clean_metadata_dict: No OME Metadata was found for {tiff_filepath}. Exiting script...")
+                                exit()
+
+                        if metadata_cache is not None:
+                            metadata_cache.put(tiff_filepath, image_metadata)
+
+                    # Parse the metadata to write to the CSV
+                    progress.log("\tParsing metadata and splitting channels to output...")
+                    frame_checksums = None
+                    if journal is not None:
+                        journal.mark_started(tiff_filepath)
+                        frame_checksums = {}
+                    # The split captures the output of its own checks, the frames it reports to progress stay visible
+                    with catch_stack_errors(tiff_filepath, "split_stack_channels_timepoints", args.continue_on_error, capture_output=False):
+                        split_metadata = profile_call(args.profile_dir, tiff_filepath, split_stack_channels_timepoints, tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder=False, stage_timer=stage_timer, progress=progress, frame_checksums=frame_checksums, continue_on_error=args.continue_on_error, **split_options)
+                except StackError as e:
+                    error_report.add(e.tiff_filepath, e.stage, e.message)
+                    progress.stack_failed(tiff_filepath)
+                    continue
+
+                if journal is not None:
+                    journal.mark_done(tiff_filepath, split_metadata, frame_checksums)
+                all_metadata.extend(split_metadata)
+                progress.stack_done(tiff_filepath, split_metadata, os.path.getsize(tiff_filepath), log_frames=False)
+
+        progress.close()
+
+        # Throw the data into the CSV in a fixed order so the result does not depend on which stack finished first
+        # The watch appends its rows as it goes
+        if not args.watch:
+            print("Adding data to CSV...")
+            all_metadata.sort(key=metadata_row_sort_key)
+            csv_start = time.perf_counter()
+            # A resumed run can find rows of its stacks in the CSV already, those are replaced instead of added again
+            drop_source_filenames = {metadata_tuple[-1] for metadata_tuple in all_metadata} if args.resume else None
+            with SIMACSVWriter(output_csv_fp, drop_source_filenames=drop_source_filenames) as csv_writer:
+                csv_writer.writerows(all_metadata)
+            if stage_timer is not None:
+                stage_timer.record("csv_append", time.perf_counter() - csv_start, bytes_written=os.path.getsize(output_csv_fp), count=len(all_metadata))
+
+        if archive_writer is not None:
+            # The CSV goes last, into the last volume, once every frame it lists is in the archive
+            archive_writer.add_file(os.path.basename(output_csv_fp), output_csv_fp)
+            archive_writer.close()
+            print(f"Saved the frames and CSV to {', '.join(archive_writer.volume_filepaths)}")
+
+        if journal is not None:
+            journal.close()
+
+        if stage_timer is not None:
+            stage_timer.write_report(args.report)
+            print(f"Saved the run report to {args.report}")
+
+        if error_report is not None and len(error_report) > 0:
+            error_report.write()
+            print(f"Finished process with {len(error_report)} failed stacks, see {error_report.report_filepath}")
+        else:
+            print("Finished process successfully")
+    finally:
+        # Keep what was cached so far when a stack or Ctrl + C stops the run
+        if metadata_cache is not None:
+            metadata_cache.close()
 
 
 # TODO
@@ -0,0 +1,357 @@
+"""
+Benchmarks for the SImA scripts, run on synthetic BioTek-style stacks so no instrument data is needed.
+Run from the repository folder:
+
+    python SIMA_Benchmark.py
+    python SIMA_Benchmark.py --stacks 8 --channels 6 --timepoints 20 --size 2048 --json results.json
+    python SIMA_Benchmark.py --headers
+    python SIMA_Benchmark.py --headers path/to/stack.tif path/to/other_stack.tif
+    python SIMA_Benchmark.py --codecs --size 2048 --network-mb-per-s 50
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xmltodict
+import tifffile
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is left out there
+    resource = None
+
+import Batch_SIMA_Metadata_CSV_Generator as batch
+from SIMA_MetadataIndex import build_metadata_index, parse_metadata_index
+
+
+def build_ome_header(num_channels, num_timepoints, image_width=2048, image_height=2048, well_ID="A1", pixel_type="uint16"):
+    """Build a BioTek-style OME-XML header with one Plane element per frame."""
+    channels = "".join(f'<Channel ID="Channel:0:{c}" SamplesPerPixel="1"/>' for c in range(num_channels))
+    planes = "".join(f'<Plane TheC="{c}" TheT="{t}" TheZ="0" DeltaT="{t * 60}" ExposureTime="100"/>' for t in range(num_timepoints) for c in range(num_channels))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" Creator="Gen5">'
+        f'<Image ID="Image:0" Name="{well_ID}">'
+        f'<Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="{pixel_type}" SizeX="{image_width}" SizeY="{image_height}" SizeC="{num_channels}" SizeT="{num_timepoints}" SizeZ="1">'
+        f'{channels}<TiffData IFD="0" PlaneCount="{num_channels * num_timepoints}"/>{planes}'
+        '</Pixels></Image>'
+        '<StructuredAnnotations><XMLAnnotation ID="Annotation:0"><Value><BTIImageMetaData>'
+        f'<ImageReference><Plate>Plate 1</Plate><Well>{well_ID}</Well><Date>10/18/26</Date><VerticalTotal>1</VerticalTotal><HorizontalTotal>1</HorizontalTotal></ImageReference>'
+        '<ImageAcquisition><ObjectiveSize>10</ObjectiveSize><NumericalAperture>0.3</NumericalAperture><ShutterSpeedMS>100</ShutterSpeedMS>'
+        '<Channel><Color>DAPI</Color><EmissionWavelength>447</EmissionWavelength><ExcitationWavelength>377</ExcitationWavelength></Channel>'
+        '</ImageAcquisition></BTIImageMetaData></Value></XMLAnnotation></StructuredAnnotations>'
+        '</OME>'
+    )
+
+def write_synthetic_stack(tiff_filepath, num_channels, num_timepoints, image_width=512, image_height=512, bit_depth=16, compression=None, header="ome", well_ID="A1", seed=0):
+    """Write a kinetic stack laid out like the BioTek ones, with the OME-XML in the ImageDescription or the IJMetadata."""
+    dtype = np.uint8 if bit_depth == 8 else np.uint16
+    rng = np.random.default_rng(seed)
+    frames = rng.integers(0, 2 ** bit_depth - 1, (num_channels * num_timepoints, image_height, image_width), dtype=dtype, endpoint=True)
+    ome_header = build_ome_header(num_channels, num_timepoints, image_width, image_height, well_ID, np.dtype(dtype).name)
+
+    if header == "ome":
+        tifffile.imwrite(tiff_filepath, frames, description=ome_header, photometric="minisblack", compression=compression, metadata=None)
+    elif header == "imagej":
+        tifffile.imwrite(tiff_filepath, frames, imagej=True, compression=compression, metadata={"Info": ome_header, "axes": "TYX"})
+    else:
+        raise ValueError(f"Unknown header variant {header}")
+
+def write_synthetic_plate(directory, num_stacks, num_channels, num_timepoints, image_width=512, image_height=512, bit_depth=16, compression=None, header="ome"):
+    """Write num_stacks synthetic stacks with well IDs A1, A2, ... to directory and return their paths."""
+    rows = "ABCDEFGHIJKLMNOP"
+    tiff_filepaths = []
+    for stack_index in range(num_stacks):
+        well_ID = f"{rows[stack_index // 24]}{stack_index % 24 + 1}"
+        tiff_filepath = os.path.join(directory, f"{well_ID}.tif")
+        write_synthetic_stack(tiff_filepath, num_channels, num_timepoints, image_width, image_height, bit_depth, compression, header, well_ID, seed=stack_index)
+        tiff_filepaths.append(tiff_filepath)
+    return tiff_filepaths
+
+
+
+# Header lookup comparison
+
+class RecursiveLookup:
+    """Look keys up the way the scripts did before the metadata index, one full tree walk per key."""
+    def __init__(self, cleaned_metadata_dict):
+        self.cleaned_metadata_dict = cleaned_metadata_dict
+
+    def get(self, key):
+        return batch.get_value_from_metadata_dict(key, self.cleaned_metadata_dict)
+
+def extract_recursive(ome_xml):
+    return batch.get_clean_metadata_dict(RecursiveLookup(batch.clean_dict_keys(xmltodict.parse(ome_xml))))
+
+def extract_indexed(ome_xml):
+    return batch.get_clean_metadata_dict(build_metadata_index(xmltodict.parse(ome_xml)))
+
+def extract_streamed(ome_xml):
+    return batch.get_clean_metadata_dict(parse_metadata_index(ome_xml))
+
+def time_per_call(function, argument, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(argument)
+    return (time.perf_counter() - start) / repeats
+
+def benchmark_metadata_extraction(headers, repeats=5):
+    print(f"\n{'Header':<40} {'Planes':>8} {'Recursive (ms)':>16} {'Indexed (ms)':>14} {'Streamed (ms)':>15} {'Speedup':>9}")
+    for name, ome_xml in headers:
+        reference_metadata = extract_recursive(ome_xml)
+        if extract_indexed(ome_xml) != reference_metadata or extract_streamed(ome_xml) != reference_metadata:
+            print(f"ERROR benchmark_metadata_extraction: The metadata for {name} does not match the recursive lookup.")
+            exit()
+
+        recursive_time = time_per_call(extract_recursive, ome_xml, repeats)
+        indexed_time = time_per_call(extract_indexed, ome_xml, repeats)
+        streamed_time = time_per_call(extract_streamed, ome_xml, repeats)
+        print(f"{name:<40} {ome_xml.count('<Plane '):>8} {recursive_time * 1000:>16.2f} {indexed_time * 1000:>14.2f} {streamed_time * 1000:>15.2f} {recursive_time / streamed_time:>8.1f}x")
+
+
+
+# Stage suite
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return peak_rss / 1024 / 1024 if sys.platform == "darwin" else peak_rss / 1024
+
+def get_channel_names_inorder(num_channels):
+    channel_keys = list(batch.channel_presets.keys())
+    return [(batch.channel_presets[key]["ChannelName"], batch.channel_presets[key]["AcquisitionType"], batch.channel_presets[key]["Color"]) for key in channel_keys[:num_channels]]
+
+def get_directory_size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+def run_stage(stage, tiff_filepaths, output_directory, num_channels, split_options, csv_rows):
+    """Time one stage over every stack. Runs in a fresh process so the peak RSS belongs to this stage alone."""
+    result = {"stage": stage, "files": len(tiff_filepaths), "frames": 0, "bytes_read": 0, "bytes_written": 0}
+    os.makedirs(output_directory, exist_ok=True)
+
+    if stage == "extract_metadata_as_dict":
+        start = time.perf_counter()
+        for tiff_filepath in tiff_filepaths:
+            batch.extract_metadata_as_dict(tiff_filepath)
+        result["seconds"] = time.perf_counter() - start
+
+    elif stage == "get_clean_metadata_dict":
+        metadata_indexes = []
+        for tiff_filepath in tiff_filepaths:
+            with tifffile.TiffFile(tiff_filepath) as tif:
+                metadata_xml = tif.ome_metadata or tif.pages[0].tags["IJMetadata"].value["Info"]
+            metadata_indexes.append(parse_metadata_index(metadata_xml))
+        start = time.perf_counter()
+        for metadata_index in metadata_indexes:
+            batch.get_clean_metadata_dict(metadata_index)
+        result["seconds"] = time.perf_counter() - start
+
+    elif stage.startswith("split_stack_channels_timepoints"):
+        channel_names_inorder = get_channel_names_inorder(num_channels)
+        image_metadata_list = [batch.extract_metadata_as_dict(tiff_filepath) for tiff_filepath in tiff_filepaths]
+        start = time.perf_counter()
+        for tiff_filepath, image_metadata in zip(tiff_filepaths, image_metadata_list):
+            result["frames"] += len(batch.split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, False, **split_options))
+        result["seconds"] = time.perf_counter() - start
+        for tiff_filepath in tiff_filepaths:
+            with tifffile.TiffFile(tiff_filepath) as tif:
+                result["bytes_read"] += sum(page.nbytes for page in tif.pages)
+        result["bytes_written"] = get_directory_size(output_directory)
+
+    elif stage == "SIMACSVWriter":
+        csv_filepath = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
+        start = time.perf_counter()
+        with batch.SIMACSVWriter(csv_filepath) as csv_writer:
+            csv_writer.writerows(csv_rows)
+        result["seconds"] = time.perf_counter() - start
+        result["files"] = 1
+        result["frames"] = len(csv_rows)
+        result["bytes_written"] = os.path.getsize(csv_filepath)
+
+    else:
+        raise ValueError(f"Unknown stage {stage}")
+
+    result["peak_rss_mb"] = get_peak_rss_mb()
+    return result
+
+# Output codecs
+
+def make_fluorescence_frames(num_frames, image_width=512, image_height=512, num_cells=50, seed=0):
+    """
+    16-bit frames that compress like fluorescence images: a smooth background, blurred cells and shot noise in the
+    12 bits of the camera. The uniform noise of write_synthetic_stack doesn't compress at all, real frames do.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:image_height, 0:image_width].astype(np.float32)
+    background = 200 + 100 * np.sin(x / image_width * np.pi) * np.cos(y / image_height * np.pi)
+    frames = []
+    for _ in range(num_frames):
+        signal = np.zeros((image_height, image_width), dtype=np.float32)
+        for center_x, center_y, radius, brightness in zip(rng.uniform(0, image_width, num_cells), rng.uniform(0, image_height, num_cells), rng.uniform(4, 12, num_cells), rng.uniform(500, 3000, num_cells)):
+            # Only the area around each cell, a whole frame per cell gets slow on large frames
+            x0, x1 = int(max(0, center_x - 4 * radius)), int(min(image_width, center_x + 4 * radius + 1))
+            y0, y1 = int(max(0, center_y - 4 * radius)), int(min(image_height, center_y + 4 * radius + 1))
+            signal[y0:y1, x0:x1] += brightness * np.exp(-((x[y0:y1, x0:x1] - center_x) ** 2 + (y[y0:y1, x0:x1] - center_y) ** 2) / (2 * radius ** 2))
+        frames.append(rng.poisson(background + signal).clip(0, 4095).astype(np.uint16))
+    return frames
+
+def can_write_codec(codec):
+    if codec == "none":
+        return True
+    try:
+        with tifffile.TiffWriter(io.BytesIO()) as writer:
+            writer.write(np.zeros((2, 2), dtype=np.uint16), compression=codec)
+    except Exception:
+        return False
+    return True
+
+def benchmark_output_codecs(args):
+    """Write the same synthetic frames with every output codec through write_frame_to_tiff and compare them."""
+    num_frames = args.stacks * args.channels * args.timepoints
+    frames = make_fluorescence_frames(num_frames, args.size, args.size)
+    input_bytes = sum(frame.nbytes for frame in frames)
+    network_bytes_per_s = args.network_mb_per_s * 1024 * 1024
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix="sima_codecs_")
+
+    results = []
+    print(f"\n{num_frames} frames of {args.size}x{args.size} 16-bit, {input_bytes / 1024 ** 2:.1f} MB, {args.codec_workers} compression threads, {args.network_mb_per_s} MB/s upload")
+    print(f"\n{'Codec':<8} {'Ratio':>7} {'Output (MB)':>12} {'Wall (s)':>9} {'CPU (s)':>9} {'Write MB/s':>11} {'Upload (s)':>11} {'Net MB/s':>9}")
+    try:
+        for codec in batch.OUTPUT_CODECS:
+            if not can_write_codec(codec):
+                print(f"{codec:<8} skipped, needs imagecodecs")
+                continue
+            output_directory = os.path.join(work_directory, codec)
+            shutil.rmtree(output_directory, ignore_errors=True)
+            os.makedirs(output_directory)
+            write_kwargs = {"photometric": "minisblack", "metadata": None}
+            write_kwargs.update(batch.get_codec_write_kwargs(codec, workers=args.codec_workers) or {})
+
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            bytes_written = 0
+            for i, frame in enumerate(frames):
+                bytes_written += batch.write_frame_to_tiff(os.path.join(output_directory, f"frame_{i:05d}.tif"), frame, write_kwargs, "<")[0]
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+
+            # Writing and uploading overlap, the slower of the two sets the pace
+            upload_seconds = bytes_written / network_bytes_per_s
+            result = {"codec": codec, "frames": num_frames, "bytes_read": input_bytes, "bytes_written": bytes_written, "ratio": input_bytes / bytes_written, "seconds": wall_seconds, "cpu_seconds": cpu_seconds, "upload_seconds": upload_seconds}
+            result["net_mb_per_s"] = input_bytes / 1024 / 1024 / max(wall_seconds, upload_seconds, 1e-9)
+            results.append(result)
+            print(f"{codec:<8} {result['ratio']:>7.2f} {bytes_written / 1024 ** 2:>12.1f} {wall_seconds:>9.3f} {cpu_seconds:>9.3f} {input_bytes / 1024 ** 2 / max(wall_seconds, 1e-9):>11.1f} {upload_seconds:>11.3f} {result['net_mb_per_s']:>9.1f}")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.json:
+        report = {
+            "config": {"frames": num_frames, "size": args.size, "codec_workers": args.codec_workers, "network_mb_per_s": args.network_mb_per_s},
+            "platform": {"python": platform.python_version(), "system": platform.platform(), "tifffile": tifffile.__version__, "numpy": np.__version__},
+            "results": results,
+        }
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+        print(f"\nSaved results to {args.json}")
+
+    return results
+
+def add_throughput(result):
+    seconds = max(result["seconds"], 1e-9)
+    result["files_per_s"] = result["files"] / seconds
+    result["frames_per_s"] = result["frames"] / seconds
+    result["mb_per_s"] = max(result["bytes_read"], result["bytes_written"]) / 1024 / 1024 / seconds
+    return result
+
+def run_suite(args):
+    work_directory = args.work_dir or tempfile.mkdtemp(prefix="sima_benchmark_")
+    stages = ["extract_metadata_as_dict", "get_clean_metadata_dict", "split_stack_channels_timepoints", "split_stack_channels_timepoints (write threads)", "SIMACSVWriter"]
+    variants = [(header, compression) for header in ["ome", "imagej"] for compression in [None, "zlib"]]
+
+    # Enough rows for the CSV writer to flush a few times
+    sample_row = ("Plate 1", "2026-10-18T00:00:00Z", 1, 1, "1", 1, "1", 1, "DAPI", "#0035ff", "Fluoresence", "0.6500", "0.6500", 0.1, "447", "377", "0", "0", "0", 1792281600, "512", "512", 1, "20", 10, "0.3", "Confocal", "[[1,0,0],[0,1,0],[0,0,1]]", "A1_RS_1_1_DAPI_001.tif")
+    csv_rows = [sample_row] * args.csv_rows
+
+    results = []
+    print(f"\n{'Variant':<14} {'Stage':<48} {'Seconds':>9} {'Files/s':>9} {'Frames/s':>10} {'MB/s':>9} {'Peak RSS (MB)':>14}")
+    try:
+        for header, compression in variants:
+            variant = f"{header}-{compression or 'none'}"
+            input_directory = os.path.join(work_directory, variant)
+            os.makedirs(input_directory, exist_ok=True)
+            tiff_filepaths = write_synthetic_plate(input_directory, args.stacks, args.channels, args.timepoints, args.size, args.size, args.bit_depth, compression, header)
+
+            for stage in stages:
+                output_directory = os.path.join(work_directory, f"{variant}_output")
+                shutil.rmtree(output_directory, ignore_errors=True)
+                split_options = {"write_threads": 4} if stage.endswith("(write threads)") else {}
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    result = executor.submit(run_stage, stage, tiff_filepaths, output_directory, args.channels, split_options, csv_rows).result()
+                result = add_throughput(result)
+                result["variant"] = variant
+                results.append(result)
+
+                peak_rss = f"{result['peak_rss_mb']:.1f}" if result["peak_rss_mb"] is not None else "n/a"
+                print(f"{variant:<14} {stage:<48} {result['seconds']:>9.3f} {result['files_per_s']:>9.1f} {result['frames_per_s']:>10.1f} {result['mb_per_s']:>9.1f} {peak_rss:>14}")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    if args.json:
+        report = {
+            "config": {"stacks": args.stacks, "channels": args.channels, "timepoints": args.timepoints, "size": args.size, "bit_depth": args.bit_depth, "csv_rows": args.csv_rows},
+            "platform": {"python": platform.python_version(), "system": platform.platform(), "tifffile": tifffile.__version__, "numpy": np.__version__},
+            "results": results,
+        }
+        with open(args.json, "w") as json_file:
+            json.dump(report, json_file, indent=2)
+        print(f"\nSaved results to {args.json}")
+
+    return results
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the SImA scripts on synthetic BioTek-style stacks.")
+    parser.add_argument("--headers", action="store_true", help="Only compare the metadata lookups, on synthetic headers or on the given stacks")
+    parser.add_argument("tiff_filepaths", nargs="*", help="With --headers, stacks to read the headers from")
+    parser.add_argument("--codecs", action="store_true", help="Only compare the output codecs on synthetic fluorescence frames")
+    parser.add_argument("--codec-workers", type=int, default=4, help="With --codecs, number of threads compressing the strips of each frame (default: 4)")
+    parser.add_argument("--network-mb-per-s", type=float, default=50.0, help="With --codecs, upload speed to work out the net throughput of each codec with (default: 50)")
+    parser.add_argument("--stacks", type=int, default=4, help="Number of synthetic stacks per variant (default: 4)")
+    parser.add_argument("--channels", type=int, default=2, help="Channels per stack (default: 2)")
+    parser.add_argument("--timepoints", type=int, default=10, help="Timepoints per stack (default: 10)")
+    parser.add_argument("--size", type=int, default=512, help="Frame width and height in pixels (default: 512)")
+    parser.add_argument("--bit-depth", type=int, choices=[8, 16], default=16, help="Bits per pixel (default: 16)")
+    parser.add_argument("--csv-rows", type=int, default=100000, help="Rows written in the CSV writer stage (default: 100000)")
+    parser.add_argument("--json", help="Save the results to this JSON file")
+    parser.add_argument("--work-dir", help="Folder for the synthetic stacks and split frames, kept after the run (default: a temporary folder)")
+    args = parser.parse_args()
+
+    if args.headers:
+        if len(args.tiff_filepaths) > 0:
+            headers = []
+            for tiff_filepath in args.tiff_filepaths:
+                with tifffile.TiffFile(tiff_filepath) as tif:
+                    headers.append((tiff_filepath, tif.ome_metadata))
+        else:
+            headers = [(f"synthetic {c} channels x {t} timepoints", build_ome_header(c, t)) for c, t in [(1, 1), (6, 20), (6, 200), (6, 1000)]]
+
+        benchmark_metadata_extraction(headers)
+    elif args.codecs:
+        benchmark_output_codecs(args)
+    else:
+        run_suite(args)
@@ -0,0 +1,81 @@
+"""
+Writer for the ImageIndex.ColumbusIDX.csv the SImA scripts make, shared by all of them.
+"""
+
+import csv
+import os
+import shutil
+
+
+class SIMACSVWriter:
+    """
+    Write the rows of ImageIndex.ColumbusIDX.csv through a temporary file that replaces the CSV on close.
+    Existing rows are kept, except those whose SourceFilename is in drop_source_filenames.
+    """
+    headers = [
+        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
+        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um",
+        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm",
+        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth",
+        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification",
+        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
+    ]
+
+    def __init__(self, filepath, flush_every=1000, drop_source_filenames=None):
+        self.filepath = filepath
+        self.temp_filepath = filepath + ".tmp"
+        self.flush_every = flush_every
+        self.pending_rows = []
+
+        has_rows = os.path.isfile(filepath) and os.path.getsize(filepath) > 0
+        if has_rows and drop_source_filenames:
+            with open(filepath, newline='') as existing_file, open(self.temp_filepath, mode='w', newline='') as temp_file:
+                temp_writer = csv.writer(temp_file)
+                for existing_row in csv.reader(existing_file):
+                    if len(existing_row) > 0 and existing_row[-1] not in drop_source_filenames:
+                        temp_writer.writerow(existing_row)
+        elif has_rows:
+            shutil.copyfile(filepath, self.temp_filepath)
+        self.file = open(self.temp_filepath, mode='a', newline='', buffering=1024 * 1024)
+        self.writer = csv.writer(self.file)
+        if not has_rows:
+            self.writer.writerow(self.headers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.close()
+
+    def writerow(self, row):
+        self.pending_rows.append(row)
+        if len(self.pending_rows) >= self.flush_every:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        self.writer.writerows(self.pending_rows)
+        self.pending_rows = []
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_filepath, self.filepath)
+
+    def discard(self):
+        """Close and delete the temporary file, leaving the CSV as it was."""
+        if self.file.closed:
+            return
+        self.pending_rows = []
+        self.file.close()
+        os.remove(self.temp_filepath)
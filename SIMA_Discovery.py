@@ -0,0 +1,153 @@
+"""
+Find the stacks under an input folder for the SImA scripts, listing folders in a pool of threads.
+Check which files a set of patterns keeps from the repository folder:
+
+    python SIMA_Discovery.py path/to/input
+    python SIMA_Discovery.py path/to/input --exclude "*_old/*" --max-depth 1
+    python SIMA_Discovery.py path/to/input --regex --include "[A-P][0-9]+.*\\.tiff?$"
+"""
+
+import argparse
+import fnmatch
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_INCLUDE = ["*.tif", "*.tiff"]
+
+
+class DiscoveryFilter:
+    """
+    Decide which files and folders under input_directory are kept, by glob or regex patterns on their relative path,
+    exclude_directories and max_depth.
+    """
+    def __init__(self, input_directory, include=None, exclude=None, pattern_type="glob", max_depth=None, exclude_directories=None):
+        if pattern_type not in ("glob", "regex"):
+            print(f"ERROR DiscoveryFilter: Unknown pattern type '{pattern_type}', use 'glob' or 'regex'.")
+            exit()
+        self.input_directory = input_directory
+        self.pattern_type = pattern_type
+        self.max_depth = max_depth
+        self.include = self.compile_patterns(include or DEFAULT_INCLUDE)
+        self.exclude = self.compile_patterns(exclude) if exclude else None
+        self.exclude_directories = {self.normalize_directory(directory) for directory in exclude_directories or []}
+
+    def compile_patterns(self, patterns):
+        try:
+            if self.pattern_type == "glob":
+                return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
+            return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+        except re.error as e:
+            print(f"ERROR compile_patterns: {patterns} are not valid {self.pattern_type} patterns ({e})")
+            exit()
+
+    @staticmethod
+    def normalize_directory(directory):
+        return os.path.normcase(os.path.abspath(directory))
+
+    def matches(self, regex, relative_path, name):
+        if self.pattern_type == "glob":
+            return regex.match(relative_path) is not None or regex.match(name) is not None
+        return regex.search(relative_path) is not None
+
+    def keeps_file(self, relative_path, name):
+        return self.matches(self.include, relative_path, name) and (self.exclude is None or not self.matches(self.exclude, relative_path, name))
+
+    def keeps_directory(self, path, relative_path, name, depth):
+        """depth is the depth of the folder itself, the folders directly in input_directory are at depth 1."""
+        if self.max_depth is not None and depth > self.max_depth:
+            return False
+        if self.exclude is not None and self.matches(self.exclude, relative_path, name):
+            return False
+        return len(self.exclude_directories) == 0 or self.normalize_directory(path) not in self.exclude_directories
+
+    def keeps_filepath(self, filepath):
+        """Check a single file found some other way, e.g. by a folder watch, including all of its folders."""
+        relative_path = os.path.relpath(filepath, self.input_directory).replace(os.sep, "/")
+        if relative_path.startswith("../"):
+            return False
+        parts = relative_path.split("/")
+        for depth in range(1, len(parts)):
+            directory = os.path.join(self.input_directory, *parts[:depth])
+            if not self.keeps_directory(directory, "/".join(parts[:depth]), parts[depth - 1], depth):
+                return False
+        return self.keeps_file(relative_path, parts[-1])
+
+def scan_directory(directory, relative_directory, depth, discovery_filter):
+    """
+    List a single folder with os.scandir. Returns the files discovery_filter keeps, the subfolders to list next
+    as (path, relative path) and the depth of the folder. Folders that can't be listed are skipped like os.walk does.
+    """
+    filepaths = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                relative_path = f"{relative_directory}/{entry.name}" if relative_directory else entry.name
+                try:
+                    is_directory = entry.is_dir()
+                except OSError:
+                    continue
+                if is_directory:
+                    # Like os.walk, links to folders are not followed
+                    if not entry.is_symlink() and discovery_filter.keeps_directory(entry.path, relative_path, entry.name, depth + 1):
+                        subdirectories.append((entry.path, relative_path))
+                elif discovery_filter.keeps_file(relative_path, entry.name):
+                    filepaths.append(entry.path)
+    except OSError as e:
+        print(f"WARNING scan_directory: Skipping {directory} ({e})")
+    return sorted(filepaths), sorted(subdirectories), depth
+
+def iter_tiff_filepaths(input_directory, include=None, exclude=None, pattern_type="glob", max_depth=None, exclude_directories=None, workers=8):
+    """
+    Yield the files under input_directory a DiscoveryFilter keeps, listing folders in workers threads
+    but yielding them in sorted os.walk order.
+    """
+    discovery_filter = DiscoveryFilter(input_directory, include, exclude, pattern_type, max_depth, exclude_directories)
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def scan_tree(directory, relative_directory, depth):
+        filepaths, subdirectories, depth = scan_directory(directory, relative_directory, depth, discovery_filter)
+        if stop_event.is_set():
+            return filepaths, []
+        return filepaths, [executor.submit(scan_tree, subdirectory, relative_path, depth + 1) for subdirectory, relative_path in subdirectories]
+
+    try:
+        # The listings still to yield, the next folder in walk order on top
+        pending = [executor.submit(scan_tree, input_directory, "", 0)]
+        while len(pending) > 0:
+            filepaths, subdirectory_futures = pending.pop().result()
+            yield from filepaths
+            pending += reversed(subdirectory_futures)
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def add_discovery_arguments(parser):
+    """Add the discovery options shared by the scripts to an argparse parser."""
+    parser.add_argument("--include", action="append", help="Only use the files matching this pattern, can be given more than once (default: *.tif and *.tiff)")
+    parser.add_argument("--exclude", action="append", help="Skip the files and folders matching this pattern, can be given more than once")
+    parser.add_argument("--regex", action="store_true", help="Read --include and --exclude as regular expressions instead of glob patterns")
+    parser.add_argument("--max-depth", type=int, help="Don't look deeper than this many folders under the input folder, 0 only uses the files directly in it")
+    parser.add_argument("--discovery-workers", type=int, default=8, help="Number of threads listing folders (default: 8)")
+
+def get_discovery_options(args):
+    """Turn the parsed add_discovery_arguments options into keyword arguments of iter_tiff_filepaths."""
+    return {"include": args.include, "exclude": args.exclude, "pattern_type": "regex" if args.regex else "glob", "max_depth": args.max_depth, "workers": args.discovery_workers}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the stacks the SImA scripts would find in a folder.")
+    parser.add_argument("input_directory")
+    add_discovery_arguments(parser)
+    parser.add_argument("--exclude-dir", action="append", help="Skip this folder, as the scripts do with their output folder")
+    args = parser.parse_args()
+
+    count = 0
+    for tiff_filepath in iter_tiff_filepaths(args.input_directory, exclude_directories=args.exclude_dir, **get_discovery_options(args)):
+        print(tiff_filepath)
+        count += 1
+    print(f"Found {count} files")
@@ -0,0 +1,73 @@
+"""
+Job files for the SImA scripts: a JSON object or (Python 3.11+) a TOML table with the command line options of a
+run, e.g.
+
+    input = "D:/Plates/Plate1"
+    output = "D:/Split/Plate1"
+    channels = ["Confocal DRAQ7", "Confocal DAPI"]
+    workers = 4
+"""
+
+import argparse
+import json
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11, only JSON job files then
+    tomllib = None
+
+
+def load_job_file(job_filepath, description="job file"):
+    """Read a JSON or TOML job file (or preset file, as the description says) into a dict."""
+    try:
+        if job_filepath.endswith(".toml"):
+            if tomllib is None:
+                print(f"ERROR load_job_file: TOML {description}s need Python 3.11 or newer, use a JSON {description} instead of {job_filepath}.")
+                exit()
+            with open(job_filepath, "rb") as job_file:
+                job = tomllib.load(job_file)
+        else:
+            with open(job_filepath) as job_file:
+                job = json.load(job_file)
+    except (OSError, ValueError) as e:
+        print(f"ERROR load_job_file: Could not read the {description} {job_filepath} ({e})")
+        exit()
+    if not isinstance(job, dict):
+        print(f"ERROR load_job_file: The {description} {job_filepath} has to hold an object of names and values.")
+        exit()
+    return job
+
+def convert_job_value(action, value):
+    """Run a job file value (or each item of a list) through the type and choices of its option, as argparse does."""
+    if isinstance(value, list):
+        return [convert_job_value(action, item) for item in value]
+    if action.type is not None and isinstance(value, str):
+        value = action.type(value)
+    if action.choices is not None and value not in action.choices:
+        raise ValueError(f"invalid choice {value!r}, choose from {', '.join(map(str, action.choices))}")
+    return value
+
+def parse_args_with_job_file(parser):
+    """
+    Parse the command line, with the options of the --job file as defaults so the command line still overrides them.
+    Job file keys are the option names with or without the leading dashes ("write-threads" or "write_threads").
+    """
+    args, _ = parser.parse_known_args()
+    if args.job is None:
+        return parser.parse_args()
+
+    actions_by_dest = {action.dest: action for action in parser._actions}
+    job_defaults = {}
+    for key, value in load_job_file(args.job).items():
+        dest = key.lstrip("-").replace("-", "_")
+        if dest not in actions_by_dest or dest in ("help", "job"):
+            print(f"ERROR parse_args_with_job_file: Unknown option '{key}' in the job file {args.job}.")
+            exit()
+        try:
+            job_defaults[dest] = convert_job_value(actions_by_dest[dest], value)
+        except (TypeError, ValueError, argparse.ArgumentTypeError) as e:
+            print(f"ERROR parse_args_with_job_file: Invalid value {value!r} for the option '{key}' in the job file {args.job} ({e}).")
+            exit()
+    parser.set_defaults(**job_defaults)
+    return parser.parse_args()
@@ -0,0 +1,111 @@
+"""
+SQLite cache of the metadata the SImA scripts parse out of each stack, so reruns skip their headers.
+One cache file can be shared by all the scripts, each entry belongs to an extractor and its version.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def get_file_stats(filepaths):
+    """Return {filepath: (size, mtime_ns)} read from the directory listings with one os.scandir per folder."""
+    filepaths_by_directory = {}
+    for filepath in filepaths:
+        directory = os.path.dirname(os.path.abspath(filepath))
+        filepaths_by_directory.setdefault(directory, {})[os.path.basename(filepath)] = filepath
+
+    file_stats = {}
+    for directory, filepaths_by_name in filepaths_by_directory.items():
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                filepath = filepaths_by_name.get(entry.name)
+                if filepath is not None:
+                    entry_stat = entry.stat()
+                    file_stats[filepath] = (entry_stat.st_size, entry_stat.st_mtime_ns)
+
+    return file_stats
+
+class MetadataCache:
+    """
+    SQLite cache of the metadata dict of each tif for one extractor, keyed by path, size, mtime_ns and extractor_version.
+    Stale entries of this extractor are deleted when they are looked up, new ones are committed every few puts.
+    """
+    def __init__(self, cache_filepath, extractor, extractor_version, commit_every=100, commit_seconds=5.0):
+        # The pipeline looks entries up from its header parsing threads, the lock keeps them off each other
+        self.connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS extractor_metadata (extractor TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, version INTEGER, metadata TEXT, PRIMARY KEY (extractor, path))")
+        self.extractor = extractor
+        self.extractor_version = extractor_version
+        self.file_stats = {}
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.uncommitted_puts = 0
+        self.last_commit_time = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, filepath):
+        """Return the cached metadata_dict of a single filepath, or None if it has no up to date cache entry."""
+        file_stat = os.stat(filepath)
+        self.file_stats[filepath] = (file_stat.st_size, file_stat.st_mtime_ns)
+        return self.lookup([filepath]).get(filepath)
+
+    def get_many(self, filepaths):
+        """Return {filepath: metadata_dict} for every filepath with an up to date cache entry."""
+        self.file_stats.update(get_file_stats(filepaths))
+        return self.lookup(filepaths)
+
+    def lookup(self, filepaths):
+        filepaths_by_path = {os.path.abspath(filepath): filepath for filepath in filepaths if filepath in self.file_stats}
+        paths = list(filepaths_by_path)
+
+        cached_metadata = {}
+        stale_paths = []
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            with self.lock:
+                rows = self.connection.execute(f"SELECT path, size, mtime_ns, version, metadata FROM extractor_metadata WHERE extractor = ? AND path IN ({','.join('?' * len(chunk))})", [self.extractor] + chunk).fetchall()
+            for path, size, mtime_ns, version, metadata in rows:
+                filepath = filepaths_by_path[path]
+                if (size, mtime_ns) == self.file_stats[filepath] and version == self.extractor_version:
+                    cached_metadata[filepath] = json.loads(metadata)
+                else:
+                    stale_paths.append((self.extractor, path))
+
+        if stale_paths:
+            with self.lock:
+                self.connection.executemany("DELETE FROM extractor_metadata WHERE extractor = ? AND path = ?", stale_paths)
+                self.connection.commit()
+
+        return cached_metadata
+
+    def put(self, filepath, metadata_dict):
+        if filepath not in self.file_stats:
+            file_stat = os.stat(filepath)
+            self.file_stats[filepath] = (file_stat.st_size, file_stat.st_mtime_ns)
+        size, mtime_ns = self.file_stats[filepath]
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO extractor_metadata VALUES (?, ?, ?, ?, ?, ?)", (self.extractor, os.path.abspath(filepath), size, mtime_ns, self.extractor_version, json.dumps(metadata_dict)))
+            self.uncommitted_puts += 1
+            if self.uncommitted_puts >= self.commit_every or time.monotonic() - self.last_commit_time >= self.commit_seconds:
+                self.connection.commit()
+                self.uncommitted_puts = 0
+                self.last_commit_time = time.monotonic()
+
+    def close(self):
+        """Commit and close the cache, closing it again does nothing."""
+        with self.lock:
+            if self.connection is None:
+                return
+            self.connection.commit()
+            self.connection.close()
+            self.connection = None
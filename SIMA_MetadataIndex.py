@@ -0,0 +1,169 @@
+"""
+Index of the metadata in the OME/BioTek XML header of a stack, shared by the SImA scripts. The header is streamed
+with ElementTree.iterparse for the keys get_clean_metadata_dict reads, and parsed whole with xmltodict otherwise.
+"""
+
+import io
+import xml.etree.ElementTree as ET
+import xmltodict
+
+
+def get_channel_infos(ome_channels, bti_channels):
+    """
+    Pair the OME Channel and BTI Channel elements of a header by position into a dict per channel with the name,
+    wavelengths and acquisition mode of the OME one and the Color (and wavelengths, when OME has none) of the BTI one.
+    """
+    channel_infos = []
+    for i in range(max(len(ome_channels), len(bti_channels))):
+        ome_channel = ome_channels[i] if i < len(ome_channels) else {}
+        bti_channel = bti_channels[i] if i < len(bti_channels) else {}
+        channel_infos.append({
+            "name": ome_channel.get("Name"),
+            "color": bti_channel.get("Color"),
+            "excitationWavelength": ome_channel.get("ExcitationWavelength") or bti_channel.get("ExcitationWavelength"),
+            "emissionWavelength": ome_channel.get("EmissionWavelength") or bti_channel.get("EmissionWavelength"),
+            "acquisitionMode": ome_channel.get("AcquisitionMode"),
+        })
+    return channel_infos
+
+def build_metadata_index(data, metadata_index=None):
+    """Walk the parsed metadata once and map every key (without the xmltodict '@') to its first value."""
+    if metadata_index is None:
+        metadata_index = {}
+
+    if isinstance(data, dict):
+        for key, value in data.items():
+            key = key.lstrip('@')
+            if value is not None and key not in metadata_index:
+                metadata_index[key] = value
+            if isinstance(value, (dict, list)):
+                build_metadata_index(value, metadata_index)
+    elif isinstance(data, list):
+        for item in data:
+            build_metadata_index(item, metadata_index)
+
+    return metadata_index
+
+# Keys read by get_clean_metadata_dict, each with the fallback keys it tries when the first one is missing
+REQUIRED_METADATA_KEYS = [
+    ("VerticalTotal", "verticalTotal"),
+    ("HorizontalTotal", "horizontalTotal"),
+    ("ShutterSpeedMS",),
+    ("Date",),
+    ("Well",),
+    ("ObjectiveSize",),
+    ("SizeX", "PixelWidth"),
+    ("SizeY", "PixelHeight"),
+    ("Plate",),
+    ("Color",),
+    ("EmissionWavelength",),
+    ("ExcitationWavelength",),
+    ("SizeC",),
+    ("SizeT",),
+    ("NumericalAperture",),
+]
+
+def stream_metadata_index(metadata_xml, pixels_info=None):
+    """
+    Stream the XML for the REQUIRED_METADATA_KEYS, or return None so the caller falls back to xmltodict.
+    Given a pixels_info dict, the DimensionOrder, SizeZ and channels of the header are added to it in the same pass.
+    """
+    wanted_keys = {key for keys in REQUIRED_METADATA_KEYS for key in keys}
+    primary_keys = {keys[0] for keys in REQUIRED_METADATA_KEYS}
+    metadata_index = {}
+    primary_keys_found = 0
+
+    if pixels_info is not None:
+        pixels_info.update({"dimensionOrder": "XYCZT", "num_planes": "1", "channels": []})
+    ome_channels = []
+    bti_channels = []
+    # Depth of the BTI Channel being read and of the element holding the BTI Channels
+    bti_channel_depth = None
+    bti_channels_parent_depth = None
+    pixels_done = channels_done = pixels_info is None
+    # The open elements from the root down, finished elements are removed from their parent so the tree stays small
+    open_elements = []
+    has_children = []
+    depth = 0
+
+    try:
+        for event, elem in ET.iterparse(io.StringIO(metadata_xml), events=("start", "end")):
+            tag = elem.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if has_children:
+                    has_children[-1] = True
+                open_elements.append(elem)
+                has_children.append(False)
+                depth += 1
+                # Attributes come before the children of an element, the same order xmltodict gives them
+                if metadata_index is not None:
+                    for attribute, value in elem.attrib.items():
+                        key = attribute.rsplit("}", 1)[-1]
+                        if key in wanted_keys and key not in metadata_index and value != "":
+                            metadata_index[key] = value
+                            primary_keys_found += key in primary_keys
+                if pixels_info is not None:
+                    if tag == "Pixels":
+                        pixels_info["dimensionOrder"] = elem.get("DimensionOrder") or pixels_info["dimensionOrder"]
+                        pixels_info["num_planes"] = elem.get("SizeZ") or pixels_info["num_planes"]
+                    elif tag == "Channel" and elem.get("ID", "").startswith("Channel"):
+                        ome_channels.append(dict(elem.attrib))
+                    elif tag == "Channel":
+                        bti_channels.append({})
+                        bti_channel_depth = depth
+                        bti_channels_parent_depth = depth - 1
+            else:
+                if metadata_index is not None and tag in wanted_keys and tag not in metadata_index:
+                    if has_children[-1] or elem.attrib:
+                        if pixels_info is None:
+                            return None
+                        # The keys come from xmltodict, only the pixels_info is still read
+                        metadata_index = None
+                    else:
+                        text = (elem.text or "").strip()
+                        if text != "":
+                            metadata_index[tag] = text
+                            primary_keys_found += tag in primary_keys
+                if pixels_info is not None:
+                    if bti_channel_depth is not None and depth == bti_channel_depth + 1:
+                        bti_channels[-1][tag] = (elem.text or "").strip()
+                    elif depth == bti_channel_depth:
+                        bti_channel_depth = None
+                    elif depth == bti_channels_parent_depth:
+                        channels_done = True
+                    elif tag == "Pixels":
+                        pixels_done = True
+                elem.clear()
+                open_elements.pop()
+                has_children.pop()
+                if open_elements:
+                    open_elements[-1].remove(elem)
+                depth -= 1
+
+            if metadata_index is not None and primary_keys_found == len(primary_keys) and pixels_done and channels_done:
+                break
+    except ET.ParseError:
+        if pixels_info is not None:
+            pixels_info.update({"dimensionOrder": "XYCZT", "num_planes": "1", "channels": []})
+        return None
+
+    if pixels_info is not None:
+        pixels_info["channels"] = get_channel_infos(ome_channels, bti_channels)
+
+    if metadata_index is None:
+        return None
+    for keys in REQUIRED_METADATA_KEYS:
+        if not any(key in metadata_index for key in keys):
+            return None
+
+    return metadata_index
+
+def parse_metadata_index(metadata_xml, pixels_info=None):
+    """
+    Build the metadata index of an XML string, streaming it when possible and parsing all of it with xmltodict otherwise.
+    Given a pixels_info dict it is filled in by stream_metadata_index.
+    """
+    metadata_index = stream_metadata_index(metadata_xml, pixels_info)
+    if metadata_index is None:
+        metadata_index = build_metadata_index(xmltodict.parse(metadata_xml))
+    return metadata_index
@@ -1,37 +1,57 @@
 import tifffile
 import xml.etree.ElementTree as ET
 import json
+import io
 from PIL import Image
 import os
 import xmltodict
 from datetime import datetime
 import csv
-
-
-def get_input_output():
-    print("\nPress Ctrl + C to exit anytime.")
+import shutil
+import argparse
+import random
+from SIMA_Discovery import add_discovery_arguments, get_discovery_options, iter_tiff_filepaths
+from SIMA_CSVWriter import SIMACSVWriter
+from SIMA_MetadataCache import MetadataCache
+from SIMA_MetadataIndex import parse_metadata_index
+from SIMA_JobFile import parse_args_with_job_file
+
+
+def get_input_output(discovery_options=None, input_directory=None, output_directory=None):
+    """Ask for the input and output folders, unless they are given as input_directory/output_directory, the script exits if those aren't valid."""
+    if discovery_options is None:
+        discovery_options = {}
+    given_input_directory = input_directory
+    given_output_directory = output_directory
+    if given_input_directory is None or given_output_directory is None:
+        print("\nPress Ctrl + C to exit anytime.")
     tiff_filepaths = []
     while True:
-        input_directory = input("\nINPUT - Enter an input folder with aligned kinetic stacks to split/generate a SImA Upload CSV: ")
+        if given_input_directory is None:
+            input_directory = input("\nINPUT - Enter an input folder with aligned kinetic stacks to split/generate a SImA Upload CSV: ")
         if not os.path.isdir(input_directory):
             print(f"ERROR: The folder '{input_directory}' does not exist.")
+            if given_input_directory is not None:
+                exit()
             continue
         else:
             # Walk through the directory and get .tif files
-            for root, dirs, files in os.walk(input_directory):
-                for file in files:
-                    if file.endswith(".tif") or file.endswith(".tiff"):
-                        tiff_filepaths.append(os.path.join(root, file))
+            tiff_filepaths = sorted(iter_tiff_filepaths(input_directory, **discovery_options))
             if not len(tiff_filepaths) > 0:
                 print(f"ERROR: The folder '{input_directory}' does not contain any .tif files, please try again.")
+                if given_input_directory is not None:
+                    exit()
                 continue
             else:
                 break
 
     while True:
-        output_directory = input("\nOUTPUT - Enter an folder to output the CSV and split stacks: ")
+        if given_output_directory is None:
+            output_directory = input("\nOUTPUT - Enter an folder to output the CSV and split stacks: ")
         if not os.path.isdir(output_directory):
             print(f"ERROR: The folder '{output_directory}' does not exist, try again.")
+            if given_output_directory is not None:
+                exit()
             continue
         else:
             break
@@ -39,39 +59,7 @@ def get_input_output():
     
     return tiff_filepaths, output_directory
 
-def create_append_SIMA_CSV_tuple(filepath, data):
-    headers = [
-        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
-        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um", 
-        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm", 
-        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth", 
-        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification", 
-        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
-    ]
-    
-    try:
-        with open(filepath, mode='a+', newline='') as file:
-            writer = csv.writer(file)
-            
-            file.seek(0)
-            if file.read(1) == '':
-                writer.writerow(headers)
-            
-            writer.writerows(data)
-
-    except Exception as e:
-        print(f"ERROR create_append_SIMA_CSV: {e}")
-
-def create_append_SIMA_CSV_dict(filepath, data_dict):
-    # Define the headers
-    headers = [
-        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
-        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um",
-        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm",
-        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth",
-        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification",
-        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
-    ]
+def metadata_dict_to_row(data_dict):
     # Map incoming dictionary keys to the headers
     row = [
         data_dict.get("plateName", ""),                 # PlateName
@@ -105,20 +93,7 @@ def create_append_SIMA_CSV_dict(filepath, data_dict):
         data_dict.get("sourceFilename", "")            # SourceFilename
     ]
 
-    try:
-        with open(filepath, mode='a+', newline='') as file:
-            writer = csv.writer(file)
-            
-            # Write headers if the file is empty
-            file.seek(0)
-            if file.read(1) == '':
-                writer.writerow(headers)
-            
-            # Write the row mapped from the dictionary
-            writer.writerow(row)
-
-    except Exception as e:
-        print(f"ERROR create_append_SIMA_CSV: {e}")
+    return row
 
 def well_id_to_row_col(well_id):
     rows = "ABCDEFGHIJKLMNOP"
@@ -153,8 +128,7 @@ def extract_metadata_as_dict(tiff_path):
     with tifffile.TiffFile(tiff_path) as tif:
         # Check for OME metadata and parse if available
         if tif.ome_metadata:
-            ome_dict = xmltodict.parse(tif.ome_metadata)
-            return get_clean_metadata_dict(clean_dict_keys(ome_dict))
+            return get_clean_metadata_dict(parse_metadata_index(tif.ome_metadata))
 
         # If OME metadata is not available, extract and parse metadata from page 0
         if tif.pages:
@@ -162,16 +136,14 @@ def extract_metadata_as_dict(tiff_path):
             page_0_metadata_xml = page_0.description  # Assuming XML metadata is in the description field
             if page_0_metadata_xml:
                 try:
-                    page_0_dict = xmltodict.parse(page_0_metadata_xml)
-                    return get_clean_metadata_dict(clean_dict_keys(page_0_dict))
+                    return get_clean_metadata_dict(parse_metadata_index(page_0_metadata_xml))
                 except Exception as e:
                     if "IJMetadata" in page_0.tags:
                         ij_metadata = page_0.tags["IJMetadata"].value["Info"]
                         start_index = ij_metadata.find("<OME")
                         if start_index != -1:
                             ij_metadata = ij_metadata[start_index:]
-                        ome_dict = xmltodict.parse(ij_metadata)
-                        return get_clean_metadata_dict(clean_dict_keys(ome_dict))
+                        return get_clean_metadata_dict(parse_metadata_index(ij_metadata))
                     
                     else:
                         return None
@@ -195,31 +167,31 @@ def get_value_from_metadata_dict(final_key, data):
                         return result
     return None
 
-def get_clean_metadata_dict(original_metadata_dict):    
+def get_clean_metadata_dict(metadata_index):    
 
     # Calculated/Derived
     
-    verticalTotal = get_value_from_metadata_dict("VerticalTotal", original_metadata_dict)
+    verticalTotal = metadata_index.get("VerticalTotal")
     if verticalTotal is None:
-        verticalTotal = get_value_from_metadata_dict("verticalTotal", original_metadata_dict)
+        verticalTotal = metadata_index.get("verticalTotal")
 
-    horizTotal = get_value_from_metadata_dict("HorizontalTotal", original_metadata_dict)
+    horizTotal = metadata_index.get("HorizontalTotal")
     if horizTotal is None:
-        horizTotal = get_value_from_metadata_dict("horizontalTotal", original_metadata_dict)
+        horizTotal = metadata_index.get("horizontalTotal")
 
 
     numFields = int(verticalTotal) * int(horizTotal)
 
-    exposureTimeMS = get_value_from_metadata_dict("ShutterSpeedMS", original_metadata_dict)
+    exposureTimeMS = metadata_index.get("ShutterSpeedMS")
     exposureTimeS = int(exposureTimeMS) / 1000
 
-    measurementDate = get_value_from_metadata_dict("Date", original_metadata_dict)
+    measurementDate = metadata_index.get("Date")
     measurementDate, absoluteTime = convert_date_format(measurementDate)
 
-    wellID = get_value_from_metadata_dict("Well", original_metadata_dict)
+    wellID = metadata_index.get("Well")
     row, column = well_id_to_row_col(wellID)
 
-    objectiveMagnification = get_value_from_metadata_dict("ObjectiveSize", original_metadata_dict)
+    objectiveMagnification = metadata_index.get("ObjectiveSize")
 
     objectiveSizeInt = int(objectiveMagnification)
 
@@ -233,18 +205,21 @@ def get_clean_metadata_dict(original_metadata_dict):
         resolution = "0.1612"
     elif objectiveSizeInt == 60:
         resolution = "0.1082"
+    else:
+        print(f"ERROR get_clean_metadata_dict: Unknown objective size {objectiveMagnification}x, only 4x, 10x, 20x, 40x and 60x objectives have a known image resolution.")
+        exit()
 
 
-    image_width = get_value_from_metadata_dict("SizeX", original_metadata_dict)
+    image_width = metadata_index.get("SizeX")
     if image_width == None or image_width == "":
-        image_width = get_value_from_metadata_dict("PixelWidth", original_metadata_dict)
+        image_width = metadata_index.get("PixelWidth")
 
-    image_height = get_value_from_metadata_dict("SizeY", original_metadata_dict)
+    image_height = metadata_index.get("SizeY")
     if image_height == None or image_height == "":
-        image_height = get_value_from_metadata_dict("PixelHeight", original_metadata_dict)
+        image_height = metadata_index.get("PixelHeight")
 
     clean_metadata_dict = {
-        "plateName" : get_value_from_metadata_dict("Plate", original_metadata_dict),
+        "plateName" : metadata_index.get("Plate"),
         "measurementDate" : measurementDate,
         "absoluteTime" : absoluteTime,
         "wellID" : wellID,
@@ -254,16 +229,16 @@ def get_clean_metadata_dict(original_metadata_dict):
         "horizTotal" : horizTotal,
         "numFields": numFields,
         "exposureTimeS" : exposureTimeS,
-        "channelName" : get_value_from_metadata_dict("Color", original_metadata_dict),
-        "emissionWavelength" : get_value_from_metadata_dict("EmissionWavelength", original_metadata_dict),
-        "excitationWavelength" : get_value_from_metadata_dict("ExcitationWavelength", original_metadata_dict),
-        "num_channels" : get_value_from_metadata_dict("SizeC", original_metadata_dict),
-        "num_timepoints" : get_value_from_metadata_dict("SizeT", original_metadata_dict),
+        "channelName" : metadata_index.get("Color"),
+        "emissionWavelength" : metadata_index.get("EmissionWavelength"),
+        "excitationWavelength" : metadata_index.get("ExcitationWavelength"),
+        "num_channels" : metadata_index.get("SizeC"),
+        "num_timepoints" : metadata_index.get("SizeT"),
         "imageWidth" : image_width,
         "imageHeight" : image_height,
         "resolutionX" : resolution,
         "resolutionY" : resolution,
-        "objectiveNA" : get_value_from_metadata_dict("NumericalAperture", original_metadata_dict),
+        "objectiveNA" : metadata_index.get("NumericalAperture"),
         "objectiveMagnification" : objectiveSizeInt,
         "field" : "1",
         "plane" : "1",
@@ -282,6 +257,11 @@ def get_clean_metadata_dict(original_metadata_dict):
 
     return clean_metadata_dict
 
+# Bump this whenever get_clean_metadata_dict changes what it returns so old cache entries are thrown away
+METADATA_EXTRACTOR_VERSION = 1
+# Name of this script's entries in a metadata cache shared with the other SImA scripts
+METADATA_EXTRACTOR_NAME = "non-splitting"
+
 def append_more_metadata_from_filename(filepath, metadata_dict, num_timepoints):
     """"
     okay, a lot of this information is going to be based on the filename since that data can't AUTOMATICALLY be extracted from the metadata
@@ -329,6 +309,42 @@ def append_more_metadata_from_filename(filepath, metadata_dict, num_timepoints):
     
     return metadata_dict
 
+def get_frame_group_key(filepath):
+    """Return the (well, channel number) of a split frame, read from the same filename fields as append_more_metadata_from_filename."""
+    sourceFilename_split_list = os.path.basename(filepath).split(".")[0].split("_")
+    return sourceFilename_split_list[0], sourceFilename_split_list[2]
+
+def get_group_templates(filepath_list, verify_sample=0, cached_metadata=None):
+    """
+    Parse one header per (well, channel) group of frames and return them as the metadata template of each group.
+    With verify_sample, groups with a frame that doesn't match the template get no template.
+    """
+    if cached_metadata is None:
+        cached_metadata = {}
+
+    frame_groups = {}
+    for filepath in filepath_list:
+        frame_groups.setdefault(get_frame_group_key(filepath), []).append(filepath)
+
+    # Seeded so reruns spot-check the same frames
+    sampler = random.Random(0)
+    group_templates = {}
+    for group_key, group_filepaths in frame_groups.items():
+        template_filepath = group_filepaths[0]
+        template = cached_metadata.get(template_filepath) or extract_metadata_as_dict(template_filepath)
+        if template is None:
+            continue
+
+        sample_filepaths = sampler.sample(group_filepaths[1:], min(verify_sample, len(group_filepaths) - 1))
+        mismatched_filepaths = [filepath for filepath in sample_filepaths if (cached_metadata.get(filepath) or extract_metadata_as_dict(filepath)) != template]
+        if len(mismatched_filepaths) > 0:
+            print(f"WARNING: The header of {os.path.basename(mismatched_filepaths[0])} does not match {os.path.basename(template_filepath)}, reading every frame of well {group_key[0]} channel {group_key[1]} separately")
+            continue
+
+        group_templates[group_key] = dict(template)
+
+    return group_templates
+
 def get_total_num_timepoints(filepath_list):
     largest_number = 0
     for filepath in filepath_list:
@@ -345,33 +361,67 @@ def get_total_num_timepoints(filepath_list):
 
 
 
-tiff_filepaths, output_directory = get_input_output()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a SImA upload CSV for tifs that are already split. Without --input and --output the script asks for them.")
+    parser.add_argument("--job", help="JSON or TOML file with the options of this run, options given on the command line override it")
+    parser.add_argument("--input", help="Input folder with the split tifs, instead of asking for it")
+    parser.add_argument("--output", help="Output folder for the CSV, instead of asking for it")
+    parser.add_argument("--metadata-cache", help="SQLite file to cache the metadata of each tif in, so reruns over the same files skip opening them")
+    parser.add_argument("--group-frames", action="store_true", help="Read one header per well and channel and reuse it for every timepoint of that well and channel")
+    parser.add_argument("--verify-sample", type=int, default=0, help="With --group-frames, number of extra frames per well and channel to read and compare to the reused header (default: 0)")
+    add_discovery_arguments(parser)
+    args = parse_args_with_job_file(parser)
 
-print(f"OUTPUT: {output_directory}")
+    tiff_filepaths, output_directory = get_input_output(get_discovery_options(args), args.input, args.output)
 
+    print(f"OUTPUT: {output_directory}")
 
-headers = [
-    "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
-    "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um", 
-    "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm", 
-    "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth", 
-    "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification", 
-    "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
-]
 
-num_timepoints = get_total_num_timepoints(tiff_filepaths)
-if num_timepoints == None:
-    print(f"ERROR: Could not parse the number of time points in the folder. Is the time point number the last element of the filename? {os.path.basename(tiff_filepaths[0])}")
-    exit()
+    headers = [
+        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
+        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um", 
+        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm", 
+        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth", 
+        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification", 
+        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
+    ]
 
+    num_timepoints = get_total_num_timepoints(tiff_filepaths)
+    if num_timepoints == None:
+        print(f"ERROR: Could not parse the number of time points in the folder. Is the time point number the last element of the filename? {os.path.basename(tiff_filepaths[0])}")
+        exit()
 
-csv_filepath = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
 
-for filepath in tiff_filepaths:
-    print(f"Processing {os.path.basename(filepath)}")
-    metadata_dict = extract_metadata_as_dict(filepath)
-    completed_metadata_dict = append_more_metadata_from_filename(filepath, metadata_dict, num_timepoints)
-    if completed_metadata_dict is None:
-        print("METADATA IS NONE!!")
-    create_append_SIMA_CSV_dict(csv_filepath, completed_metadata_dict)
-    
+    csv_filepath = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
+
+    metadata_cache = None
+    cached_metadata = {}
+    if args.metadata_cache:
+        metadata_cache = MetadataCache(args.metadata_cache, METADATA_EXTRACTOR_NAME, METADATA_EXTRACTOR_VERSION)
+        cached_metadata = metadata_cache.get_many(tiff_filepaths)
+        print(f"Found cached metadata for {len(cached_metadata)} of {len(tiff_filepaths)} tifs")
+
+    group_templates = {}
+    if args.group_frames:
+        group_templates = get_group_templates(tiff_filepaths, args.verify_sample, cached_metadata)
+        print(f"Reusing headers for {len(group_templates)} well/channel groups")
+
+    try:
+        with SIMACSVWriter(csv_filepath) as csv_writer:
+            for filepath in tiff_filepaths:
+                print(f"Processing {os.path.basename(filepath)}")
+                metadata_dict = cached_metadata.get(filepath)
+                if metadata_dict is None and args.group_frames and get_frame_group_key(filepath) in group_templates:
+                    metadata_dict = dict(group_templates[get_frame_group_key(filepath)])
+                if metadata_dict is None:
+                    metadata_dict = extract_metadata_as_dict(filepath)
+                    if metadata_cache is not None and metadata_dict is not None:
+                        metadata_cache.put(filepath, metadata_dict)
+                completed_metadata_dict = append_more_metadata_from_filename(filepath, metadata_dict, num_timepoints)
+                if completed_metadata_dict is None:
+                    print("METADATA IS NONE!!")
+                csv_writer.writerow(metadata_dict_to_row(completed_metadata_dict))
+    finally:
+        # Keep what was cached so far when a stack stops the run
+        if metadata_cache is not None:
+            metadata_cache.close()
@@ -38,11 +38,16 @@ create_well_folder = True
 import tifffile
 import xml.etree.ElementTree as ET
 import json
-from PIL import Image
 import os
 import xmltodict
 from datetime import datetime
 import csv
+import shutil
+import time
+import argparse
+from Batch_SIMA_Metadata_CSV_Generator import OUTPUT_LAYOUTS, OutputLayout, create_output_directories, get_frame_output_size, map_tiff_file, measure_throughput, plan_frame_filenames, write_page_to_tiff
+from SIMA_CSVWriter import SIMACSVWriter
+from SIMA_JobFile import parse_args_with_job_file
 
 def well_id_to_row_col(well_id):
     rows = "ABCDEFGHIJKLMNOP"
@@ -129,6 +134,9 @@ def get_metadata_info(image_metadata):
         resolution = "0.1612"
     elif objectiveSizeInt == 60:
         resolution = "0.1082"
+    else:
+        print(f"ERROR get_metadata_info: Unknown objective size {objectiveMagnification}x, only 4x, 10x, 20x, 40x and 60x objectives have a known image resolution.")
+        exit()
     resolutionX = resolution
     resolutionY = resolution
 
@@ -146,96 +154,165 @@ def get_metadata_info(image_metadata):
 
     return plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor,channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename, wellID
 
-def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder):
-
+def plan_stack_frames(image_metadata, channel_names_inorder, num_frames, output_layout=None):
+    """Return the page index, output filename and CSV row of every frame of a stack, named as the batch script names them."""
     plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor, channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename, well_ID = get_metadata_info(image_metadata)
-    if create_well_folder:
-        output_directory = os.path.join(output_directory, well_ID)
-        if not os.path.isdir(output_directory):
-            os.mkdir(output_directory)
+
+    pixels = image_metadata["OME"]["Image"]["Pixels"]
+    num_planes = int(pixels.get("SizeZ") or 1)
+
+    frame_plan = []
+    for page_index, output_filename, timepoint, channel_number, plane, field in plan_frame_filenames(plateName, well_ID, channel_names_inorder, num_frames, num_timepoints, num_planes, numFields, pixels.get("DimensionOrder"), output_layout=output_layout):
+        # Create the metadata tuples and output
+        sourceFilename = output_filename 
+        acquisitionType = channel_names_inorder[channel_number - 1][1]
+        metadata_tuple = (plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor, channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename)
+        frame_plan.append((page_index, output_filename, metadata_tuple))
+
+    return frame_plan
+
+def split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder, output_layout=None):
+    """
+    Split the stack into one TIFF per frame and return the CSV rows of the frames. The frames go into the folders
+    of output_layout (create_well_folder is the same as the "well" layout), which are created before the first frame.
+    """
+
+    if create_well_folder and (output_layout is None or output_layout.name == "flat"):
+        output_layout = OutputLayout("well")
 
     output_filepaths = []
-    time_point_index = 0
-    channel_name_index = 0
     
-    with Image.open(tiff_filepath) as img:
-
+    with tifffile.TiffFile(tiff_filepath) as tif:
         channel_name_index_max = len(channel_names_inorder)
 
-        num_frames = img.n_frames
-        time_point_index_max = int(num_frames / channel_name_index_max)
+        num_frames = len(tif.pages)
 
         if num_frames % channel_name_index_max != 0:
             print(f"ERROR split_stack_channels_timepoints: The number of frames ({num_frames}) divided by number of channels ({channel_name_index_max}) was not zero-divisible for {tiff_filepath}.\n\tCannot split stack evenly without matching number of frames and number of channels")
             exit()
 
-        for i in range(num_frames):
-
-            # Save the frame with correct channel and time point
-            channel_prefix = channel_names_inorder[channel_name_index][0]
-            output_filename = f"{well_ID}_{channel_prefix}_{time_point_index+1:03d}.tif" 
-            output_filepath = os.path.join(output_directory, output_filename)
-            
-            img.seek(i)
-            img.save(output_filepath)
-            print(f"Saved frame {i+1} as {output_filename}")
-
-            # Create the metadata tuples and output
-            sourceFilename = output_filename 
-            acquisitionType = channel_names_inorder[channel_name_index][1]
-            timepoint = time_point_index + 1
-            metadata_tuple = (plateName, measurementDate, row, column, field, timepoint, plane, channel, channelName, channelColor, channelType, resolutionX, resolutionY, exposureTimeS, emissionWavelength, excitationWavelength, positionX, positionY, timeOffset, absoluteTime, imageWidth, imageHeight, numFields, num_timepoints, objectiveMagnification, objectiveNA, acquisitionType, orientationMatrix, sourceFilename)
-            output_filepaths.append(metadata_tuple)
-
-            # Increment indices and reset if necessary
-            channel_name_index = (channel_name_index + 1) % channel_name_index_max
-            if channel_name_index == 0:  # This means channel_name_index has reset
-                time_point_index = (time_point_index + 1) % time_point_index_max
-        
+        frame_plan = plan_stack_frames(image_metadata, channel_names_inorder, num_frames, output_layout)
+        create_output_directories(output_directory, [os.path.dirname(output_filename) for page_index, output_filename, metadata_tuple in frame_plan])
+
+        stack_map = map_tiff_file(tif)
+        try:
+            for page_index, output_filename, metadata_tuple in frame_plan:
+
+                # Save the frame with correct channel and time point
+                output_filepath = os.path.join(output_directory, output_filename)
+                
+                write_page_to_tiff(tif, tif.pages[page_index], output_filepath, stack_map)
+                print(f"Saved frame {page_index+1} as {output_filename}")
+                output_filepaths.append(metadata_tuple)
+        finally:
+            if stack_map is not None:
+                try:
+                    stack_map.close()
+                except BufferError:
+                    # A frame that failed to write can still hold a view of the map, it is closed once that is freed
+                    pass
             
     return output_filepaths
 
-def create_append_SIMA_CSV(filepath, data):
-    headers = [
-        "PlateName", "MeasurementDate", "Row", "Column", "Field", "Timepoint", "Plane", "Channel",
-        "ChannelName", "ChannelColor", "ChannelType", "ImageResolutionX@um", "ImageResolutionY@um", 
-        "ExposureTime[s]", "MainEmissionWavelength@nm", "MainExcitationWavelength@nm", 
-        "PositionX@um", "PositionY@um", "TimeOffset@s", "AbsoluteTime@s", "ImageWidth", 
-        "ImageHeight", "NumberOfFields", "NumberOfTimepoints", "ObjectiveMagnification", 
-        "ObjectiveNA", "AcquisitionType", "OrientationMatrix", "SourceFilename"
-    ]
-    
-    # try:
-    with open(filepath, mode='a+', newline='') as file:
-        writer = csv.writer(file)
-        
-        file.seek(0)
-        if file.read(1) == '':
-            writer.writerow(headers)
-        
-        writer.writerows(data)
-
-    # except Exception as e:
-    #     print(f"ERROR create_append_SIMA_CSV: {e}")
-
-
-
-if not os.path.isfile(tiff_filepath):
-    print(f"\n\nERROR {tiff_filepath} is not a valid tiff file. Check to make sure it exists.")
-    exit()
-if not tiff_filepath.endswith(".tif"):
-    print(f"\n\nERROR {tiff_filepath} is not a tiff file. Enter a .tif filepath and retry.\n")
-    exit()
-
-if not os.path.isdir(tiff_filepath):
-    print(f"\n\nERROR {output_directory} is not a valid output directory. Check to make sure it exists and is where you want to output the files.")
-
-output_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
-
-image_metadata = extract_ome_metadata_as_dict(tiff_filepath)
-
-split_metadata = split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, create_well_folder)
-
-create_append_SIMA_CSV(output_csv_fp, split_metadata)
-
-print("Finished process successfully")
+def parse_channel_names(channels):
+    """
+    Turn channels, a list (or comma separated string) of "Name:AcquisitionType" strings or [name, acquisition type]
+    pairs, into the (name, acquisition type) list of channel_names_inorder.
+    """
+    if isinstance(channels, str):
+        channels = [channel.strip() for channel in channels.split(",")]
+
+    parsed_channel_names = []
+    for channel in channels:
+        if isinstance(channel, str):
+            channel = channel.rsplit(":", 1)
+        if len(channel) != 2 or channel[1] not in ("Confocal", "NonConfocal"):
+            print(f"ERROR parse_channel_names: '{channel}' is not a channel name and Confocal/NonConfocal acquisition type, e.g. \"DAPI:Confocal\".")
+            exit()
+        parsed_channel_names.append((channel[0], channel[1]))
+    return parsed_channel_names
+
+def plan_split(tiff_filepath, image_metadata, channel_names_inorder, output_directory, output_layout=None):
+    """
+    Dry run of split_stack_channels_timepoints: write ImageIndex.ColumbusIDX.plan.csv and print the output size,
+    free space and estimated runtime.
+    """
+    with tifffile.TiffFile(tiff_filepath) as tif:
+        num_frames = len(tif.pages)
+        if num_frames % len(channel_names_inorder) != 0:
+            print(f"ERROR plan_split: The number of frames ({num_frames}) divided by number of channels ({len(channel_names_inorder)}) was not zero-divisible for {tiff_filepath}.")
+            exit()
+        frame_plan = plan_stack_frames(image_metadata, channel_names_inorder, num_frames, output_layout)
+        output_bytes = num_frames * get_frame_output_size(tif.pages[0])
+    input_bytes = os.path.getsize(tiff_filepath)
+
+    plan_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.plan.csv")
+    if os.path.isfile(plan_csv_fp):
+        os.remove(plan_csv_fp)
+    with SIMACSVWriter(plan_csv_fp) as csv_writer:
+        csv_writer.writerows(metadata_tuple for page_index, output_filename, metadata_tuple in frame_plan)
+    output_bytes += os.path.getsize(plan_csv_fp)
+
+    read_speed, write_speed = measure_throughput(tiff_filepath, output_directory)
+    estimated_seconds = input_bytes / read_speed + output_bytes / write_speed
+    free_bytes = shutil.disk_usage(output_directory).free
+
+    print(f"\nPlan for {tiff_filepath}:")
+    print(f"\tFrames to write:   {num_frames}")
+    print(f"\tInput size:        {input_bytes / 1024 ** 3:.2f} GB")
+    print(f"\tOutput size:       {output_bytes / 1024 ** 3:.2f} GB (frames and CSV)")
+    print(f"\tFree output space: {free_bytes / 1024 ** 3:.2f} GB")
+    print(f"\tMeasured speed:    {read_speed / 1024 ** 2:.1f} MB/s read, {write_speed / 1024 ** 2:.1f} MB/s write")
+    print(f"\tEstimated runtime: {time.strftime('%H:%M:%S', time.gmtime(estimated_seconds))}")
+    print(f"\tPlanned filenames and CSV rows: {plan_csv_fp}")
+    if free_bytes < output_bytes:
+        print(f"WARNING: The output folder is {(output_bytes - free_bytes) / 1024 ** 3:.2f} GB short of space for this stack.")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split the stack set at the top of this script and generate a SImA upload CSV. The settings at the top of this script are used for every option that isn't given.")
+    parser.add_argument("--plan", action="store_true", help="Don't split anything, only write the filenames and CSV rows the split would create and estimate its size and runtime")
+    parser.add_argument("--job", help="JSON or TOML file with the options of this run, options given on the command line override it")
+    parser.add_argument("--input", help="Stack to split, instead of tiff_filepath")
+    parser.add_argument("--output", help="Output folder for the CSV and split stack, instead of output_directory")
+    parser.add_argument("--channels", help="Channels of the stack in order as comma separated Name:AcquisitionType pairs, e.g. \"DRAQ7:Confocal,DAPI:Confocal\", instead of channel_names_inorder")
+    parser.add_argument("--well-folder", action=argparse.BooleanOptionalAction, help="Put the split frames in a folder named after the well, instead of create_well_folder")
+    parser.add_argument("--layout", choices=OUTPUT_LAYOUTS, help="Folders to put the split frames in: all in the output folder (flat), a folder per well, per plate and well, per well and channel, or hash buckets that fill up evenly, instead of create_well_folder")
+    parser.add_argument("--hash-buckets", type=int, default=256, help="With --layout hash, number of bucket folders (default: 256)")
+    args = parse_args_with_job_file(parser)
+
+    if args.input is not None:
+        tiff_filepath = args.input
+    if args.output is not None:
+        output_directory = args.output
+    if args.channels is not None:
+        channel_names_inorder = parse_channel_names(args.channels)
+    if args.well_folder is not None:
+        create_well_folder = args.well_folder
+    output_layout = OutputLayout(args.layout or ("well" if create_well_folder else "flat"), args.hash_buckets)
+
+    if not os.path.isfile(tiff_filepath):
+        print(f"\n\nERROR {tiff_filepath} is not a valid tiff file. Check to make sure it exists.")
+        exit()
+    if not tiff_filepath.endswith(".tif"):
+        print(f"\n\nERROR {tiff_filepath} is not a tiff file. Enter a .tif filepath and retry.\n")
+        exit()
+
+    if not os.path.isdir(tiff_filepath):
+        print(f"\n\nERROR {output_directory} is not a valid output directory. Check to make sure it exists and is where you want to output the files.")
+
+    output_csv_fp = os.path.join(output_directory, "ImageIndex.ColumbusIDX.csv")
+
+    image_metadata = extract_ome_metadata_as_dict(tiff_filepath)
+
+    if args.plan:
+        plan_split(tiff_filepath, image_metadata, channel_names_inorder, output_directory, output_layout)
+        exit()
+
+    split_metadata = split_stack_channels_timepoints(tiff_filepath, image_metadata, channel_names_inorder, output_directory, False, output_layout)
+
+    with SIMACSVWriter(output_csv_fp) as csv_writer:
+        csv_writer.writerows(split_metadata)
+
+    print("Finished process successfully")
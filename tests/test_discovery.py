@@ -0,0 +1,43 @@
+import os
+
+from SIMA_Discovery import iter_tiff_filepaths
+
+
+def make_tree(root, relative_paths):
+    for relative_path in relative_paths:
+        filepath = os.path.join(root, *relative_path.split("/"))
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "wb"):
+            pass
+
+def get_relative_paths(root, filepaths):
+    return [os.path.relpath(filepath, root).replace(os.sep, "/") for filepath in filepaths]
+
+TREE = [
+    "B2.tif", "A1.tif", "notes.txt", "C3.tiff",
+    "plate2/D4.tif", "plate2/sub/E5.tif",
+    "plate1/F6.tif", "plate1_old/G7.tif",
+]
+
+def test_files_come_in_sorted_walk_order(tmp_path):
+    make_tree(tmp_path, TREE)
+    expected = ["A1.tif", "B2.tif", "C3.tiff", "plate1/F6.tif", "plate1_old/G7.tif", "plate2/D4.tif", "plate2/sub/E5.tif"]
+    for workers in (1, 4):
+        assert get_relative_paths(tmp_path, iter_tiff_filepaths(str(tmp_path), workers=workers)) == expected
+
+def test_exclude_patterns_skip_files_and_folders(tmp_path):
+    make_tree(tmp_path, TREE)
+    filepaths = iter_tiff_filepaths(str(tmp_path), exclude=["*_old", "B2.tif"])
+    assert get_relative_paths(tmp_path, filepaths) == ["A1.tif", "C3.tiff", "plate1/F6.tif", "plate2/D4.tif", "plate2/sub/E5.tif"]
+
+def test_regex_include(tmp_path):
+    make_tree(tmp_path, TREE)
+    filepaths = iter_tiff_filepaths(str(tmp_path), include=[r"(^|/)[A-C][0-9]+\.tiff?$"], pattern_type="regex")
+    assert get_relative_paths(tmp_path, filepaths) == ["A1.tif", "B2.tif", "C3.tiff"]
+
+def test_exclude_directories_and_max_depth(tmp_path):
+    make_tree(tmp_path, TREE)
+    filepaths = iter_tiff_filepaths(str(tmp_path), exclude_directories=[str(tmp_path / "plate2")], max_depth=1)
+    assert get_relative_paths(tmp_path, filepaths) == ["A1.tif", "B2.tif", "C3.tiff", "plate1/F6.tif", "plate1_old/G7.tif"]
+    filepaths = iter_tiff_filepaths(str(tmp_path), max_depth=0)
+    assert get_relative_paths(tmp_path, filepaths) == ["A1.tif", "B2.tif", "C3.tiff"]
@@ -0,0 +1,69 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import Batch_SIMA_Metadata_CSV_Generator as batch
+
+
+def get_expected_frame_indices(order, sizes):
+    """(timepoint, channel, plane, field) of every page, the first dimension of order changing fastest and fields outermost."""
+    axes = ["F"] + list(reversed(order))
+    expected = []
+    for indices in itertools.product(*(range(sizes[axis]) for axis in axes)):
+        index = dict(zip(axes, indices))
+        expected.append([index["T"], index["C"], index["Z"], index["F"]])
+    return expected
+
+@pytest.mark.parametrize("dimension_order", ["XYCZT", "XYCTZ", "XYZCT", "XYZTC", "XYTCZ", "XYTZC"])
+def test_frame_index_table_follows_dimension_order(dimension_order):
+    sizes = {"C": 2, "Z": 3, "T": 4, "F": 2}
+    num_frames = 2 * 3 * 4 * 2
+    table = batch.get_frame_index_table(num_frames, sizes["C"], sizes["T"], sizes["Z"], sizes["F"], dimension_order)
+    assert table.tolist() == get_expected_frame_indices(dimension_order[2:], sizes)
+
+def test_frame_index_table_drops_sizes_that_dont_add_up():
+    # 2 channels x 3 timepoints, but the header claims 2 planes and 2 fields
+    table = batch.get_frame_index_table(6, 2, 3, num_planes=2, num_fields=2, dimension_order="XYZCT")
+    assert table.tolist() == get_expected_frame_indices("ZCT", {"C": 2, "Z": 1, "T": 3, "F": 1})
+
+def test_frame_index_table_falls_back_to_channels_then_timepoints():
+    table = batch.get_frame_index_table(6, 2, num_timepoints=5, dimension_order="bogus")
+    assert table.tolist() == get_expected_frame_indices("CZT", {"C": 2, "Z": 1, "T": 3, "F": 1})
+
+def test_parse_timepoint_ranges():
+    assert batch.parse_timepoint_ranges("1-3, 5,7-") == [(1, 3), (5, 5), (7, None)]
+    assert batch.parse_timepoint_ranges("-2") == [(1, 2)]
+
+@pytest.mark.parametrize("timepoints", ["3-1", "0", "a-b"])
+def test_parse_timepoint_ranges_rejects_bad_ranges(timepoints):
+    with pytest.raises(SystemExit):
+        batch.parse_timepoint_ranges(timepoints)
+
+def test_select_timepoints_with_ranges_and_stride():
+    # Timepoints 2, 3, 4, 8, 9 and 10, of those every other one
+    selection = batch.FrameSelection(timepoint_ranges=[(2, 4), (8, None)], stride=2)
+    assert np.flatnonzero(selection.select_timepoints(10)).tolist() == [1, 3, 8]
+
+def test_select_frames_renumbers_the_selected_timepoints():
+    channel_names_inorder = [("DAPI", "Confocal", "#0035ff"), ("GFP", "Confocal", "#07ed07")]
+    table = batch.get_frame_index_table(8, 2, 4)
+    selection = batch.FrameSelection(channels=[("GFP", None)], timepoint_ranges=[(3, None)])
+    page_indices, timepoint_numbers = selection.select_frames(table, channel_names_inorder)
+    assert page_indices.tolist() == [5, 7]
+    assert timepoint_numbers.tolist() == [0, 0, 1, 2]
+
+def test_frame_filenames_use_the_csv_timepoint():
+    channel_names_inorder = [("DAPI", "Confocal", "#0035ff"), ("GFP", "Confocal", "#07ed07")]
+    selection = batch.FrameSelection(timepoint_ranges=[(2, 3)])
+    frame_names = batch.plan_frame_filenames("Plate 1", "A1", channel_names_inorder, 8, 4, frame_selection=selection)
+    assert [(page_index, output_filename, timepoint) for page_index, output_filename, timepoint, channel, plane, field in frame_names] == [
+        (2, "A1_RS_1_1_DAPI_001.tif", 1),
+        (3, "A1_RS_2_1_GFP_001.tif", 1),
+        (4, "A1_RS_1_1_DAPI_002.tif", 2),
+        (5, "A1_RS_2_1_GFP_002.tif", 2),
+    ]
+
+def test_frame_selection_wells():
+    selection = batch.FrameSelection(wells=["a1", " B2"])
+    assert selection.keeps_well("A1") and selection.keeps_well("B2") and not selection.keeps_well("C3")
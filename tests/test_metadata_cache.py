@@ -0,0 +1,72 @@
+import os
+
+from SIMA_MetadataCache import MetadataCache
+
+
+def make_tif(tmp_path, name, content=b"stack"):
+    filepath = str(tmp_path / name)
+    with open(filepath, "wb") as tif_file:
+        tif_file.write(content)
+    return filepath
+
+def test_entries_survive_a_reopen(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        cache.put(filepath, {"wellID": "A1"})
+
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        assert cache.get(filepath) == {"wellID": "A1"}
+        assert cache.get_many([filepath]) == {filepath: {"wellID": "A1"}}
+
+def test_changed_file_is_invalidated(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        cache.put(filepath, {"wellID": "A1"})
+    make_tif(tmp_path, "A1.tif", b"a different stack")
+
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        assert cache.get_many([filepath]) == {}
+        count = cache.connection.execute("SELECT COUNT(*) FROM extractor_metadata").fetchone()[0]
+        assert count == 0
+
+def test_touched_file_is_invalidated(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        cache.put(filepath, {"wellID": "A1"})
+    file_stat = os.stat(filepath)
+    os.utime(filepath, ns=(file_stat.st_atime_ns, file_stat.st_mtime_ns + 1_000_000_000))
+
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        assert cache.get(filepath) is None
+
+def test_new_extractor_version_is_invalidated(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as cache:
+        cache.put(filepath, {"wellID": "A1"})
+
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 2) as cache:
+        assert cache.get(filepath) is None
+
+def test_extractors_share_a_cache_file(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 3) as cache:
+        cache.put(filepath, {"wellID": "A1"})
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "non-splitting", 1) as cache:
+        assert cache.get(filepath) is None
+        cache.put(filepath, {"row": "1"})
+
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 3) as cache:
+        assert cache.get(filepath) == {"wellID": "A1"}
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "non-splitting", 1) as cache:
+        assert cache.get(filepath) == {"row": "1"}
+
+def test_puts_are_committed_before_close(tmp_path):
+    filepath = make_tif(tmp_path, "A1.tif")
+    cache = MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1, commit_every=1)
+    cache.put(filepath, {"wellID": "A1"})
+
+    # A second connection only sees committed entries
+    with MetadataCache(str(tmp_path / "cache.sqlite"), "batch", 1) as other_cache:
+        assert other_cache.get(filepath) == {"wellID": "A1"}
+    cache.close()
+    cache.close()
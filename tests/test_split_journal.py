@@ -0,0 +1,85 @@
+import os
+
+import Batch_SIMA_Metadata_CSV_Generator as batch
+
+
+def make_done_stack(tmp_path, journal):
+    """A stack marked done in journal with two frames of 100 bytes in the output folder, returns it and its rows."""
+    tiff_filepath = str(tmp_path / "A1.tif")
+    with open(tiff_filepath, "wb") as stack_file:
+        stack_file.write(b"stack")
+    output_directory = tmp_path / "out"
+    rows = []
+    frame_checksums = {}
+    for filename in ("A1_RS_1_1_DAPI_001.tif", "A1_RS_2_1_GFP_001.tif"):
+        (output_directory / filename).write_bytes(b"x" * 100)
+        frame_checksums[filename] = (100, 0)
+        rows.append(("Plate 1", filename))
+    journal.mark_started(tiff_filepath)
+    journal.mark_done(tiff_filepath, rows, frame_checksums)
+    return tiff_filepath, rows
+
+def open_journal(tmp_path, resume):
+    output_directory = tmp_path / "out"
+    output_directory.mkdir(exist_ok=True)
+    return batch.SplitJournal(str(output_directory / "journal.sqlite"), str(output_directory), resume)
+
+def test_resume_returns_the_rows_of_done_stacks(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        tiff_filepath, rows = make_done_stack(tmp_path, journal)
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.get_done_rows(tiff_filepath) == rows
+        assert journal.count_stacks("done") == 1
+
+def test_started_stacks_are_split_again(tmp_path):
+    tiff_filepath = str(tmp_path / "B2.tif")
+    with open(tiff_filepath, "wb") as stack_file:
+        stack_file.write(b"stack")
+    with open_journal(tmp_path, resume=False) as journal:
+        journal.mark_started(tiff_filepath)
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.get_done_rows(tiff_filepath) is None
+
+def test_truncated_frame_is_detected(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        tiff_filepath, rows = make_done_stack(tmp_path, journal)
+    os.truncate(tmp_path / "out" / "A1_RS_2_1_GFP_001.tif", 50)
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.get_done_rows(tiff_filepath) is None
+
+def test_missing_frame_is_detected(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        tiff_filepath, rows = make_done_stack(tmp_path, journal)
+    os.remove(tmp_path / "out" / "A1_RS_1_1_DAPI_001.tif")
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.get_done_rows(tiff_filepath) is None
+
+def test_changed_stack_is_split_again(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        tiff_filepath, rows = make_done_stack(tmp_path, journal)
+    with open(tiff_filepath, "ab") as stack_file:
+        stack_file.write(b" more")
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.get_done_rows(tiff_filepath) is None
+
+def test_without_resume_the_journal_is_cleared(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        tiff_filepath, rows = make_done_stack(tmp_path, journal)
+        assert journal.check_setting("channels", ["DAPI"])
+
+    with open_journal(tmp_path, resume=False) as journal:
+        assert journal.get_done_rows(tiff_filepath) is None
+        assert journal.check_setting("channels", ["GFP"])
+
+def test_resume_with_other_settings_is_refused(tmp_path):
+    with open_journal(tmp_path, resume=False) as journal:
+        assert journal.check_setting("channels", ["DAPI"])
+
+    with open_journal(tmp_path, resume=True) as journal:
+        assert journal.check_setting("channels", ["DAPI"])
+        assert not journal.check_setting("channels", ["GFP"])